@@ -0,0 +1,79 @@
+"""
+Measures peak RSS of preparing and sending a build context as the context grows
+
+Each measurement runs in a fresh interpreter so ru_maxrss reflects only that
+run. The "streamed" mode uses prepare_archive and reads the context back in
+the same 8KB blocks http.client uses when sending a file body. The
+"buffered" mode reproduces the previous BytesIO + getvalue() behaviour for
+comparison.
+
+Usage:
+    python benchmarks/bench_context_memory.py [size_mb ...]
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import os
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+from io import BytesIO
+
+sys.path.insert(0, {root!r})
+from builder.core.repo import prepare_archive
+
+mode, size_mb = sys.argv[1], int(sys.argv[2])
+
+code_path = tempfile.mkdtemp(prefix="bench")
+chunk = os.urandom(1024 * 1024)
+with open(os.path.join(code_path, "model.bin"), "wb") as f:
+    for _ in range(size_mb):
+        f.write(chunk)
+del chunk
+
+try:
+    if mode == "streamed":
+        context = prepare_archive("FROM scratch", code_path)
+        while context.read(8192):
+            pass
+        context.close()
+    else:
+        tarstream = BytesIO()
+        archive = tarfile.TarFile(fileobj=tarstream, mode="w")
+        archive.add(code_path, arcname="code")
+        body = tarstream.getvalue()
+        del body
+finally:
+    shutil.rmtree(code_path)
+
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024)
+"""
+
+
+def peak_rss_mb(mode, size_mb):
+    out = subprocess.check_output(
+        [sys.executable, "-c", CHILD.format(root=ROOT), mode, str(size_mb)]
+    )
+    return int(out.decode().strip())
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [16, 64, 256]
+
+    print("{:>12} {:>16} {:>16}".format("context MB", "streamed RSS MB", "buffered RSS MB"))
+    for size in sizes:
+        print("{:>12} {:>16} {:>16}".format(
+            size,
+            peak_rss_mb("streamed", size),
+            peak_rss_mb("buffered", size)
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Measures per request overhead of a fresh docker APIClient versus the shared client
+
+Runs a minimal fake docker daemon on a unix socket which answers /version
+and /images/json, then issues the same concurrent workload with a new
+APIClient per request (the previous behaviour) and with the shared client
+from docker_api_client. Reports latency per request and the number of
+connections the daemon accepted.
+
+Usage:
+    python benchmarks/bench_docker_client.py [requests] [threads]
+"""
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docker import APIClient  # noqa: E402
+
+from builder.clients.docker import docker_api_client, close_docker_clients  # noqa: E402
+
+# Simulated cost of the daemon answering a version negotiation
+VERSION_LATENCY = 0.002
+
+
+class FakeDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+    connections = 0
+
+    def get_request(self):
+        FakeDaemon.connections += 1
+        return super().get_request()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return "docker"
+
+    def do_GET(self):
+        if self.path.endswith("/version"):
+            time.sleep(VERSION_LATENCY)
+            body = {"ApiVersion": "1.41", "Version": "20.10.0"}
+        elif self.path.endswith("/_ping"):
+            body = "OK"
+        else:
+            body = []
+
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def run(workload, requests, threads):
+    FakeDaemon.connections = 0
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda _: workload(), range(requests)))
+    elapsed = time.perf_counter() - start
+    return elapsed / requests * 1000, FakeDaemon.connections
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "docker.sock")
+    server = FakeDaemon(socket_path, Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "unix://" + socket_path
+
+    def fresh_client():
+        client = APIClient(base_url=base_url)
+        client.images()
+        client.close()
+
+    def shared_client():
+        docker_api_client(base_url).images()
+
+    print("{:>8} {:>16} {:>12}".format("client", "ms per request", "connections"))
+    for name, workload in [("fresh", fresh_client), ("shared", shared_client)]:
+        latency, connections = run(workload, requests, threads)
+        print("{:>8} {:>16.3f} {:>12}".format(name, latency, connections))
+
+    close_docker_clients()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,28 @@
 import base64
-import boto3
+import hashlib
+import time
+import weakref
+
 from docker.errors import APIError
 
+from builder.authentication.cache import ExpiringCache
+from builder.clients.aws import aws_client
+from builder.settings import env_int
+
+# ECR tokens are valid for 12 hours, refresh them in the last 10% of that
+_ecr_tokens = ExpiringCache("ecr tokens", refresh_ratio=0.1)
+_docker_logins = ExpiringCache("docker logins")
+
+AUTH_ERROR_MARKERS = ["unauthorized", "denied", "authentication required", "authorization token has expired"]
+
 
 def session_client(service, auth_config):
     """
-    Creates and returns a boto3 session client
+    Returns a boto3 client for the session args in auth_config
+
+    Clients are shared across requests
     """
-    session = boto3.session.Session(**auth_config)
-    return session.client(service)
+    return aws_client(service, **auth_config)
 
 
 def get_ecr_image_prefix(auth_config):
@@ -27,17 +41,27 @@ def authenticate_ecr(auth_config, tag):
 
     Takes project tag and returns formatted ECR repo name
 
+    The authorization token is cached until shortly before it expires
+
     Inputs:
     auth_config => dict of aws creds
     tag => name of repository
     """
-    ecr_client = session_client("ecr", auth_config)
-    login = ecr_client.get_authorization_token()
-    b64token = login['authorizationData'][0]['authorizationToken'].encode('utf-8')
-    ecr_username, ecr_password = base64.b64decode(b64token).decode('utf-8').split(':')
-    ecr_url = login['authorizationData'][0]['proxyEndpoint']
+    def load_token():
+        ecr_client = session_client("ecr", auth_config)
+        login = ecr_client.get_authorization_token()
+        b64token = login['authorizationData'][0]['authorizationToken'].encode('utf-8')
+        ecr_username, ecr_password = base64.b64decode(b64token).decode('utf-8').split(':')
+        ecr_url = login['authorizationData'][0]['proxyEndpoint']
+        expires_at = login['authorizationData'][0]['expiresAt'].timestamp()
+
+        return (ecr_url, {'username': ecr_username, 'password': ecr_password}), expires_at
+
+    key = tuple(sorted(auth_config.items()))
+    ecr_url, creds = _ecr_tokens.get(key, load_token)
 
-    return ecr_url, {'username': ecr_username, 'password': ecr_password}
+    # Callers add login args to the returned dict so hand out a copy
+    return ecr_url, dict(creds)
 
 
 def authenticate_docker_client(docker_client, registry, auth_config):
@@ -52,3 +76,41 @@ def authenticate_docker_client(docker_client, registry, auth_config):
         return resp['Status']
     except APIError as e:
         raise e
+
+
+def login_docker_client(docker_client, registry, auth_config):
+    """
+    Authenticates the docker client to the registry unless a client for the
+    same daemon already logged in with the same credentials recently
+
+    Logins are reused for M1L0_BUILDER_LOGIN_TTL seconds. The cache key
+    includes the credentials so a refreshed ECR token logs in again.
+
+    The auth configs live on the client, so logins are cached per client
+    rather than per daemon. A client replaced after a failed health check
+    logs in again. A weak reference keeps a new client from matching the
+    entry of a collected client at the same address.
+    """
+    secret = hashlib.sha256(str(auth_config.get("password")).encode("utf-8")).hexdigest()
+    key = (weakref.ref(docker_client), registry, auth_config.get("username"), secret)
+
+    def login():
+        status = authenticate_docker_client(docker_client, registry, dict(auth_config))
+        if status != "Login Succeeded":
+            # Failed logins are returned but not cached
+            return status, time.time()
+        return status, time.time() + env_int("M1L0_BUILDER_LOGIN_TTL", 3600)
+
+    return _docker_logins.get(key, login)
+
+
+def is_auth_error(error):
+    """Returns True if a docker api error was caused by missing or expired credentials"""
+    msg = str(error).lower()
+    return any(marker in msg for marker in AUTH_ERROR_MARKERS)
+
+
+def invalidate_registry_auth():
+    """Drops cached ECR tokens and docker logins after an auth failure"""
+    _ecr_tokens.clear()
+    _docker_logins.clear()
@@ -0,0 +1,82 @@
+# Process wide cache for credentials and tokens which expire
+import logging
+import threading
+import time
+
+module_logger = logging.getLogger('builder.authentication.cache')
+
+
+class ExpiringCache:
+    """
+    Thread safe cache of values which expire
+
+    Values are produced by a loader returning (value, expires_at). Once less
+    than refresh_ratio of a value's lifetime remains it is refreshed on a
+    background thread while the current value keeps being served. Expired
+    or missing values are loaded on the calling thread, once per key no
+    matter how many threads ask for it.
+    """
+    def __init__(self, name, refresh_ratio=0.2):
+        self.name = name
+        self.refresh_ratio = refresh_ratio
+        self._entries = {}
+        self._key_locks = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _store(self, key, loader):
+        loaded_at = time.time()
+        value, expires_at = loader()
+        if expires_at > loaded_at:
+            with self._lock:
+                self._entries[key] = (value, loaded_at, expires_at)
+        return value
+
+    def _refresh(self, key, loader):
+        try:
+            with self._key_lock(key):
+                self._store(key, loader)
+        except Exception as e:
+            module_logger.warning("Background refresh of {} cache failed: {}".format(self.name, e))
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, key, loader):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None and now < entry[2]:
+            value, loaded_at, expires_at = entry
+            refresh_at = expires_at - (expires_at - loaded_at) * self.refresh_ratio
+
+            if now >= refresh_at:
+                with self._lock:
+                    start = key not in self._refreshing
+                    self._refreshing.add(key)
+                if start:
+                    threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+
+            return value
+
+        with self._key_lock(key):
+            # Another thread may have loaded it while we waited
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None and time.time() < entry[2]:
+                return entry[0]
+
+            return self._store(key, loader)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
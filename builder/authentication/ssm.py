@@ -1,9 +1,20 @@
 import json
 import os
+import time
 
-import boto3
 from botocore.exceptions import ClientError
 
+from builder.authentication.cache import ExpiringCache
+from builder.clients.aws import aws_client
+from builder.settings import env_int
+
+# Parsed secret shared by the dockerhub/ecr/github lookups
+_secrets = ExpiringCache("secrets")
+
+
+def clear_credentials_cache():
+    _secrets.clear()
+
 
 def fetch_local_credentials(service):
     auth_config = dict()
@@ -29,6 +40,9 @@ def fetch_local_credentials(service):
 def fetch_credentials(service):
     """
     Fetches the required creds from SSM service
+
+    The secret is cached for M1L0_BUILDER_SECRET_TTL seconds and refreshed in
+    the background before it expires
     """
     if os.environ.get("MODE") == "Local":
         return fetch_local_credentials(service)
@@ -37,22 +51,27 @@ def fetch_credentials(service):
     region = os.environ.get("AWS_DEFAULT_REGION")
 
     aws_container_credentials_uri = os.environ.get("AWS_CONTAINER_CREDENTIALS_RELATIVE_URI")
+    profile = os.environ.get("AWS_PROFILE")
+
+    def load_secret():
+        if aws_container_credentials_uri:
+            ssm_client = aws_client("secretsmanager", region_name=region)
+        else:
+            ssm_client = aws_client("secretsmanager", profile_name=profile, region_name=region)
+
+        try:
+            get_secret_value_response = ssm_client.get_secret_value(
+                SecretId=secret_name,
+                VersionStage="AWSCURRENT"
+            )["SecretString"]
+        except ClientError as e:
+            raise e
+
+        ttl = env_int("M1L0_BUILDER_SECRET_TTL", 300)
+        return json.loads(get_secret_value_response), time.time() + ttl
+
+    creds = _secrets.get((secret_name, region), load_secret)
 
-    if aws_container_credentials_uri:
-        ssm_client = boto3.session.Session(region_name=region).client("secretsmanager")
-    else:
-        profile = os.environ.get("AWS_PROFILE")
-        ssm_client = boto3.session.Session(profile_name=profile, region_name=region).client("secretsmanager")
-
-    try:
-        get_secret_value_response = ssm_client.get_secret_value(
-            SecretId=secret_name,
-            VersionStage="AWSCURRENT"
-        )["SecretString"]
-    except ClientError as e:
-        raise e
-
-    creds = json.loads(get_secret_value_response)
     auth_config = dict()
     if service == "dockerhub":
         auth_config = {
@@ -9,6 +9,7 @@ version = '1.0.0'
 @click.option("--host", default="[::]", type=str)
 @click.option("--port", default=50051, type=int)
 @click.option("--secure", is_flag=True, help="Run service with TLS")
-def start(host, port, secure):
+@click.option("--metrics-port", default=None, type=int, help="Port for Prometheus metrics")
+def start(host, port, secure, metrics_port):
     """Starts ImageBuilder service"""
-    serve(host, port, secure)
+    serve(host, port, secure, metrics_port=metrics_port)
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import threading
+
+import boto3
+
+module_logger = logging.getLogger('builder.clients.aws')
+
+# Env vars which change the credentials a new session would pick up
+CREDENTIAL_ENV_VARS = [
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "AWS_SESSION_TOKEN",
+    "AWS_CONTAINER_CREDENTIALS_RELATIVE_URI",
+    "AWS_SHARED_CREDENTIALS_FILE"
+]
+
+# Bound on cached clients, session args may carry rotating keys from secrets
+MAX_CLIENTS = 32
+
+# (service, session args) => (credentials fingerprint, client), least recently used first
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def _credentials_fingerprint():
+    values = "\0".join(os.environ.get(x, "") for x in CREDENTIAL_ENV_VARS)
+    return hashlib.sha256(values.encode("utf-8")).hexdigest()
+
+
+def aws_client(service, **session_args):
+    """
+    Returns a boto3 client shared process wide
+
+    Clients are keyed by service and the session args e.g. profile_name and
+    region_name. When the credentials in the environment rotate the client
+    is rebuilt on next use. Credentials fetched by botocore itself, such as
+    the ECS container role, refresh inside the existing client.
+
+    Clients built with other credentials are dropped once the environment
+    credentials change and at most MAX_CLIENTS clients are kept.
+    """
+    key = (service, tuple(sorted(session_args.items())))
+    fingerprint = _credentials_fingerprint()
+
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            _clients.move_to_end(key)
+            return entry[1]
+
+        if entry is not None:
+            module_logger.info("Credentials changed, recreating {} client".format(service))
+
+        for stale in [k for k, v in _clients.items() if v[0] != fingerprint]:
+            del _clients[stale]
+
+        # boto3 sessions are not thread safe so they are created under the lock
+        client = boto3.session.Session(**session_args).client(service)
+        _clients[key] = (fingerprint, client)
+        while len(_clients) > MAX_CLIENTS:
+            _clients.popitem(last=False)
+        return client
+
+
+def clear_aws_clients():
+    with _clients_lock:
+        _clients.clear()
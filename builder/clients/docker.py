@@ -1,12 +1,117 @@
+import logging
+import os
+import threading
+import time
+
 import docker
 from docker import APIClient
+from docker.errors import DockerException
+from requests.exceptions import RequestException
+
+from builder.settings import env_int
+
+module_logger = logging.getLogger('builder.clients.docker')
+
+DEFAULT_SOCKET = 'unix://var/run/docker.sock'
+
+# Shared api clients keyed by daemon endpoint => [client, last health check]
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Per endpoint locks held while a client is created so a slow daemon only
+# blocks callers of that endpoint
+_endpoint_locks = {}
+
+
+def docker_endpoints():
+    """
+    Returns the configured docker daemon endpoints
+
+    M1L0_BUILDER_DOCKER_HOSTS is a comma separated list, the first entry is
+    the default endpoint
+    """
+    hosts = os.environ.get("M1L0_BUILDER_DOCKER_HOSTS", "")
+    endpoints = [x.strip() for x in hosts.split(",") if len(x.strip()) > 0]
+    return endpoints or [DEFAULT_SOCKET]
 
 
-def docker_api_client(socket='unix://var/run/docker.sock'):
+def cli_host(endpoint):
+    """
+    Returns the endpoint in the form the docker cli expects for DOCKER_HOST
+
+    docker-py accepts unix://var/run/docker.sock which the cli reads as a
+    relative path
+    """
+    if endpoint.startswith("unix://") and not endpoint.startswith("unix:///"):
+        return "unix:///" + endpoint[len("unix://"):]
+    return endpoint
+
+
+def _create_client(socket):
+    module_logger.info("Creating docker api client for {}".format(socket))
+    return APIClient(
+        base_url=socket,
+        version=os.environ.get("M1L0_BUILDER_DOCKER_API_VERSION") or None,
+        timeout=env_int("M1L0_BUILDER_DOCKER_TIMEOUT", 60),
+        max_pool_size=env_int("M1L0_BUILDER_DOCKER_POOL_SIZE", 10)
+    )
+
+
+def docker_api_client(socket=None):
     """
     Returns a low level docker api client for building which returns progress status
+
+    Clients are shared process wide per daemon endpoint so connections in
+    the pool are kept alive across requests and the api version is only
+    negotiated once. A client is pinged at most every
+    M1L0_BUILDER_DOCKER_HEALTHCHECK seconds and replaced if the ping fails.
     """
-    return APIClient(base_url=socket)
+    socket = socket or docker_endpoints()[0]
+    interval = env_int("M1L0_BUILDER_DOCKER_HEALTHCHECK", 30)
+
+    with _clients_lock:
+        entry = _clients.get(socket)
+        endpoint_lock = _endpoint_locks.setdefault(socket, threading.Lock())
+
+    if entry is None:
+        # Creating the client negotiates the api version with the daemon
+        with endpoint_lock:
+            with _clients_lock:
+                entry = _clients.get(socket)
+            if entry is None:
+                client = _create_client(socket)
+                with _clients_lock:
+                    _clients[socket] = [client, time.time()]
+                return client
+
+    with _clients_lock:
+        if time.time() - entry[1] < interval:
+            return entry[0]
+
+        # Only one caller runs the health check, the rest use the client meanwhile
+        entry[1] = time.time()
+        client = entry[0]
+
+    try:
+        client.ping()
+        return client
+    except (DockerException, RequestException) as e:
+        module_logger.warning("Docker daemon at {} failed health check, reconnecting: {}".format(socket, e))
+
+    client.close()
+    with endpoint_lock:
+        new_client = _create_client(socket)
+        with _clients_lock:
+            _clients[socket] = [new_client, time.time()]
+    return new_client
+
+
+def close_docker_clients():
+    """Closes all shared api clients"""
+    with _clients_lock:
+        for client, _ in _clients.values():
+            client.close()
+        _clients.clear()
 
 
 def docker_client(version='1.40'):
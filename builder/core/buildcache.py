@@ -0,0 +1,161 @@
+# Content addressed index of previously built images
+import hashlib
+import json
+import logging
+import os
+import re
+import stat
+import threading
+import time
+
+from builder.core.ignores import walk_context
+from builder.settings import cache_dir, env_bool
+
+module_logger = logging.getLogger('builder.buildcache')
+
+CONTENT_HASH_LABEL = "m1l0.content-hash"
+
+# Config keys that change the built image besides the context files
+HASHED_CONFIG_KEYS = ["dockerfile", "dockerfile_from_image", "framework_labels", "tags"]
+
+# ${NAME} or $NAME in a FROM line
+ARG_RE = re.compile(r"\$\{(\w+)\}|\$(\w+)")
+
+
+def context_files(code_path, matcher=None):
+    """
+    Yields (path, relpath) of every file in the build context in a stable order
+    """
+    for path, relpath, is_dir in walk_context(code_path, matcher):
+        if not is_dir:
+            yield path, relpath
+
+
+def dockerfile_base_images(dockerfile):
+    """
+    Returns the images the stages of dockerfile are built FROM
+
+    Build args declared before the first FROM are replaced by their
+    defaults. Earlier stages, scratch and images named by args without a
+    default are left out as they cannot be resolved before the build.
+    """
+    images = []
+    stages = set()
+    args = {}
+    for line in dockerfile.splitlines():
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+
+        if parts[0].upper() == "ARG" and not stages and not images:
+            name, sep, default = parts[1].partition("=")
+            if sep:
+                args[name] = default.strip("\"'")
+            continue
+        if parts[0].upper() != "FROM":
+            continue
+
+        names = [x for x in parts[1:] if not x.startswith("--")]
+        if not names:
+            continue
+
+        image = ARG_RE.sub(lambda m: args.get(m.group(1) or m.group(2), m.group(0)), names[0])
+        if image.lower() not in stages and image != "scratch" and "$" not in image and image not in images:
+            images.append(image)
+        if len(names) >= 3 and names[1].upper() == "AS":
+            stages.add(names[2].lower())
+    return images
+
+
+def compute_content_hash(dockerfile, code_path, config, custom_dockerfile=False, matcher=None, base_images=None):
+    """
+    Computes a sha256 over the rendered dockerfile, build config and context files
+
+    base_images maps each base image to its local image id so a base image
+    which was updated and pulled again produces a new hash.
+
+    Each file contributes its relative path, permission bits and contents so
+    renames and chmods produce a new hash. Files excluded by matcher are
+    skipped as they never reach the build context.
+    """
+    digest = hashlib.sha256()
+
+    build_config = {k: config.get(k) for k in HASHED_CONFIG_KEYS}
+    build_config["custom_dockerfile"] = custom_dockerfile
+    build_config["base_images"] = base_images or {}
+    digest.update(json.dumps(build_config, sort_keys=True).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(dockerfile.encode("utf-8"))
+    digest.update(b"\0")
+
+    for path, relpath in context_files(code_path, matcher):
+        st = os.lstat(path)
+        digest.update("{}\0{:o}\0".format(relpath, stat.S_IMODE(st.st_mode)).encode("utf-8"))
+
+        if stat.S_ISLNK(st.st_mode):
+            digest.update(os.readlink(path).encode("utf-8"))
+        else:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+class BuildCache:
+    """
+    Local index of content hash => image tag
+
+    The index is a json file under the cache dir. Entries are validated
+    against the image label by the caller before reuse.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, index_path=None):
+        self.index_path = index_path or os.path.join(cache_dir(), "build_index.json")
+
+    @property
+    def enabled(self):
+        return env_bool("M1L0_BUILDER_BUILD_CACHE", True)
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, index):
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def lookup(self, content_hash):
+        """Returns the image tag recorded for the content hash or None"""
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._load().get(content_hash)
+
+        if entry:
+            return entry["image"]
+
+    def record(self, content_hash, image):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            index = self._load()
+            index[content_hash] = {"image": image, "created": int(time.time())}
+            self._save(index)
+
+    def discard(self, content_hash):
+        """Drops a stale entry whose image no longer exists"""
+        with self._lock:
+            index = self._load()
+            if index.pop(content_hash, None) is not None:
+                module_logger.info("Discarding stale build cache entry {}".format(content_hash))
+                self._save(index)
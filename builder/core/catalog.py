@@ -0,0 +1,274 @@
+# Persistent index of built and pushed images
+from contextlib import closing
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from builder.settings import cache_dir
+
+module_logger = logging.getLogger('builder.catalog')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    namespace TEXT,
+    name TEXT,
+    revision TEXT,
+    tag TEXT,
+    image_id TEXT,
+    digest TEXT,
+    size INTEGER,
+    content_hash TEXT,
+    repository TEXT,
+    created REAL,
+    updated REAL,
+    pushed REAL
+);
+CREATE INDEX IF NOT EXISTS images_namespace_name ON images (namespace, name, revision);
+CREATE INDEX IF NOT EXISTS images_tag ON images (tag);
+CREATE INDEX IF NOT EXISTS images_digest ON images (digest);
+CREATE INDEX IF NOT EXISTS images_image_id ON images (image_id);
+CREATE INDEX IF NOT EXISTS images_content_hash ON images (content_hash);
+
+CREATE TABLE IF NOT EXISTS labels (
+    build_id TEXT NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (build_id, name)
+);
+CREATE INDEX IF NOT EXISTS labels_name_value ON labels (name, value);
+
+CREATE TABLE IF NOT EXISTS pushes (
+    build_id TEXT NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    repository TEXT NOT NULL,
+    digest TEXT,
+    pushed REAL,
+    PRIMARY KEY (build_id, repository)
+);
+CREATE INDEX IF NOT EXISTS pushes_repository ON pushes (repository);
+CREATE INDEX IF NOT EXISTS pushes_digest ON pushes (digest);
+
+CREATE TABLE IF NOT EXISTS base_images (
+    image TEXT PRIMARY KEY,
+    uses INTEGER NOT NULL DEFAULT 0,
+    last_used REAL,
+    pulled REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS base_images_uses ON base_images (uses, last_used);
+"""
+
+
+class ImageCatalog:
+    """
+    SQLite catalog of the images built and pushed by the service
+
+    Each build records an entry under its request id which a later push
+    updates with the pushed repository and digest. A push to several
+    registries or revisions adds one row per repository to pushes, the
+    entry itself holds the last one. Entries are indexed by namespace/name,
+    tag, repository, digest and label so lookups never touch the docker
+    daemon.
+    """
+    _initialized = set()
+    _lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), "catalog.db")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+
+        with self._lock:
+            if self.path not in self._initialized:
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.executescript(SCHEMA)
+                self._initialized.add(self.path)
+
+        return closing(conn)
+
+    def record_build(self, id, namespace, name, revision, tag, image_id=None, size=None, labels=None,
+                     content_hash=None):
+        now = time.time()
+        with self._connect() as conn, conn:
+            conn.execute(
+                "INSERT INTO images (id, namespace, name, revision, tag, image_id, size, content_hash, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET namespace = excluded.namespace, name = excluded.name, "
+                "revision = excluded.revision, tag = excluded.tag, image_id = excluded.image_id, "
+                "size = excluded.size, content_hash = excluded.content_hash, updated = excluded.updated",
+                (id, namespace, name, revision, tag, image_id, size, content_hash, now, now)
+            )
+            conn.execute("DELETE FROM labels WHERE build_id = ?", (id,))
+            conn.executemany(
+                "INSERT INTO labels (build_id, name, value) VALUES (?, ?, ?)",
+                [(id, k, v) for k, v in (labels or {}).items()]
+            )
+
+    def record_push(self, id, tag, repository, digest=None):
+        """
+        Records the pushed repository of an image
+
+        The entry is found by request id, else the latest build of the same
+        tag, else a new entry is created
+        """
+        now = time.time()
+        with self._connect() as conn, conn:
+            row = conn.execute("SELECT id FROM images WHERE id = ?", (id,)).fetchone()
+            if row is None:
+                row = conn.execute("SELECT id FROM images WHERE tag = ? ORDER BY created DESC LIMIT 1",
+                                   (tag,)).fetchone()
+
+            if row is None:
+                conn.execute(
+                    "INSERT INTO images (id, tag, repository, digest, created, updated, pushed) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (id, tag, repository, digest, now, now, now)
+                )
+                build_id = id
+            else:
+                build_id = row["id"]
+                conn.execute(
+                    "UPDATE images SET repository = ?, digest = COALESCE(?, digest), updated = ?, pushed = ? "
+                    "WHERE id = ?",
+                    (repository, digest, now, now, build_id)
+                )
+
+            conn.execute(
+                "INSERT INTO pushes (build_id, repository, digest, pushed) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (build_id, repository) DO UPDATE SET digest = COALESCE(excluded.digest, digest), "
+                "pushed = excluded.pushed",
+                (build_id, repository, digest, now)
+            )
+
+    def _entry(self, conn, row):
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["labels"] = {
+            r["name"]: r["value"]
+            for r in conn.execute("SELECT name, value FROM labels WHERE build_id = ?", (entry["id"],))
+        }
+        entry["repositories"] = [
+            r["repository"]
+            for r in conn.execute("SELECT repository FROM pushes WHERE build_id = ? ORDER BY pushed DESC, rowid DESC",
+                                  (entry["id"],))
+        ]
+        # Pushes recorded before the pushes table only have the entry's repository
+        if not entry["repositories"] and entry["repository"]:
+            entry["repositories"] = [entry["repository"]]
+        return entry
+
+    def get(self, id):
+        with self._connect() as conn:
+            return self._entry(conn, conn.execute("SELECT * FROM images WHERE id = ?", (id,)).fetchone())
+
+    def find(self, query):
+        """
+        Returns the entry matching query or None
+
+        query is a request id, an image or repo digest, a tag, a pushed
+        repository or namespace/name[:revision]. The latest matching entry
+        is returned.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM images WHERE id = ?", (query,)).fetchone()
+
+            if row is None and query.startswith("sha256:"):
+                row = conn.execute(
+                    "SELECT * FROM images WHERE digest = ? OR image_id = ? "
+                    "OR id IN (SELECT build_id FROM pushes WHERE digest = ?) ORDER BY created DESC LIMIT 1",
+                    (query, query, query)
+                ).fetchone()
+
+            if row is None:
+                row = conn.execute("SELECT * FROM images WHERE tag = ? ORDER BY created DESC LIMIT 1",
+                                   (query,)).fetchone()
+
+            if row is None:
+                row = conn.execute(
+                    "SELECT images.* FROM images JOIN pushes ON pushes.build_id = images.id "
+                    "WHERE pushes.repository = ? ORDER BY pushes.pushed DESC LIMIT 1",
+                    (query,)
+                ).fetchone()
+
+            if row is None and "/" in query:
+                namespace, _, name = query.partition("/")
+                name, _, revision = name.partition(":")
+                sql = "SELECT * FROM images WHERE namespace = ? AND name = ?"
+                args = [namespace, name]
+                if revision:
+                    sql += " AND revision = ?"
+                    args.append(revision)
+                row = conn.execute(sql + " ORDER BY created DESC LIMIT 1", args).fetchone()
+
+            return self._entry(conn, row)
+
+    def find_by_label(self, name, value):
+        """Returns entries carrying the label, latest first"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT images.* FROM images JOIN labels ON labels.build_id = images.id "
+                "WHERE labels.name = ? AND labels.value = ? ORDER BY images.created DESC",
+                (name, value)
+            ).fetchall()
+            return [self._entry(conn, row) for row in rows]
+
+    def latest(self, namespace, name, limit=10):
+        """Returns the latest entries of namespace/name"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM images WHERE namespace = ? AND name = ? ORDER BY created DESC LIMIT ?",
+                (namespace, name, limit)
+            ).fetchall()
+            return [self._entry(conn, row) for row in rows]
+
+    def record_base_image_use(self, image):
+        """Counts a build from the base image"""
+        with self._connect() as conn, conn:
+            conn.execute(
+                "INSERT INTO base_images (image, uses, last_used) VALUES (?, 1, ?) "
+                "ON CONFLICT (image) DO UPDATE SET uses = uses + 1, last_used = excluded.last_used",
+                (image, time.time())
+            )
+
+    def record_base_image_pull(self, image, size=None):
+        """Records a pull of the base image, size is None once it is removed locally"""
+        with self._connect() as conn, conn:
+            conn.execute(
+                "INSERT INTO base_images (image, pulled, size) VALUES (?, ?, ?) "
+                "ON CONFLICT (image) DO UPDATE SET pulled = excluded.pulled, size = excluded.size",
+                (image, time.time() if size is not None else None, size)
+            )
+
+    def base_images(self, limit=None):
+        """Returns base images by use, most used first"""
+        sql = "SELECT * FROM base_images ORDER BY uses DESC, last_used DESC"
+        args = ()
+        if limit is not None:
+            sql += " LIMIT ?"
+            args = (limit,)
+
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(sql, args)]
+
+    def image_last_used(self, image):
+        """Returns when the image was last built, pushed or used as a base image, or None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT MAX(COALESCE(pushed, 0), COALESCE(updated, 0)) AS last_used FROM images "
+                "WHERE tag = ? OR repository = ? "
+                "OR id IN (SELECT build_id FROM pushes WHERE repository = ?) ORDER BY last_used DESC LIMIT 1",
+                (image, image, image)
+            ).fetchone()
+            if row is not None and row["last_used"]:
+                return row["last_used"]
+
+            row = conn.execute("SELECT last_used FROM base_images WHERE image = ?", (image,)).fetchone()
+            if row is not None:
+                return row["last_used"]
+        return None
@@ -2,16 +2,30 @@
 import json
 import logging
 import os
+import queue
+import threading
 import time
-import traceback
 
-import boto3
 from botocore.exceptions import ClientError
 
+from builder.clients.aws import aws_client
+from builder.core.logsink import LogSink
+from builder.settings import env_float, env_int
+
 module_logger = logging.getLogger('builder.cloudwatch')
 
 # Orig idea from: https://gist.github.com/olegdulin/fd18906343d75142a487b9a9da9042e0
 
+# PutLogEvents limits
+MAX_BATCH_BYTES = 1048576
+MAX_BATCH_EVENTS = 10000
+MAX_EVENT_BYTES = 262144
+EVENT_OVERHEAD = 26
+
+# Log streams already created => (log group, stream)
+_log_streams = set()
+_log_streams_lock = threading.Lock()
+
 
 def get_client(service):
     region = os.environ.get("AWS_DEFAULT_REGION")
@@ -19,18 +33,22 @@ def get_client(service):
     aws_container_credentials_uri = os.environ.get("AWS_CONTAINER_CREDENTIALS_RELATIVE_URI")
 
     if aws_container_credentials_uri:
-        client = boto3.session.Session(region_name=region).client(service)
+        client = aws_client(service, region_name=region)
     else:
         profile = os.environ.get("AWS_PROFILE")
-        client = boto3.session.Session(profile_name=profile, region_name=region).client(service)
+        client = aws_client(service, profile_name=profile, region_name=region)
 
     return client
 
 
 def setup_log_stream(stream):
-    """Creates the log stream"""
+    """Creates the log stream, once per process"""
     log_group = os.environ.get("JOB_LOG_GROUP")
 
+    with _log_streams_lock:
+        if (log_group, stream) in _log_streams:
+            return
+
     client = get_client("logs")
 
     try:
@@ -52,33 +70,151 @@ def setup_log_stream(stream):
     except client.exceptions.ResourceAlreadyExistsException:
         module_logger.info("Log group stream {} already exists".format(stream))
 
+    with _log_streams_lock:
+        _log_streams.add((log_group, stream))
 
-def send_to_cloudwatch(stream, events):
-    """Write to log stream"""
 
-    log_group = os.environ.get("JOB_LOG_GROUP")
-    log_events = []
-    for event in events:
-        log_events.append({
-            "timestamp": int(round(time.time() * 1000)),
-            "message": json.dumps(event)
-        })
-
-    log_event = {
-        "logGroupName": log_group,
-        "logStreamName": stream,
-        "logEvents": log_events
-    }
+def clear_log_stream_cache():
+    with _log_streams_lock:
+        _log_streams.clear()
 
-    client = get_client("logs")
 
-    try:
-        client.put_log_events(**log_event)
-    except client.exceptions.InvalidSequenceTokenException as e:
-        log_event["sequenceToken"] = e.response["expectedSequenceToken"]
+def _timestamp():
+    return int(round(time.time() * 1000))
+
+
+class CloudWatchLogShipper(LogSink):
+    """
+    Ships log lines of a single stream to cloudwatch from a background thread
+
+    Lines are timestamped when put and queued on a bounded queue. The
+    shipper thread sends them in batches within the PutLogEvents limits,
+    at the latest M1L0_BUILDER_LOG_FLUSH_INTERVAL seconds after the first
+    line of a batch was queued.
+
+    When the queue is full put blocks for up to M1L0_BUILDER_LOG_BLOCK_TIMEOUT
+    seconds and then drops the line so a throttled cloudwatch never stalls a
+    build for long. Dropped lines are counted and reported in the stream.
+
+    close() flushes the remaining lines and waits for the thread to finish.
+    """
+    _CLOSE = object()
+
+    def __init__(self, stream, queue_size=None, flush_interval=None, block_timeout=None):
+        super().__init__(stream)
+        self.log_group = os.environ.get("JOB_LOG_GROUP")
+        self.flush_interval = flush_interval or env_float("M1L0_BUILDER_LOG_FLUSH_INTERVAL", 2.0)
+        if block_timeout is None:
+            block_timeout = env_float("M1L0_BUILDER_LOG_BLOCK_TIMEOUT", 1.0)
+        self.block_timeout = block_timeout
+        self.dropped = 0
+
+        # Guards dropped which producers increment and the shipper thread reports
+        self._lock = threading.Lock()
+        self._reported_dropped = 0
+        self._sequence_token = None
+        self._ready = False
+        self._queue = queue.Queue(maxsize=queue_size or env_int("M1L0_BUILDER_LOG_QUEUE_SIZE", 10000))
+        self._thread = threading.Thread(target=self._run, name="cloudwatch-{}".format(stream), daemon=True)
+        self._thread.start()
+
+    def put(self, event):
+        """Queues an event, returns False if it was dropped"""
+        message = json.dumps(event)
+        if len(message.encode("utf-8")) > MAX_EVENT_BYTES - EVENT_OVERHEAD:
+            message = message.encode("utf-8")[:MAX_EVENT_BYTES - EVENT_OVERHEAD].decode("utf-8", "ignore")
+
+        try:
+            self._queue.put({"timestamp": _timestamp(), "message": message}, timeout=self.block_timeout)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(self._CLOSE)
+            self._thread.join()
+
+        if self.dropped > 0:
+            module_logger.warning("Dropped {} log lines of stream {}".format(self.dropped, self.stream))
+
+    def _run(self):
+        batch = []
+        batch_bytes = 0
+        deadline = None
+
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is None or item is self._CLOSE:
+                self._flush(batch)
+                batch, batch_bytes, deadline = [], 0, None
+                if item is self._CLOSE:
+                    return
+                continue
+
+            size = len(item["message"].encode("utf-8")) + EVENT_OVERHEAD
+            if batch_bytes + size > MAX_BATCH_BYTES or len(batch) >= MAX_BATCH_EVENTS:
+                self._flush(batch)
+                batch, batch_bytes, deadline = [], 0, None
+
+            batch.append(item)
+            batch_bytes += size
+            if deadline is None:
+                deadline = time.time() + self.flush_interval
+
+    def _flush(self, batch):
+        with self._lock:
+            dropped = self.dropped - self._reported_dropped
+            self._reported_dropped = self.dropped
+
+        if dropped > 0:
+            batch = batch + [{
+                "timestamp": batch[-1]["timestamp"] if batch else _timestamp(),
+                "message": json.dumps("{} log lines dropped".format(dropped))
+            }]
+
+        if len(batch) == 0:
+            return
 
         try:
-            client.put_log_events(**log_event)
-        except ClientError as e:
-            failure_msg = "\n{}\n{}".format(traceback.format_exc(), str(e))
-            module_logger.error(failure_msg)
+            if not self._ready:
+                setup_log_stream(self.stream)
+                self._ready = True
+            self._put_log_events(batch)
+        except Exception as e:
+            module_logger.error("Unable to send {} log lines to stream {}: {}".format(len(batch), self.stream, e))
+
+    def _put_log_events(self, batch, attempts=3):
+        client = get_client("logs")
+
+        for attempt in range(attempts):
+            args = {
+                "logGroupName": self.log_group,
+                "logStreamName": self.stream,
+                "logEvents": batch
+            }
+            if self._sequence_token:
+                args["sequenceToken"] = self._sequence_token
+
+            try:
+                resp = client.put_log_events(**args)
+                self._sequence_token = resp.get("nextSequenceToken")
+                return
+            except client.exceptions.InvalidSequenceTokenException as e:
+                self._sequence_token = e.response.get("expectedSequenceToken")
+            except client.exceptions.DataAlreadyAcceptedException as e:
+                self._sequence_token = e.response.get("expectedSequenceToken")
+                return
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") != "ThrottlingException" or attempt == attempts - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+        raise RuntimeError("Sequence token for stream {} kept changing".format(self.stream))
@@ -0,0 +1,240 @@
+# Deduplication of identical builds which are in flight at the same time
+from contextlib import contextmanager
+import hashlib
+import logging
+import threading
+
+import grpc
+from grpc_interceptor.exceptions import Aborted, GrpcException
+
+from builder.core.metrics import cache_lookup
+from builder.settings import env_bool
+
+module_logger = logging.getLogger('builder.coalescer')
+
+
+@contextmanager
+def _no_slot():
+    yield
+
+
+def build_request_key(request, backend=None):
+    """
+    Returns a canonical hash of a build request
+
+    The request id is left out as every client sends its own. Ignores are
+    hashed in order since later patterns override earlier ones, tags are
+    not ordered. Requests for different build backends never share a build.
+    """
+    h = hashlib.sha256()
+    h.update(request.config.SerializeToString(deterministic=True))
+
+    for ignore in request.ignores:
+        h.update(b"\0ignore\0" + ignore.value.encode("utf-8"))
+
+    for name, value in sorted((tag.name, tag.value) for tag in request.tags):
+        h.update(b"\0tag\0" + name.encode("utf-8") + b"\0" + value.encode("utf-8"))
+
+    if backend:
+        h.update(b"\0backend\0" + backend.encode("utf-8"))
+
+    return h.hexdigest()
+
+
+class _Flight:
+    """
+    Log lines of an in flight build which participants replay and then follow
+
+    The build runs on its own thread so it is not tied to the stream of the
+    request which started it, and keeps going while any participant is
+    attached.
+    """
+    def __init__(self):
+        self.lines = []
+        self.done = False
+        self.error = None
+        self.result = None
+        self._contexts = []
+        self._cond = threading.Condition()
+
+    def attach(self, context):
+        with self._cond:
+            self._contexts.append(context)
+
+    def detach(self, context):
+        with self._cond:
+            self._contexts.remove(context)
+
+    @property
+    def contexts(self):
+        with self._cond:
+            return list(self._contexts)
+
+    @property
+    def abandoned(self):
+        with self._cond:
+            return len(self._contexts) == 0
+
+    def active(self):
+        """True while a participant is attached whose client is still connected"""
+        return any(c is None or c.is_active() for c in self.contexts)
+
+    def append(self, line):
+        with self._cond:
+            self.lines.append(line)
+            self._cond.notify_all()
+
+    def finish(self, error=None, result=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self.result = result
+            self._cond.notify_all()
+
+    def follow(self):
+        pos = 0
+        while True:
+            with self._cond:
+                while pos == len(self.lines) and not self.done:
+                    self._cond.wait()
+                lines = self.lines[pos:]
+                done = self.done
+
+            for line in lines:
+                yield line
+            pos += len(lines)
+
+            if done and pos == len(self.lines):
+                return
+
+
+class _FlightContext:
+    """
+    Context the shared build runs with
+
+    Metadata comes from the request which started the build. The build is
+    active while any participant is and aborting raises a GrpcException
+    which every participant turns into its own status.
+    """
+    def __init__(self, flight, context):
+        self._flight = flight
+        self._context = context
+
+    def invocation_metadata(self):
+        if self._context is None:
+            return ()
+        return self._context.invocation_metadata()
+
+    def is_active(self):
+        return self._flight.active()
+
+    def set_trailing_metadata(self, metadata):
+        for context in self._flight.contexts:
+            if context is not None:
+                context.set_trailing_metadata(metadata)
+
+    def abort(self, code, details):
+        raise GrpcException(details, status_code=code)
+
+
+def follower_error(error):
+    """Returns the status exception a request which joined a failed build ends with"""
+    if isinstance(error, GrpcException):
+        return GrpcException(error.details, status_code=error.status_code)
+    return GrpcException("Shared build failed: {}".format(error), status_code=grpc.StatusCode.UNKNOWN)
+
+
+class BuildCoalescer:
+    """
+    Runs a single build for identical requests which arrive while it is in flight
+
+    The first request for a key starts the build. Requests with the same
+    key which arrive before it finishes replay the lines logged so far,
+    then follow the build live and end with the same result. The request
+    which started the build gets its own error, the others a GrpcException
+    with the same status so they can be told apart from failures of their
+    own. The build stops only once every participant has gone away.
+
+    follow_slot(context) is a context manager held while a request follows
+    a build it did not start, used to bound the threads they occupy.
+
+    Set M1L0_BUILDER_COALESCE to false to run every request separately.
+    """
+    def __init__(self, follow_slot=None):
+        self.follow_slot = follow_slot
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return env_bool("M1L0_BUILDER_COALESCE", True)
+
+    def run(self, key, work, context=None, on_join=None):
+        """
+        Yields the log lines of the build for key
+
+        work is called with a context to start the build if none is in
+        flight and returns an iterator of log lines, its return value is
+        the result of the build. on_join is called with the result in
+        requests which joined a build started by another.
+        """
+        if not self.enabled:
+            for line in work(context):
+                yield line
+            return
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+            flight.attach(context)
+
+        cache_lookup("coalesce", not leader)
+
+        try:
+            if leader:
+                threading.Thread(target=self._run_flight, args=(key, flight, work, _FlightContext(flight, context)),
+                                 name="build-{}".format(key[:12]), daemon=True).start()
+                for line in flight.follow():
+                    yield line
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+            module_logger.info("Joining in flight build {}".format(key[:12]))
+            slot = self.follow_slot(context) if self.follow_slot else _no_slot()
+            with slot:
+                for line in flight.follow():
+                    yield line
+
+            if flight.error is not None:
+                raise follower_error(flight.error)
+            if on_join is not None:
+                on_join(flight.result)
+        finally:
+            flight.detach(context)
+
+    def _run_flight(self, key, flight, work, context):
+        error = None
+        result = None
+        lines = work(context)
+        try:
+            while True:
+                if flight.abandoned:
+                    if hasattr(lines, "close"):
+                        lines.close()
+                    error = Aborted("Build was cancelled by all clients")
+                    break
+                flight.append(next(lines))
+        except StopIteration as e:
+            result = e.value
+        except Exception as e:
+            error = e
+
+        # Requests arriving from now on start a new build
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(error, result)
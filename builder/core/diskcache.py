@@ -0,0 +1,120 @@
+# On disk cache of directories bounded by a byte budget
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from builder.settings import cache_dir
+
+module_logger = logging.getLogger('builder.diskcache')
+
+
+def dir_size(path):
+    """Returns the total size in bytes of the files below path"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class DirectoryCache:
+    """
+    Directory of cache entries with least recently used eviction
+
+    Each entry is a directory under <cache dir>/<name>/<key> with a sidecar
+    <key>.json recording its size and last use. Callers hold lock(key) while
+    creating or reading an entry and entries which are locked are never
+    evicted.
+    """
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+
+    @property
+    def root(self):
+        return cache_dir(self.name)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def _meta_path(self, key):
+        return os.path.join(self.root, "{}.json".format(key))
+
+    def lock(self, key):
+        """Returns the process wide lock guarding the entry"""
+        with self._locks_lock:
+            return self._locks.setdefault((self.root, key), threading.Lock())
+
+    def exists(self, key):
+        return os.path.isdir(self.path(key)) and os.path.exists(self._meta_path(key))
+
+    def touch(self, key, size=None):
+        """Records a use of the entry, measuring its size if not given"""
+        meta_path = self._meta_path(key)
+        if size is None:
+            size = dir_size(self.path(key))
+
+        tmp_path = "{}.{}.tmp".format(meta_path, threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump({"size": size, "last_used": time.time()}, f)
+        os.replace(tmp_path, meta_path)
+
+    def remove(self, key):
+        meta_path = self._meta_path(key)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        shutil.rmtree(self.path(key), ignore_errors=True)
+
+    def entries(self):
+        """Returns list of (key, size, last_used) for complete entries"""
+        res = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            try:
+                with open(self._meta_path(key), "r") as f:
+                    meta = json.load(f)
+                res.append((key, meta["size"], meta["last_used"]))
+            except (IOError, ValueError, KeyError):
+                continue
+        return res
+
+    def evict(self, keep=()):
+        """
+        Removes least recently used entries until the cache fits the budget
+
+        Returns the number of bytes reclaimed
+        """
+        entries = sorted(self.entries(), key=lambda x: x[2])
+        total = sum(x[1] for x in entries)
+        reclaimed = 0
+
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+
+            lock = self.lock(key)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                module_logger.info("Evicting {} cache entry {} ({} bytes)".format(self.name, key, size))
+                self.remove(key)
+            finally:
+                lock.release()
+
+            total -= size
+            reclaimed += size
+
+        return reclaimed
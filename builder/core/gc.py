@@ -0,0 +1,193 @@
+# Garbage collection of images, containers and build cache on the docker host
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+import sqlite3
+
+from docker.errors import DockerException
+
+from builder.clients.docker import docker_api_client
+from builder.core.catalog import ImageCatalog
+from builder.settings import env_bool, env_int
+
+module_logger = logging.getLogger('builder.gc')
+
+GB = 1024 * 1024 * 1024
+
+# Images being built or pushed => start time
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+@contextmanager
+def in_flight(image):
+    """Protects an image from collection while it is built or pushed"""
+    with _in_flight_lock:
+        _in_flight[image] = _in_flight.get(image, []) + [time.time()]
+    try:
+        yield
+    finally:
+        with _in_flight_lock:
+            _in_flight[image].pop(0)
+            if not _in_flight[image]:
+                del _in_flight[image]
+
+
+def in_flight_images():
+    """Returns (images, start time of the oldest) of builds and pushes in flight"""
+    with _in_flight_lock:
+        starts = [t for times in _in_flight.values() for t in times]
+        return set(_in_flight), min(starts) if starts else None
+
+
+def docker_disk_usage(df):
+    """Returns the bytes used by images, containers and build cache from a df() response"""
+    total = df.get("LayersSize") or 0
+    total += sum(x.get("SizeRw") or 0 for x in df.get("Containers") or [])
+    total += sum(x.get("Size") or 0 for x in df.get("BuildCache") or [] if not x.get("Shared"))
+    return total
+
+
+class GCReport:
+    """What a collection reclaimed"""
+    def __init__(self, usage_before):
+        self.usage_before = usage_before
+        self.usage_after = usage_before
+        self.containers = 0
+        self.images = []
+        self.reclaimed = 0
+
+    def __str__(self):
+        return "Reclaimed {} bytes, removed {} containers and {} images, docker disk usage {} => {} bytes".format(
+            self.reclaimed, self.containers, len(self.images), self.usage_before, self.usage_after
+        )
+
+
+class ImageGarbageCollector:
+    """
+    Keeps docker disk usage between watermarks
+
+    When images, containers and build cache use more than
+    M1L0_BUILDER_GC_HIGH_WATERMARK bytes, stopped containers, dangling images
+    and build cache are pruned. Tagged images are then removed least
+    recently used first until usage is below M1L0_BUILDER_GC_LOW_WATERMARK.
+    Last use comes from the catalog, falling back to the image creation time.
+
+    Images of builds and pushes in flight, warm base images returned by
+    protected and images used by containers are never removed. Leftovers
+    of in flight builds are protected by only pruning what was created
+    before the oldest of them started.
+    """
+    def __init__(self, catalog=None, high_watermark=None, low_watermark=None, interval=None, protected=None):
+        self.catalog = catalog or ImageCatalog()
+        self.high_watermark = high_watermark or env_int("M1L0_BUILDER_GC_HIGH_WATERMARK", 80 * GB)
+        self.low_watermark = low_watermark or env_int("M1L0_BUILDER_GC_LOW_WATERMARK", 60 * GB)
+        self.interval = interval or env_int("M1L0_BUILDER_GC_INTERVAL", 300)
+        self.protected = protected or set
+
+        self.last_report = None
+        self.total_reclaimed = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return env_bool("M1L0_BUILDER_GC", True)
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="image-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.collect()
+            except Exception as e:
+                module_logger.error("Garbage collection failed: {}".format(e))
+            self._stop.wait(self.interval)
+
+    def _last_used(self, image):
+        for tag in image.get("RepoTags") or []:
+            try:
+                last_used = self.catalog.image_last_used(tag)
+            except sqlite3.Error:
+                last_used = None
+            if last_used:
+                return last_used
+        return image.get("Created") or 0
+
+    def _prune(self, api_client, report, until):
+        filters = {"until": str(int(until))}
+
+        resp = api_client.prune_containers(filters=filters)
+        report.containers += len(resp.get("ContainersDeleted") or [])
+
+        resp = api_client.prune_images(filters=dict(filters, dangling=True))
+        report.images += [x.get("Deleted") or x.get("Untagged") for x in resp.get("ImagesDeleted") or []]
+
+    def _remove_lru(self, api_client, report, df, keep):
+        candidates = []
+        for image in df.get("Images") or []:
+            tags = set(image.get("RepoTags") or [])
+            if not tags or tags & keep or (image.get("Containers") or 0) > 0:
+                continue
+            candidates.append((self._last_used(image), image))
+
+        candidates.sort(key=lambda x: x[0])
+
+        usage = docker_disk_usage(df)
+        for _, image in candidates:
+            if usage <= self.low_watermark:
+                break
+
+            try:
+                api_client.remove_image(image["Id"], force=True)
+            except DockerException as e:
+                module_logger.info("Unable to remove image {}: {}".format(image["Id"], e))
+                continue
+
+            module_logger.info("Removed image {} {}".format(image["Id"], ", ".join(image.get("RepoTags") or [])))
+            report.images.append(image["Id"])
+            # Only the layers not shared with other images are freed
+            usage -= max(0, (image.get("Size") or 0) - max(0, image.get("SharedSize") or 0))
+
+    def collect(self):
+        """Runs a collection if usage is over the high watermark, returns the report"""
+        with self._lock:
+            api_client = docker_api_client()
+            usage = docker_disk_usage(api_client.df())
+            report = GCReport(usage)
+
+            if usage <= self.high_watermark:
+                return report
+
+            images, oldest_start = in_flight_images()
+            until = oldest_start if oldest_start is not None else time.time()
+            self._prune(api_client, report, until)
+
+            if oldest_start is None:
+                # Build cache has no age filter in the api so only prune it when idle
+                api_client.prune_builds()
+
+            df = api_client.df()
+            keep = images | set(self.protected())
+            self._remove_lru(api_client, report, df, keep)
+
+            report.usage_after = docker_disk_usage(api_client.df())
+            report.reclaimed = max(0, usage - report.usage_after)
+
+            self.last_report = report
+            self.total_reclaimed += report.reclaimed
+            module_logger.info(str(report))
+            return report
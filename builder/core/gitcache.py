@@ -0,0 +1,161 @@
+# Local cache of bare git mirrors for git sources
+import base64
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+from urllib.parse import urlparse, urlunparse
+
+from builder.core.diskcache import DirectoryCache
+from builder.core.metrics import cache_lookup
+from builder.settings import env_int
+
+module_logger = logging.getLogger('builder.gitcache')
+
+DEFAULT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+COMMIT_RE = re.compile(r"^[0-9a-fA-F]{7,40}$")
+
+
+class GitError(Exception):
+    pass
+
+
+def split_source(source):
+    """
+    Splits a git source url into the clone url and revision
+
+    The revision is given as the url fragment e.g.
+    https://github.com/myrepo/myproject.git#v1.0 and defaults to HEAD
+    """
+    parsed = urlparse(source)
+    ref = validate_ref(parsed.fragment or "HEAD")
+    return urlunparse(parsed._replace(fragment="")), ref
+
+
+def validate_ref(ref):
+    """
+    Returns ref if it is a commit or a valid ref name else raises GitError
+
+    The ref comes from the client so it must never be taken as a git option
+    e.g. #--upload-pack=...
+    """
+    if COMMIT_RE.match(ref):
+        return ref
+    if ref.startswith("-"):
+        raise GitError("Invalid git revision {}".format(ref))
+
+    proc = subprocess.Popen(["git", "check-ref-format", "--allow-onelevel", ref],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if proc.wait() != 0:
+        raise GitError("Invalid git revision {}".format(ref))
+    return ref
+
+
+def mirror_key(url):
+    """Returns the cache key of a repository url, ignoring credentials and case of the host"""
+    parsed = urlparse(url)
+    netloc = parsed.netloc.rsplit("@", 1)[-1].lower()
+    path = parsed.path.rstrip("/")
+    if path.endswith(".git"):
+        path = path[:-len(".git")]
+    return hashlib.sha1("{}://{}{}".format(parsed.scheme, netloc, path).encode("utf-8")).hexdigest()
+
+
+class GitMirrorCache:
+    """
+    Bare mirrors of git repositories shared across builds
+
+    The first build of a repository clones a mirror which later builds
+    update with an incremental fetch. The requested revision is exported
+    with git archive into the build dir so the workspace only ever holds
+    the files of that single revision.
+    """
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = env_int("M1L0_BUILDER_GIT_CACHE_SIZE", DEFAULT_CACHE_SIZE)
+        self.cache = DirectoryCache("git", max_bytes)
+
+    def _git(self, args, token=None, **kwargs):
+        cmd = ["git"]
+        if token:
+            # Credentials are passed per command so they are never written to the mirror config
+            basic = base64.b64encode("x-access-token:{}".format(token).encode("utf-8")).decode("utf-8")
+            cmd += ["-c", "http.extraHeader=Authorization: Basic {}".format(basic)]
+        cmd += args
+
+        env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+        return subprocess.Popen(cmd, env=env, **kwargs)
+
+    def _run(self, args, token=None):
+        proc = self._git(args, token=token, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise GitError("git {} failed: {}".format(" ".join(args), err.decode("utf-8", "replace").strip()))
+        return out.decode("utf-8").strip()
+
+    def update_mirror(self, url, key, token=None):
+        """Clones the mirror if missing else fetches new commits into it"""
+        mirror = self.cache.path(key)
+
+        hit = self.cache.exists(key)
+        cache_lookup("git", hit)
+
+        if hit:
+            module_logger.info("Updating git mirror {}".format(mirror))
+            self._run(["--git-dir", mirror, "remote", "update", "--prune"], token=token)
+        else:
+            module_logger.info("Creating git mirror of {} at {}".format(url, mirror))
+            tmp_mirror = mirror + "_tmp"
+            shutil.rmtree(tmp_mirror, ignore_errors=True)
+            self._run(["clone", "--mirror", "--quiet", url, tmp_mirror], token=token)
+            shutil.rmtree(mirror, ignore_errors=True)
+            os.rename(tmp_mirror, mirror)
+
+        return mirror
+
+    def resolve(self, mirror, ref, token=None):
+        """Resolves ref to a commit, fetching it if it is a commit not yet in the mirror"""
+        # validate_ref keeps refs from being taken as options, --end-of-options
+        # is not used as it needs git 2.24 and the service image ships 2.20
+        validate_ref(ref)
+        rev_parse = ["--git-dir", mirror, "rev-parse", "--verify", "{}^{{commit}}".format(ref)]
+        try:
+            return self._run(rev_parse)
+        except GitError:
+            self._run(["--git-dir", mirror, "fetch", "--quiet", "--", "origin", ref], token=token)
+            return self._run(rev_parse)
+
+    def export(self, source, dest, extract, token=None):
+        """
+        Exports the revision of source into dest
+
+        extract is called with the tar stream of the revision and dest
+        """
+        url, ref = split_source(source)
+        key = mirror_key(url)
+
+        with self.cache.lock(key):
+            mirror = self.update_mirror(url, key, token=token)
+            commit = self.resolve(mirror, ref, token=token)
+            module_logger.info("Exporting {} at {} ({})".format(url, ref, commit))
+
+            proc = self._git(["--git-dir", mirror, "archive", "--format=tar", commit],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                extract(proc.stdout, dest)
+            finally:
+                proc.stdout.close()
+                err = proc.stderr.read()
+                proc.stderr.close()
+                proc.wait()
+
+            if proc.returncode != 0:
+                raise GitError("git archive failed: {}".format(err.decode("utf-8", "replace").strip()))
+
+            self.cache.touch(key)
+
+        self.cache.evict(keep=[key])
+        return commit
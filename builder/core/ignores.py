@@ -0,0 +1,195 @@
+# Matching of build context files against ignore patterns
+import logging
+import os
+import re
+
+module_logger = logging.getLogger('builder.ignores')
+
+DOCKERIGNORE = ".dockerignore"
+
+
+def translate(pattern):
+    """
+    Translates a glob pattern into a regex matching a relative path
+
+    '*' and '?' do not cross directory separators while '**' matches any
+    number of directories. A match on a directory also matches everything
+    below it.
+    """
+    i, n = 0, len(pattern)
+    res = ""
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            res += "(?:.*/)?"
+            i += 3
+            continue
+        elif pattern.startswith("**", i):
+            res += ".*"
+            i += 2
+            continue
+        elif c == "*":
+            res += "[^/]*"
+        elif c == "?":
+            res += "[^/]"
+        elif c == "[":
+            j = pattern.find("]", i + 1)
+            if j == -1:
+                res += re.escape(c)
+            else:
+                stuff = pattern[i + 1:j]
+                if stuff.startswith("!"):
+                    stuff = "^" + stuff[1:]
+                res += "[{}]".format(stuff.replace("\\", "\\\\"))
+                i = j
+        else:
+            res += re.escape(c)
+        i += 1
+
+    return "{}(?:/.*)?$".format(res)
+
+
+def literal_prefix(pattern):
+    """Returns the part of the pattern before the first wildcard"""
+    match = re.search(r"[*?\[]", pattern)
+    return pattern if match is None else pattern[:match.start()]
+
+
+class IgnoreMatcher:
+    """
+    Compiled set of ignore patterns following .dockerignore semantics
+
+    Patterns are matched against paths relative to the context root, later
+    patterns override earlier ones and a leading '!' re-includes a path.
+
+    Patterns passed in through the build request without a '/' match at any
+    depth, the same as the previous shutil.ignore_patterns behaviour.
+    """
+    def __init__(self, dockerignore_patterns=None, request_patterns=None):
+        self.patterns = []
+
+        for pattern in dockerignore_patterns or []:
+            self._add(pattern, anywhere=False)
+
+        for pattern in request_patterns or []:
+            self._add(pattern, anywhere=True)
+
+        self.has_exceptions = any(negate for _, negate, _ in self.patterns)
+
+        # Without exceptions all patterns collapse into a single regex
+        if not self.has_exceptions and len(self.patterns) > 0:
+            self._combined = re.compile("|".join("(?:{})".format(p.pattern) for p, _, _ in self.patterns))
+        else:
+            self._combined = None
+
+        self._exception_prefixes = [prefix for _, negate, prefix in self.patterns if negate]
+
+    def _add(self, pattern, anywhere):
+        pattern = pattern.strip()
+        if len(pattern) == 0 or pattern.startswith("#"):
+            return
+
+        negate = pattern.startswith("!")
+        if negate:
+            pattern = pattern[1:].strip()
+
+        pattern = os.path.normpath(pattern).replace(os.sep, "/").lstrip("/")
+        if pattern == ".":
+            return
+
+        if anywhere and "/" not in pattern:
+            pattern = "**/" + pattern
+
+        self.patterns.append((re.compile(translate(pattern)), negate, literal_prefix(pattern)))
+
+    @classmethod
+    def for_context(cls, context_path, request_patterns=None):
+        """Creates a matcher from the .dockerignore in context_path plus request patterns"""
+        dockerignore_patterns = []
+        dockerignore = os.path.join(context_path, DOCKERIGNORE)
+
+        if os.path.isfile(dockerignore):
+            with open(dockerignore, "r") as f:
+                dockerignore_patterns = f.read().splitlines()
+            module_logger.info("Loaded {} patterns from {}".format(len(dockerignore_patterns), dockerignore))
+
+        return cls(dockerignore_patterns, request_patterns)
+
+    def __bool__(self):
+        return len(self.patterns) > 0
+
+    def matches(self, relpath):
+        """Returns True if the relative path is excluded from the context"""
+        if self._combined is not None:
+            return self._combined.match(relpath) is not None
+
+        excluded = False
+        for regex, negate, _ in self.patterns:
+            if regex.match(relpath):
+                excluded = not negate
+        return excluded
+
+    def prunes(self, reldir):
+        """
+        Returns True if the directory can be skipped without walking it
+
+        A directory is only pruned if no exception pattern could re-include
+        something below it
+        """
+        if not self.matches(reldir):
+            return False
+
+        for prefix in self._exception_prefixes:
+            if prefix.startswith(reldir + "/") or reldir.startswith(prefix):
+                return False
+        return True
+
+    def copytree_ignore(self, root):
+        """Returns a callable for the ignore argument of shutil.copytree"""
+        def _ignore(path, names):
+            reldir = os.path.relpath(path, root)
+            ignored = set()
+            for name in names:
+                relpath = name if reldir == "." else "{}/{}".format(reldir.replace(os.sep, "/"), name)
+                if os.path.isdir(os.path.join(path, name)) and not os.path.islink(os.path.join(path, name)):
+                    if self.prunes(relpath):
+                        ignored.add(name)
+                elif self.matches(relpath):
+                    ignored.add(name)
+            return ignored
+
+        return _ignore
+
+
+def walk_context(root, matcher=None):
+    """
+    Yields (path, relpath, is_dir) for every entry of the build context that
+    is not excluded by matcher, in a stable order
+
+    Excluded directories are pruned before they are walked. Symlinks to
+    directories are yielded as entries and not followed.
+    """
+    for dirpath, dirs, files in os.walk(root):
+        reldir = os.path.relpath(dirpath, root).replace(os.sep, "/")
+        reldir = "" if reldir == "." else reldir + "/"
+
+        keep = []
+        for name in sorted(dirs):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                files.append(name)
+            elif matcher and matcher.prunes(reldir + name):
+                continue
+            else:
+                keep.append(name)
+        dirs[:] = keep
+
+        for name in dirs:
+            relpath = reldir + name
+            if not (matcher and matcher.matches(relpath)):
+                yield os.path.join(dirpath, name), relpath, True
+
+        for name in sorted(files):
+            relpath = reldir + name
+            if not (matcher and matcher.matches(relpath)):
+                yield os.path.join(dirpath, name), relpath, False
@@ -1,18 +1,35 @@
+from concurrent import futures
+import logging
 import os
 from pathlib import Path
-import shutil
+import queue
+import sqlite3
 
-from .repo import create_dockerfile, prepare_archive, build_docker_image, push_docker_image, remove_image
+from .buildcache import BuildCache, CONTENT_HASH_LABEL, compute_content_hash, dockerfile_base_images
+from .catalog import ImageCatalog
+from .gc import in_flight
+from .ignores import IgnoreMatcher
+from .metrics import cache_lookup, phase
+from .repo import create_dockerfile, prepare_archive, build_docker_image, push_docker_image, remove_image, \
+    reuse_cached_image, image_details, split_list, tag_image, build_backend, BUILDKIT_BACKEND, CONTEXT_DIR
+from builder.settings import env_int
+
+module_logger = logging.getLogger('builder.imagebuilder')
 
 
 class ImageBuilder:
     """
     Actual image builder class
     """
-    def __init__(self, request, code_copy_path=None):
+    def __init__(self, request, code_copy_path=None, catalog=None, backend=None):
         self.request = request
         self.code_copy_path = code_copy_path
-        self.code_path = request.id
+        self.catalog = catalog or ImageCatalog()
+
+        self.backend = build_backend(backend)
+
+        # Arguments of the last record_build, shared with requests joining the build
+        self._recorded = None
 
     @property
     def imagename(self):
@@ -51,10 +68,12 @@ class ImageBuilder:
         self.config["framework_labels"] = framework_labels
 
         has_requirements = False
-        files_list = os.listdir(self.code_copy_path)
+        has_constraints = False
+        files_list = list(os.listdir(self.code_copy_path))
 
         if "requirements.txt" in files_list:
             has_requirements = True
+            has_constraints = "constraints.txt" in files_list
 
         tmpl_dir = os.path.join(Path(__file__).resolve().cwd(), "builder", "templates")
 
@@ -69,30 +88,149 @@ class ImageBuilder:
             else:
                 raise RuntimeError("Custom dockerfile specified but not found.")
         else:
-            dockerfile = create_dockerfile(
-                self.config,
-                tmpl_dir,
-                self.code_path,
-                dockerfile_path=None,
-                has_requirements=has_requirements,
-                save_file=False
-            )
+            with phase("build", "dockerfile"):
+                dockerfile = create_dockerfile(
+                    self.config,
+                    tmpl_dir,
+                    CONTEXT_DIR,
+                    dockerfile_path=None,
+                    has_requirements=has_requirements,
+                    has_constraints=has_constraints,
+                    save_file=False,
+                    buildkit=self.backend == BUILDKIT_BACKEND
+                )
 
-        build_context = prepare_archive(dockerfile, self.code_copy_path, custom_dockerfile=custom_dockerfile)
+            # Usage counts decide which base images are kept warm
+            if self.config.get("dockerfile_from_image"):
+                try:
+                    self.catalog.record_base_image_use(self.config["dockerfile_from_image"])
+                except sqlite3.Error as e:
+                    module_logger.error("Unable to record base image use: {}".format(e))
 
-        tag = "{}:{}".format(self.config.get("repository"), self.config.get("revision"))
+        # A revision list is pushed to several tags, the image is built as the first
+        tag = "{}:{}".format(self.config.get("repository"), split_list(self.config.get("revision"))[0])
 
-        for log in build_docker_image(build_context,
-                                      tag,
-                                      labels,
-                                      self.config,
-                                      self.code_copy_path,
-                                      custom_dockerfile=custom_dockerfile):
-            if "imagename:" in log:
-                self._imagename = log
-                continue
-            else:
-                yield log
+        ignores = [ig.value for ig in self.request.ignores]
+        matcher = IgnoreMatcher.for_context(self.code_copy_path, ignores)
+
+        build_cache = BuildCache()
+        content_hash = None
+        base_images = self.base_image_ids(dockerfile) if build_cache.enabled else None
+        if base_images is not None:
+            with phase("build", "hash"):
+                content_hash = compute_content_hash(dockerfile, self.code_copy_path, self.config,
+                                                    custom_dockerfile=custom_dockerfile, matcher=matcher,
+                                                    base_images=base_images)
+            self.config["content_hash"] = content_hash
+
+            cached_image = build_cache.lookup(content_hash)
+            if cached_image and reuse_cached_image(cached_image, tag, content_hash):
+                cache_lookup("build", True)
+                yield "Build cache hit {}, reusing image {}".format(content_hash[:12], cached_image)
+                self._imagename = "imagename: {}".format(tag)
+                self.record_build(tag, labels, content_hash)
+                return
+
+            cache_lookup("build", False)
+            if cached_image:
+                build_cache.discard(content_hash)
+
+        with phase("build", "archive"):
+            build_context = prepare_archive(dockerfile, self.code_copy_path, custom_dockerfile=custom_dockerfile,
+                                            matcher=matcher, code_dir=CONTEXT_DIR)
+
+        with in_flight(tag), phase("build", "daemon"):
+            for log in build_docker_image(build_context,
+                                          tag,
+                                          labels,
+                                          self.config,
+                                          self.code_copy_path,
+                                          custom_dockerfile=custom_dockerfile,
+                                          backend=self.backend,
+                                          cache_from=self.cache_sources(tag)):
+                if "imagename:" in log:
+                    self._imagename = log
+                    continue
+                else:
+                    yield log
+
+        if content_hash:
+            build_cache.record(content_hash, tag)
+
+        self.record_build(tag, labels, content_hash)
+
+    def base_image_ids(self, dockerfile):
+        """
+        Returns base image => local image id for the FROM images of dockerfile
+
+        Returns None if a base image is not present locally. The build pulls
+        it so the base the image would be built on is not known beforehand
+        and the build cache is not used.
+        """
+        ids = {}
+        for image in dockerfile_base_images(dockerfile):
+            details = image_details(image)
+            if not details or not details.get("Id"):
+                module_logger.info("Base image {} not present locally, skipping build cache".format(image))
+                return None
+            ids[image] = details["Id"]
+        return ids
+
+    def cache_sources(self, tag):
+        """
+        Returns earlier images of the project to use as layer cache sources
+
+        These are the image being rebuilt and the last
+        M1L0_BUILDER_CACHE_FROM_COUNT images of namespace/name in the
+        catalog, using the pushed repositories where there are any
+        """
+        count = env_int("M1L0_BUILDER_CACHE_FROM_COUNT", 3)
+        if count <= 0:
+            return []
+
+        sources = [tag]
+        try:
+            entries = self.catalog.latest(self.config["namespace"], self.config["name"], limit=count)
+        except sqlite3.Error as e:
+            module_logger.error("Unable to read cache sources from catalog: {}".format(e))
+            entries = []
+
+        for entry in entries:
+            for image in entry["repositories"] or [entry["tag"]]:
+                if image and image not in sources:
+                    sources.append(image)
+        return sources
+
+    def record_build(self, tag, labels, content_hash=None, request_id=None):
+        """Adds the built image to the catalog, failures do not fail the build"""
+        request_id = request_id or self.request.id
+        self._recorded = (tag, labels, content_hash)
+        details = image_details(tag) or {}
+
+        catalog_labels = dict(labels)
+        catalog_labels.update(self.config["framework_labels"])
+        if content_hash:
+            catalog_labels[CONTENT_HASH_LABEL] = content_hash
+
+        try:
+            self.catalog.record_build(
+                request_id,
+                self.config["namespace"],
+                self.config["name"],
+                split_list(self.config["revision"])[0],
+                tag,
+                image_id=details.get("Id"),
+                size=details.get("Size"),
+                labels=catalog_labels,
+                content_hash=content_hash
+            )
+        except sqlite3.Error as e:
+            module_logger.error("Unable to record build {} in catalog: {}".format(request_id, e))
+
+    def record_shared(self, request_id):
+        """Records the built image under the id of a request which shared this build"""
+        if self._recorded is not None:
+            self.record_build(*self._recorded, request_id=request_id)
 
     def push(self):
         self.config = {
@@ -110,20 +248,106 @@ class ImageBuilder:
             "dockerfile": self.request.config.dockerfile
         }
 
-        for log in push_docker_image(self.config.get("service"),
-                                     self.config.get("repository"),
-                                     self.config.get("revision"),
-                                     self.config.get("id")):
-            if "repository:" in log:
-                self._repository = log
-                continue
+        services = split_list(self.config["service"])
+        revisions = split_list(self.config["revision"])
+        targets = [(service, revision) for service in services for revision in revisions]
+
+        results = []
+        repository = self.config["repository"]
+        source = "{}:{}".format(repository, revisions[0])
+
+        try:
+            with in_flight(source):
+                if len(targets) == 1:
+                    for log in self._push_target(targets[0][0], targets[0][1], self.config["id"], results):
+                        yield log
+                else:
+                    # The image is built as the first revision, the others are tagged from it
+                    with phase("push", "tag"):
+                        for revision in revisions[1:]:
+                            tag_image(source, "{}:{}".format(repository, revision))
+
+                    for log in self._push_fan_out(targets, results):
+                        yield log
+        finally:
+            # Targets pushed before a failure are recorded and cleaned up too
+            self.record_pushes(source, results)
+
+    def record_pushes(self, source, results):
+        """Records the pushed repositories, failures do not fail the push"""
+        if not results:
+            return
+
+        self._repositories = [pushed for _, _, pushed, _ in results]
+        self._repository = self._repositories[0]
+
+        for _, _, pushed, digest in results:
+            try:
+                self.catalog.record_push(self.request.id, source, pushed[len("repository: "):], digest=digest)
+            except sqlite3.Error as e:
+                module_logger.error("Unable to record push {} in catalog: {}".format(self.request.id, e))
+
+    def _push_target(self, service, revision, job_id, results):
+        """Pushes a single service and revision, appending (service, revision, repository, digest) to results"""
+        digest = None
+        repository = None
+        for log in push_docker_image(service, self.config["repository"], revision, job_id):
+            if log.startswith("digest: "):
+                digest = log[len("digest: "):]
+            elif "repository:" in log:
+                repository = log
             else:
                 yield log
 
-    def cleanup_code_path(self):
-        shutil.rmtree(self.code_copy_path)
+        results.append((service, revision, repository, digest))
+
+    def _push_fan_out(self, targets, results):
+        """
+        Pushes the targets concurrently, merging their progress
+
+        Lines are prefixed with the target they belong to. Every target is
+        attempted and reported before an error is raised for the failed ones.
+        """
+        lines = queue.Queue()
+        failures = []
+
+        def run(service, revision):
+            prefix = "[{} {}] ".format(service, revision)
+            job_id = "{}-{}-{}".format(self.config["id"], service, revision)
+            try:
+                for log in self._push_target(service, revision, job_id, results):
+                    lines.put(prefix + log)
+            except Exception as e:
+                failures.append("{} {}".format(service, revision))
+                lines.put(prefix + "Push failed: {}".format(e))
+            finally:
+                lines.put(None)
+
+        max_workers = min(len(targets), env_int("M1L0_BUILDER_PUSH_CONCURRENCY", 4))
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for service, revision in targets:
+                executor.submit(run, service, revision)
+
+            remaining = len(targets)
+            while remaining > 0:
+                line = lines.get()
+                if line is None:
+                    remaining -= 1
+                else:
+                    yield line
+
+        for service, revision, repository, digest in results:
+            yield "[{} {}] Pushed {} {}".format(service, revision, repository[len("repository: "):], digest or "")
+
+        if failures:
+            raise RuntimeError("Push failed for {}".format(", ".join(failures)))
 
     def cleanup_repository(self):
         # Delete created image self.repository else it will clog up disk
         if os.environ.get("MODE") != "Local":
-            remove_image(self._repository.lstrip("repository: "))
+            # Nothing is recorded if the push failed
+            with phase("push", "cleanup"):
+                for repository in getattr(self, "_repositories", None) or [getattr(self, "_repository", None)]:
+                    if repository is None:
+                        continue
+                    remove_image(repository[len("repository: "):])
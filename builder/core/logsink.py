@@ -0,0 +1,26 @@
+# Interface of build and push log destinations
+import abc
+
+
+class LogSink(abc.ABC):
+    """
+    Receives the log lines of a single build or push stream
+
+    put is called on the build path so implementations must not block on
+    the network. close is called once the stream ends.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @abc.abstractmethod
+    def put(self, event):
+        """Takes a log line, returns False if it was dropped"""
+
+    def close(self):
+        pass
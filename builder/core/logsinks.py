@@ -0,0 +1,101 @@
+# Destinations for build and push logs
+import gzip
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import shutil
+import sys
+import threading
+
+from builder.core.cloudwatchlogs import CloudWatchLogShipper
+from builder.core.logsink import LogSink
+from builder.settings import cache_dir, env_int
+
+module_logger = logging.getLogger('builder.logsinks')
+
+DEFAULT_FILE_SIZE = 10 * 1024 * 1024
+
+
+class NullLogSink(LogSink):
+    """Discards all logs"""
+    def put(self, event):
+        return True
+
+
+class StdoutLogSink(LogSink):
+    """Writes logs to stdout prefixed with the stream name"""
+    _lock = threading.Lock()
+
+    def put(self, event):
+        with self._lock:
+            sys.stdout.write("[{}] {}\n".format(self.stream, event))
+            sys.stdout.flush()
+        return True
+
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class FileLogSink(LogSink):
+    """
+    Writes logs to <cache dir>/logs/<stream>.log
+
+    The file is rotated into gzip compressed segments <stream>.log.N.gz once
+    it reaches M1L0_BUILDER_LOG_FILE_SIZE bytes, keeping
+    M1L0_BUILDER_LOG_FILE_BACKUPS segments. It is also rotated on close so
+    the logs of a finished stream are only kept compressed.
+    """
+    def __init__(self, stream, log_dir=None):
+        super().__init__(stream)
+        log_dir = log_dir or cache_dir("logs")
+        self.path = os.path.join(log_dir, "{}.log".format(stream))
+
+        self._handler = RotatingFileHandler(
+            self.path,
+            maxBytes=env_int("M1L0_BUILDER_LOG_FILE_SIZE", DEFAULT_FILE_SIZE),
+            backupCount=env_int("M1L0_BUILDER_LOG_FILE_BACKUPS", 10),
+            delay=True
+        )
+        self._handler.namer = lambda name: name + ".gz"
+        self._handler.rotator = _gzip_rotator
+        self._handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+
+    def put(self, event):
+        self._handler.handle(logging.makeLogRecord({"msg": json.dumps(event)}))
+        return True
+
+    def close(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            self._handler.doRollover()
+        self._handler.close()
+        if os.path.exists(self.path) and os.path.getsize(self.path) == 0:
+            os.remove(self.path)
+
+
+LOG_SINKS = {
+    "cloudwatch": CloudWatchLogShipper,
+    "file": FileLogSink,
+    "stdout": StdoutLogSink,
+    "null": NullLogSink
+}
+
+
+def open_log_sink(stream):
+    """
+    Returns the log sink for a build or push stream
+
+    The sink is set by M1L0_BUILDER_LOG_SINK, one of cloudwatch, file,
+    stdout or null. It defaults to file when MODE is Local and cloudwatch
+    otherwise.
+    """
+    default = "file" if os.environ.get("MODE") == "Local" else "cloudwatch"
+    name = os.environ.get("M1L0_BUILDER_LOG_SINK") or default
+
+    if name not in LOG_SINKS:
+        raise ValueError("Unknown log sink {}, must be one of {}".format(name, ", ".join(sorted(LOG_SINKS))))
+
+    return LOG_SINKS[name](stream)
@@ -0,0 +1,87 @@
+# Prometheus metrics of builds and pushes
+from contextlib import contextmanager
+import logging
+import os
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from builder.settings import env_int
+
+module_logger = logging.getLogger('builder.metrics')
+
+# Phases range from sub second renders to builds of large images
+PHASE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+PHASE_SECONDS = Histogram(
+    "m1l0_builder_phase_seconds",
+    "Time spent in each phase of builds and pushes",
+    ["operation", "phase"],
+    buckets=PHASE_BUCKETS
+)
+
+QUEUE_SECONDS = Histogram(
+    "m1l0_builder_queue_seconds",
+    "Time builds and pushes wait for a slot",
+    buckets=PHASE_BUCKETS
+)
+
+BYTES = Counter(
+    "m1l0_builder_bytes",
+    "Bytes of fetched sources, build contexts sent to the daemon and layers pushed",
+    ["kind"]
+)
+
+CACHE_LOOKUPS = Counter(
+    "m1l0_builder_cache_lookups",
+    "Cache lookups by cache and result",
+    ["cache", "result"]
+)
+
+ACTIVE_BUILDS = Gauge("m1l0_builder_active_builds", "Builds and pushes holding a slot")
+QUEUED_BUILDS = Gauge("m1l0_builder_queued_builds", "Builds and pushes waiting for a slot")
+
+
+@contextmanager
+def phase(operation, name):
+    """Records the time spent in the block, whether it succeeds or not"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.labels(operation, name).observe(time.time() - start)
+
+
+def count_bytes(kind, size):
+    if size:
+        BYTES.labels(kind).inc(size)
+
+
+def cache_lookup(cache, hit, count=1):
+    """Counts lookups of a cache e.g. build, layer, source, coalesce or push"""
+    if count:
+        CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc(count)
+
+
+def track_scheduler(scheduler):
+    """Reports the running and queued requests of the scheduler when scraped"""
+    ACTIVE_BUILDS.set_function(lambda: scheduler.running)
+    QUEUED_BUILDS.set_function(lambda: scheduler.queued)
+
+
+def start_metrics_server(port=None, addr=None):
+    """
+    Serves the metrics over http on M1L0_BUILDER_METRICS_PORT
+
+    The endpoint is disabled if no port is given. Returns True if it was
+    started.
+    """
+    if port is None:
+        port = env_int("M1L0_BUILDER_METRICS_PORT", 0)
+    if not port:
+        return False
+
+    addr = addr or os.environ.get("M1L0_BUILDER_METRICS_ADDR", "0.0.0.0")
+    start_http_server(port, addr=addr)
+    module_logger.info("Serving metrics on {}:{}".format(addr, port))
+    return True
@@ -0,0 +1,151 @@
+# Keeps the most used base images pulled on the docker host
+import logging
+import threading
+
+import sqlite3
+
+from docker.errors import DockerException
+
+from builder.clients.docker import docker_api_client
+from builder.core.catalog import ImageCatalog
+from builder.core.repo import service_login, split_image_tag
+from builder.settings import env_int
+
+module_logger = logging.getLogger('builder.prewarm')
+
+DEFAULT_BUDGET = 50 * 1024 * 1024 * 1024
+
+
+class BaseImagePrewarmer:
+    """
+    Pulls the most used base images in the background
+
+    Base image use is counted in the catalog for every build. At startup
+    and then every M1L0_BUILDER_PREWARM_INTERVAL seconds the
+    M1L0_BUILDER_PREWARM_COUNT most used base images are pulled, which also
+    refreshes tags that moved in the registry.
+
+    Once the base images on the host exceed M1L0_BUILDER_BASE_IMAGE_BUDGET
+    bytes the least used ones outside the warm set are removed. Images still
+    used by containers or child images are left for the daemon to keep.
+    """
+    def __init__(self, catalog=None, count=None, interval=None, max_bytes=None):
+        self.catalog = catalog or ImageCatalog()
+        self.count = count if count is not None else env_int("M1L0_BUILDER_PREWARM_COUNT", 5)
+        self.interval = interval or env_int("M1L0_BUILDER_PREWARM_INTERVAL", 3600)
+        self.max_bytes = max_bytes if max_bytes is not None else \
+            env_int("M1L0_BUILDER_BASE_IMAGE_BUDGET", DEFAULT_BUDGET)
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._warm = set()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.count > 0
+
+    def warm_images(self):
+        """Returns the base images currently kept warm"""
+        with self._lock:
+            return set(self._warm)
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="base-image-prewarmer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stops the background thread, a pull in progress is not waited for beyond timeout"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                module_logger.error("Base image prewarm failed: {}".format(e))
+            self._stop.wait(self.interval)
+
+    def _auth_config(self, image):
+        if "dkr.ecr" not in image:
+            return None
+        try:
+            return service_login("ecr")[2]
+        except Exception as e:
+            module_logger.warning("Unable to login to ECR to pull {}: {}".format(image, e))
+            return None
+
+    def pull(self, image):
+        """Pulls the image, returns its size or None if the pull failed"""
+        api_client = docker_api_client()
+        repository, tag = split_image_tag(image)
+
+        try:
+            api_client.pull(repository, tag=tag, auth_config=self._auth_config(image))
+            size = api_client.inspect_image(image).get("Size")
+        except DockerException as e:
+            module_logger.warning("Unable to prewarm base image {}: {}".format(image, e))
+            return None
+
+        self.catalog.record_base_image_pull(image, size)
+        return size
+
+    def run_once(self):
+        """Pulls the warm set then evicts under the budget, returns the bytes reclaimed"""
+        try:
+            warm = [x["image"] for x in self.catalog.base_images(limit=self.count)]
+        except sqlite3.Error as e:
+            module_logger.error("Unable to read base image usage: {}".format(e))
+            return 0
+
+        with self._lock:
+            self._warm = set(warm)
+
+        for image in warm:
+            if self._stop.is_set():
+                break
+            module_logger.info("Prewarming base image {}".format(image))
+            self.pull(image)
+
+        return self.evict()
+
+    def evict(self):
+        """Removes the least used base images outside the warm set until under budget"""
+        api_client = docker_api_client()
+        warm = self.warm_images()
+
+        present = []
+        for entry in self.catalog.base_images():
+            try:
+                size = api_client.inspect_image(entry["image"]).get("Size") or 0
+            except DockerException:
+                continue
+            present.append((entry["image"], size))
+
+        total = sum(size for _, size in present)
+        reclaimed = 0
+
+        # base_images is ordered most used first
+        for image, size in reversed(present):
+            if total <= self.max_bytes:
+                break
+            if image in warm:
+                continue
+
+            try:
+                api_client.remove_image(image)
+            except DockerException as e:
+                module_logger.info("Keeping base image {}: {}".format(image, e))
+                continue
+
+            module_logger.info("Evicted base image {} ({} bytes)".format(image, size))
+            self.catalog.record_base_image_pull(image, None)
+            total -= size
+            reclaimed += size
+
+        return reclaimed
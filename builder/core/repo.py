@@ -1,34 +1,69 @@
 # Functions for building docker images
+import base64
 import contextlib
 from io import BytesIO
+import json
 import logging
 import os
+import re
 import shutil
+import subprocess
 import tempfile
 import textwrap
 import tarfile
+import threading
 import time
 
+from botocore.exceptions import ClientError
 from docker.errors import APIError
+from docker.errors import DockerException
 from docker.errors import ImageNotFound
 from jinja2 import Environment, FileSystemLoader
 
-from builder.clients.docker import docker_api_client
-from builder.authentication.authenticate import authenticate_docker_client, authenticate_ecr
+from builder.clients.docker import docker_api_client, docker_endpoints, cli_host
+from builder.authentication.authenticate import login_docker_client, authenticate_ecr, is_auth_error, \
+    invalidate_registry_auth, session_client
 from builder.authentication.ssm import fetch_credentials
-from builder.core.cloudwatchlogs import setup_log_stream, send_to_cloudwatch
+from builder.core.buildcache import CONTENT_HASH_LABEL
+from builder.core.logsinks import open_log_sink
+from builder.core.metrics import cache_lookup, count_bytes, phase
+from builder.core.ignores import walk_context
+from builder.settings import env_bool, env_int
 
 
 module_logger = logging.getLogger('builder.repo')
 module_logger.setLevel("INFO")
 
+MANIFEST_V2_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+
+BUILDKIT_SYNTAX = "docker/dockerfile:1"
+
+CLASSIC_BACKEND = "classic"
+BUILDKIT_BACKEND = "buildkit"
+BUILD_BACKENDS = [CLASSIC_BACKEND, BUILDKIT_BACKEND]
+
+
+def build_backend(backend=None):
+    """Returns the backend a build runs with, from the request, else M1L0_BUILDER_BACKEND"""
+    backend = backend or os.environ.get("M1L0_BUILDER_BACKEND") or CLASSIC_BACKEND
+    if backend not in BUILD_BACKENDS:
+        raise ValueError("Build backend must be one of {}".format(", ".join(BUILD_BACKENDS)))
+    return backend
+
+
+# Directory the generated dockerfile copies the sources from inside the build
+# context, fixed so the dockerfile and its content hash do not vary per request
+CONTEXT_DIR = "code"
+
 
 @contextlib.contextmanager
 def tempdir(suffix="", prefix="tmp"):
     """Creates a temp dir to hold the model files"""
     tmp = tempfile.mkdtemp(suffix=suffix, prefix=prefix, dir=None)
-    yield tmp
-    shutil.rmtree(tmp)
+    try:
+        yield tmp
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
 
 
 def get_build_image(config):
@@ -54,13 +89,21 @@ def get_build_image(config):
 def create_dockerfile(config, tmpl_dir, code_dir,
                       dockerfile_path=None,
                       has_requirements=False,
+                      has_constraints=False,
                       save_file=False,
                       local=False,
-                      ecr_prefix=None):
+                      ecr_prefix=None,
+                      buildkit=False):
     """
     Creates a dockerfile from train job obj
 
     Receives a temp directory of the project to add the required files to build the dockerfile...
+
+    The dependency files are copied and installed before the code is copied
+    so the pip install layer stays cached when only code changes
+
+    With buildkit the pip install uses a cache mount so downloads are kept
+    across builds even when the layer is rebuilt
     """
     module_logger.info("Creating dockerfile...")
 
@@ -68,7 +111,14 @@ def create_dockerfile(config, tmpl_dir, code_dir,
     tags = config["tags"]
     framework_labels = config["framework_labels"]
 
-    requirements_copy_cmd = f"COPY {code_dir}/requirements.txt {project_dir}/requirements.txt"
+    dependency_files = ["requirements.txt"]
+    if has_constraints:
+        dependency_files.append("constraints.txt")
+
+    requirements_copy_cmd = "COPY {} {}/".format(
+        " ".join(os.path.join(code_dir, x) for x in dependency_files),
+        project_dir
+    )
     files_copy_cmd = "COPY {} {}".format(code_dir, project_dir)
 
     # Set up entrypoint
@@ -81,12 +131,24 @@ def create_dockerfile(config, tmpl_dir, code_dir,
     reqs_cmd = ''
     if has_requirements:
         req_path = os.path.join(project_dir, "requirements.txt")
-        reqs_cmd = textwrap.dedent(
+        pip_args = "--requirement {}".format(req_path)
+        if has_constraints:
+            pip_args += " --constraint {}".format(os.path.join(project_dir, "constraints.txt"))
+
+        if buildkit:
+            reqs_cmd = textwrap.dedent(
+                """
+            RUN --mount=type=cache,target=/root/.cache/pip python3 -m pip install --upgrade pip && \
+                python3 -m pip install {}
             """
-        RUN python3 -m pip install --upgrade pip && \
-            python3 -m pip install --no-cache-dir --requirement {}
-        """
-        ).format(req_path)
+            ).format(pip_args)
+        else:
+            reqs_cmd = textwrap.dedent(
+                """
+            RUN python3 -m pip install --upgrade pip && \
+                python3 -m pip install --no-cache-dir {}
+            """
+            ).format(pip_args)
 
     env = Environment(
         loader=FileSystemLoader(tmpl_dir)
@@ -105,7 +167,8 @@ def create_dockerfile(config, tmpl_dir, code_dir,
         entrypoint=entrypoint,
         tags=tags,
         framework_labels=framework_labels,
-        pyversion=config["pyversion"])
+        pyversion=config["pyversion"],
+        syntax=BUILDKIT_SYNTAX if buildkit else None)
 
     if save_file:
         dockerfile = os.path.join(dockerfile_path, "Dockerfile")
@@ -159,30 +222,114 @@ def process_build_log(log):
     return res
 
 
-def prepare_archive(dockerfile, tmp_code_path, encoding="utf-8", custom_dockerfile=False):
+class LayerCacheReport:
+    """
+    Tracks which build steps were served from the daemon layer cache
+
+    Fed with the processed build log lines of the classic builder e.g.
+
+    Step 4/7 : RUN python3 -m pip install ...
+     ---> Using cache
+
+    or the plain progress of BuildKit where steps of parallel stages interleave
+
+    #7 [builder 2/4] RUN python3 -m pip install ...
+    #7 CACHED
+    """
+    STEP_PREFIX = "Step "
+    CACHE_MARKER = "---> Using cache"
+    BUILDKIT_STEP = re.compile(r"^#(\d+) \[([^\]]*\d+/\d+)\] (.+)$")
+    BUILDKIT_CACHED = re.compile(r"^#(\d+) CACHED$")
+
+    def __init__(self):
+        self.steps = []
+        self._vertices = {}
+
+    def _add_step(self, instruction, stage=None):
+        # FROM steps select a base image and never produce a layer
+        if instruction.upper().startswith("FROM "):
+            return None
+        step = ["{} {}".format(stage, instruction) if stage else instruction, False]
+        self.steps.append(step)
+        return step
+
+    def observe(self, line):
+        for text in line.splitlines():
+            text = text.strip()
+            if text.startswith(self.STEP_PREFIX) and " : " in text:
+                self._add_step(text.split(" : ", 1)[1])
+            elif text == self.CACHE_MARKER and len(self.steps) > 0:
+                self.steps[-1][1] = True
+            elif text.startswith("#"):
+                self._observe_buildkit(text)
+
+    def _observe_buildkit(self, text):
+        match = self.BUILDKIT_STEP.match(text)
+        if match:
+            vertex, stage, instruction = match.groups()
+            if vertex not in self._vertices:
+                # Steps of named stages keep the stage so parallel stages can be told apart
+                name = stage.rsplit(" ", 1)[0] if " " in stage else None
+                self._vertices[vertex] = self._add_step(instruction, name)
+            return
+
+        match = self.BUILDKIT_CACHED.match(text)
+        if match and self._vertices.get(match.group(1)) is not None:
+            self._vertices[match.group(1)][1] = True
+
+    @property
+    def hits(self):
+        return len([x for x in self.steps if x[1]])
+
+    @property
+    def misses(self):
+        return len(self.steps) - self.hits
+
+    def summary(self):
+        """Returns the report as log lines"""
+        lines = ["Layer cache: {} cached, {} built".format(self.hits, self.misses)]
+        for instruction, cached in self.steps:
+            lines.append("  [{}] {}".format("cached" if cached else "built", instruction))
+        return lines
+
+
+def prepare_archive(dockerfile, tmp_code_path, encoding="utf-8", custom_dockerfile=False, matcher=None,
+                    code_dir=None):
     """
     Creates an archive of the build context
 
     Note that dockerfile is passed in here as a string
+
+    The archive is written to an unnamed temporary file rather than held in
+    memory so the build context can be streamed to the docker daemon in
+    chunks. Caller is responsible for closing the returned file object.
+
+    Entries excluded by matcher are skipped while walking the code path so
+    ignored directories are never read.
+
+    code_dir is the directory name the generated dockerfile copies from and
+    defaults to the last part of the code path
     """
-    tarstream = BytesIO()
-    archive = tarfile.TarFile(fileobj=tarstream, mode="w")
-    dockerfile_str = dockerfile.encode(encoding)
-    dockerfile_tar_info = tarfile.TarInfo("Dockerfile")
-    dockerfile_tar_info.size = len(dockerfile_str)
-    archive.addfile(dockerfile_tar_info, BytesIO(dockerfile_str))
-
-    code_dir = os.path.split(tmp_code_path)[-1]
-
-    for x in os.listdir(tmp_code_path):
-        p = os.path.join(tmp_code_path, x)
-        if custom_dockerfile:
-            archive.add(p, arcname=os.path.join(".", os.path.basename(p)))
-        else:
-            archive.add(p, arcname=os.path.join(code_dir, os.path.basename(p)))
+    tarstream = tempfile.TemporaryFile()
 
+    with tarfile.TarFile(fileobj=tarstream, mode="w") as archive:
+        dockerfile_str = dockerfile.encode(encoding)
+        dockerfile_tar_info = tarfile.TarInfo("Dockerfile")
+        dockerfile_tar_info.size = len(dockerfile_str)
+        archive.addfile(dockerfile_tar_info, BytesIO(dockerfile_str))
+
+        if code_dir is None:
+            code_dir = os.path.split(tmp_code_path)[-1]
+
+        for p, relpath, _ in walk_context(tmp_code_path, matcher):
+            if custom_dockerfile:
+                archive.add(p, arcname=os.path.join(".", relpath), recursive=False)
+            else:
+                archive.add(p, arcname=os.path.join(code_dir, relpath), recursive=False)
+
+    count_bytes("context", tarstream.tell())
     tarstream.seek(0)
-    return archive
+    return tarstream
 
 
 def create_archive(target_dir, tmp_code_path):
@@ -218,20 +365,160 @@ def service_login(service, tag=None):
         auth_config = fetch_credentials("dockerhub")
         registry = "https://index.docker.io/v1/"
         if len(auth_config) > 0:
-            status = authenticate_docker_client(api_client, registry, auth_config)
+            status = login_docker_client(api_client, registry, auth_config)
             return status, auth_config
     elif service == "ecr":
         auth_config = fetch_credentials("ecr")
         if len(auth_config) > 0:
             ecr_url, auth_config = authenticate_ecr(auth_config, tag)
-            status = authenticate_docker_client(api_client, ecr_url, auth_config)
+            status = login_docker_client(api_client, ecr_url, auth_config)
             return status, ecr_url, auth_config
 
 
-def build_docker_image(tar_archive, tag, labels, config, encoding="utf-8", custom_dockerfile=False):
+def _feed_context(build_context, stdin):
+    try:
+        shutil.copyfileobj(build_context, stdin)
+    except (BrokenPipeError, ValueError):
+        # The cli exited early, the error is reported from its output
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def buildkit_build(build_context, tag, labels=None, registries=None, cache_from=None):
+    """
+    Builds with BuildKit through the docker cli and yields its plain progress lines
+
+    The build context tar is streamed to the cli on stdin. registries maps
+    registry => auth config and is written to a temporary docker config so
+    BuildKit can pull private base images. Independent stages of the
+    Dockerfile are run in parallel by BuildKit.
+
+    Images in cache_from are used as remote cache sources. The built image
+    carries inline cache metadata so it can be a cache source once pushed.
+    """
+    with tempdir(prefix="docker_config") as docker_config:
+        auths = {}
+        for registry, auth_config in (registries or {}).items():
+            creds = "{}:{}".format(auth_config.get("username"), auth_config.get("password"))
+            auths[registry] = {"auth": base64.b64encode(creds.encode("utf-8")).decode("utf-8")}
+
+        # The config holds registry credentials so only the service user may read it
+        fd = os.open(os.path.join(docker_config, "config.json"), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"auths": auths}, f)
+
+        cmd = ["docker", "build", "--progress=plain", "--tag", tag, "--build-arg", "BUILDKIT_INLINE_CACHE=1"]
+        for k, v in sorted((labels or {}).items()):
+            cmd += ["--label", "{}={}".format(k, v)]
+        for image in cache_from or []:
+            cmd += ["--cache-from", image]
+        cmd.append("-")
+
+        env = dict(os.environ,
+                   DOCKER_BUILDKIT="1",
+                   DOCKER_HOST=cli_host(docker_endpoints()[0]),
+                   DOCKER_CONFIG=docker_config)
+
+        proc = subprocess.Popen(cmd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        feeder = threading.Thread(target=_feed_context, args=(build_context, proc.stdin), daemon=True)
+        feeder.start()
+
+        completed = False
+        try:
+            for raw in proc.stdout:
+                yield raw.decode("utf-8", "replace").rstrip("\n")
+            completed = True
+        finally:
+            if not completed:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+            feeder.join()
+
+    if proc.returncode != 0:
+        raise APIError("BuildKit build of {} failed with exit code {}".format(tag, proc.returncode))
+
+
+def recent_ecr_images(repository, registry, count):
+    """Returns the last count images pushed to the ECR repository, latest first"""
+    ecr_client = session_client("ecr", fetch_credentials("ecr"))
+
+    # Images are listed in no particular order so every page is read before sorting
+    details = []
+    paginator = ecr_client.get_paginator("describe_images")
+    for page in paginator.paginate(repositoryName=repository, filter={"tagStatus": "TAGGED"}):
+        details += [x for x in page.get("imageDetails", []) if x.get("imageTags") and x.get("imagePushedAt")]
+    details.sort(key=lambda x: x["imagePushedAt"], reverse=True)
+
+    host = registry.replace("https://", "")
+    return ["{}/{}:{}".format(host, repository, x["imageTags"][0]) for x in details[:count]]
+
+
+def image_registry(image):
+    """Returns the registry host of an image, None for images without one e.g. m1l0/myproject:v1"""
+    host, sep, _ = image.partition("/")
+    if sep and ("." in host or ":" in host or host == "localhost"):
+        return host
+    return None
+
+
+def registry_host(registry):
+    """Returns the host of a registry url e.g. https://123.dkr.ecr.us-east-1.amazonaws.com"""
+    return registry.split("://", 1)[-1].split("/", 1)[0]
+
+
+def pull_cache_sources(api_client, images, auth_config, registry=None):
+    """
+    Pulls the cache source images which are not present locally
+
+    The classic builder only uses local images as cache sources. Only images
+    in the registry the build pushes to are pulled, other images e.g. local
+    tags would otherwise resolve to unrelated images on Docker Hub. Returns
+    the images which are available, images which cannot be pulled are skipped.
+    """
+    host = registry_host(registry) if registry else None
+
+    available = []
+    for image in images:
+        try:
+            api_client.inspect_image(image)
+            available.append(image)
+            continue
+        except DockerException:
+            pass
+
+        if host is None or image_registry(image) != host:
+            module_logger.info("Cache source {} not present locally".format(image))
+            continue
+
+        repository, revision = split_image_tag(image)
+        try:
+            api_client.pull(repository, tag=revision, auth_config=auth_config)
+            available.append(image)
+        except DockerException as e:
+            module_logger.info("Cache source {} unavailable: {}".format(image, e))
+
+    return available
+
+
+def build_docker_image(build_context, tag, labels, config, encoding="utf-8", custom_dockerfile=False,
+                       backend=CLASSIC_BACKEND, cache_from=None):
     """
     Builds docker image with given build context in tar archive
 
+    The build context is a file object returned by prepare_archive which is
+    streamed to the daemon as the request body and closed once the build ends
+
+    cache_from lists earlier images of the project used as layer cache
+    sources, for ecr the last M1L0_BUILDER_CACHE_FROM_COUNT images pushed
+    to the repository are added. Hosts with a cold daemon cache can then
+    reuse layers built elsewhere.
+
     Note: we may need to authenticate with both ecr and dockerhub as private
     images may be used inside FROM of dockerfile if user specifies baseimage
     """
@@ -250,10 +537,12 @@ def build_docker_image(tar_archive, tag, labels, config, encoding="utf-8", custo
     # else:
     #     _, auth_config = service_login("dockerhub")
 
-    if config.get("service") == "ecr":
-        _, _, auth_config = service_login("ecr", tag)
-    else:
-        _, auth_config = service_login("dockerhub")
+    with phase("build", "login"):
+        if "ecr" in split_list(config.get("service", "")):
+            _, registry, auth_config = service_login("ecr", tag)
+        else:
+            _, auth_config = service_login("dockerhub")
+            registry = "https://index.docker.io/v1/"
 
     """
     Note: Setting pull: True here will cause the docker
@@ -263,7 +552,7 @@ def build_docker_image(tar_archive, tag, labels, config, encoding="utf-8", custo
     """
 
     args = {
-        'fileobj': tar_archive.fileobj.getvalue(),
+        'fileobj': build_context,
         'custom_context': True,
         'encoding': encoding,
         'tag': tag,
@@ -274,26 +563,56 @@ def build_docker_image(tar_archive, tag, labels, config, encoding="utf-8", custo
         'pull': False
     }
 
-    try:
-        logs = api_client.build(**args)
-        setup_log_stream(config["id"])
+    if config.get("content_hash"):
+        args['labels'] = {CONTENT_HASH_LABEL: config["content_hash"]}
 
-        logs_cache = []
-        for log in logs:
-            res = process_build_log(log)
-            logs_cache.append(res)
+    cache_from = list(cache_from or [])
+    count = env_int("M1L0_BUILDER_CACHE_FROM_COUNT", 3)
+    if count > 0 and "ecr" in split_list(config.get("service", "")):
+        try:
+            cache_from += recent_ecr_images(config["repository"], registry, count)
+        except ClientError as e:
+            module_logger.info("Unable to list ECR images for cache sources: {}".format(e))
+    cache_from = [x for i, x in enumerate(cache_from) if x not in cache_from[:i]]
 
-            if len(logs_cache) == 10:
-                send_to_cloudwatch(config["id"], logs_cache)
-                logs_cache.clear()
+    log_sink = None
+    try:
+        log_sink = open_log_sink(config["id"])
 
-            if 'Error' in res:
+        if backend == BUILDKIT_BACKEND:
+            # BuildKit failures are reported by the exit code of the cli
+            logs = buildkit_build(build_context, tag, labels=args.get('labels'),
+                                  registries={registry: auth_config}, cache_from=cache_from)
+        else:
+            with phase("build", "pull_cache"):
+                cache_from = pull_cache_sources(api_client, cache_from, auth_config, registry)
+            if cache_from:
+                args['cache_from'] = cache_from
+            logs = (process_build_log(log) for log in api_client.build(**args))
+
+        if cache_from:
+            res = "Layer cache sources: {}".format(", ".join(cache_from))
+            log_sink.put(res)
+            yield res
+
+        layer_report = LayerCacheReport()
+        for res in logs:
+            layer_report.observe(res)
+            log_sink.put(res)
+
+            if backend != BUILDKIT_BACKEND and 'Error' in res:
                 raise APIError(res)
             else:
                 yield res
 
-        logs_cache.append(f"Image Name: {tag}")
-        send_to_cloudwatch(config["id"], logs_cache)
+        cache_lookup("layer", True, layer_report.hits)
+        cache_lookup("layer", False, layer_report.misses)
+
+        for line in layer_report.summary():
+            log_sink.put(line)
+            yield line
+
+        log_sink.put(f"Image Name: {tag}")
 
         module_logger.info("Completed building project with tag {}".format(tag))
 
@@ -305,7 +624,13 @@ def build_docker_image(tar_archive, tag, labels, config, encoding="utf-8", custo
         raise e
     except APIError as e:
         module_logger.error("Docker API returns an error: {}".format(e))
+        if is_auth_error(e):
+            invalidate_registry_auth()
         raise e
+    finally:
+        if log_sink is not None:
+            log_sink.close()
+        build_context.close()
 
 
 def push_docker_image(service, repository, revision, job_id):
@@ -322,20 +647,23 @@ def push_docker_image(service, repository, revision, job_id):
     revision => Repository tag e.g. "latest"
     """
     api_client = docker_api_client()
+    log_sink = None
 
     try:
         if not repository:
             raise RuntimeError("Repository must be specified")
 
         if service == "dockerhub":
-            status, auth_config = service_login("dockerhub")
+            with phase("push", "login"):
+                status, auth_config = service_login("dockerhub")
             if status != "Login Succeeded":
                 raise RuntimeError("Unable to login to Dockerhub service. Push failed.")
 
             repo_name = repository
         elif service == "ecr":
             # NOTE: ECR requires reauth hence logging in again...
-            status, ecr_url, auth_config = service_login("ecr")
+            with phase("push", "login"):
+                status, ecr_url, auth_config = service_login("ecr")
             if status != "Login Succeeded":
                 raise RuntimeError("Unable to login to ECR service. Push failed.")
 
@@ -344,37 +672,55 @@ def push_docker_image(service, repository, revision, job_id):
             module_logger.info("Tagging repo {} with {} ...".format(repo_name, revision))
 
             image = "{}:{}".format(repository, revision)
-            api_client.tag(image, repo_name, revision)
+            with phase("push", "tag"):
+                api_client.tag(image, repo_name, revision)
+
+        full_repo_name = "{}:{}".format(repo_name, revision)
 
-        module_logger.info("Pushing to remote repo: {}:{} ...".format(repo_name, revision))
+        digest = None
+        if env_bool("M1L0_BUILDER_SKIP_UNCHANGED_PUSH", True):
+            with phase("push", "check"):
+                digest = remote_image_digest(service, repo_name, repository, revision, auth_config)
+            cache_lookup("push", bool(digest))
 
-        logs = api_client.push(repo_name, auth_config=auth_config, tag=revision, stream=True, decode=True)
+        log_sink = open_log_sink(job_id)
 
-        setup_log_stream(job_id)
+        if digest:
+            res = "Image {} is already in the registry with digest {}, skipping push".format(full_repo_name, digest)
+            module_logger.info(res)
+            log_sink.put(res)
+            yield res
+        else:
+            module_logger.info("Pushing to remote repo: {}:{} ...".format(repo_name, revision))
 
-        logs_cache = []
-        for log in logs:
-            res = process_build_log(log)
-            logs_cache.append(res)
+            # Layer id => bytes pushed, layers already in the registry report no progress
+            pushed = {}
+            try:
+                with phase("push", "upload"):
+                    logs = api_client.push(repo_name, auth_config=auth_config, tag=revision, stream=True, decode=True)
 
-            if len(logs_cache) == 10:
-                send_to_cloudwatch(job_id, logs_cache)
-                logs_cache.clear()
+                    for log in logs:
+                        if 'aux' in log and log['aux'].get('Digest'):
+                            digest = log['aux']['Digest']
+                        if log.get('status') == 'Pushing' and log.get('progressDetail', {}).get('total'):
+                            pushed[log.get('id')] = log['progressDetail']['total']
 
-            if 'Error' in res:
-                raise APIError(res)
-            else:
-                yield res
+                        res = process_build_log(log)
+                        log_sink.put(res)
 
-        full_repo_name = "{}:{}".format(repo_name, revision)
+                        if 'Error' in res:
+                            raise APIError(res)
+                        else:
+                            yield res
+            finally:
+                count_bytes("pushed", sum(pushed.values()))
 
-        logs_cache.append(f"Repository Name: {full_repo_name}")
-        send_to_cloudwatch(job_id, logs_cache)
+        log_sink.put(f"Repository Name: {full_repo_name}")
 
         module_logger.info("Completed push to repository {}".format(full_repo_name))
 
-        # Update DB record
-        # TODO: Update artifacts in MLMD
+        if digest:
+            yield "digest: {}".format(digest)
 
         yield "repository: {}".format(full_repo_name)
     except ImageNotFound as e:
@@ -382,10 +728,123 @@ def push_docker_image(service, repository, revision, job_id):
         raise e
     except APIError as e:
         module_logger.error("Docker API returns an error: {}".format(e))
+        if is_auth_error(e):
+            invalidate_registry_auth()
         raise e
     except RuntimeError as e:
         module_logger.error("Error with pushing image: {}".format(e))
         raise e
+    finally:
+        if log_sink is not None:
+            log_sink.close()
+
+
+def split_list(value):
+    """Splits a comma separated config value e.g. the services or revisions of a push"""
+    items = [x.strip() for x in value.split(",") if len(x.strip()) > 0]
+    return items or [value]
+
+
+def tag_image(image, tag):
+    """Tags a local image with tag e.g. 'myproject:1.0'"""
+    repository, revision = split_image_tag(tag)
+    docker_api_client().tag(image, repository, revision)
+
+
+def split_image_tag(image):
+    """
+    Splits 'repository:tag' into its parts, defaulting tag to latest
+
+    Handles registry hosts with ports e.g. 'localhost:5000/myproject'
+    """
+    repository, sep, tag = image.rpartition(":")
+    if not sep or "/" in tag:
+        return image, "latest"
+    return repository, tag
+
+
+def reuse_cached_image(image, tag, content_hash):
+    """
+    Tags a previously built image with the new tag if it is still present
+    and carries the same content hash label
+
+    Returns True if the image can be reused
+    """
+    api_client = docker_api_client()
+
+    try:
+        details = api_client.inspect_image(image)
+    except (ImageNotFound, APIError) as e:
+        module_logger.info("Cached image {} not available: {}".format(image, e))
+        return False
+
+    labels = details.get("Config", {}).get("Labels") or {}
+    if labels.get(CONTENT_HASH_LABEL) != content_hash:
+        return False
+
+    if image != tag:
+        repository, revision = split_image_tag(tag)
+        api_client.tag(image, repository, revision)
+
+    return True
+
+
+def remote_image_digest(service, repo_name, repository, revision, auth_config):
+    """
+    Returns the manifest digest of the tag in the registry if it already
+    points at the local image, else None
+
+    For ecr the config digest of the remote manifest is compared with the
+    local image id. For dockerhub the manifest digest from the registry is
+    looked up in the local image's repo digests. Any failure returns None
+    so the image is pushed.
+    """
+    local = image_details("{}:{}".format(repo_name, revision))
+    if local is None:
+        return None
+
+    try:
+        if service == "ecr":
+            ecr_client = session_client("ecr", fetch_credentials("ecr"))
+            resp = ecr_client.batch_get_image(
+                repositoryName=repository,
+                imageIds=[{"imageTag": revision}],
+                acceptedMediaTypes=[MANIFEST_V2_MEDIA_TYPE]
+            )
+            for remote in resp.get("images", []):
+                manifest = json.loads(remote["imageManifest"])
+                if manifest.get("config", {}).get("digest") == local["Id"]:
+                    return remote["imageId"]["imageDigest"]
+        else:
+            descriptor = docker_api_client().inspect_distribution(
+                "{}:{}".format(repo_name, revision),
+                auth_config=auth_config
+            )
+            digest = descriptor["Descriptor"]["digest"]
+            if any(x.endswith("@{}".format(digest)) for x in local["RepoDigests"]):
+                return digest
+    except (ClientError, DockerException, KeyError, ValueError) as e:
+        module_logger.info("Unable to compare {}:{} with registry: {}".format(repo_name, revision, e))
+
+    return None
+
+
+def image_details(image):
+    """
+    Returns the Id, Size and RepoDigests of a local image or None if it
+    cannot be inspected
+    """
+    try:
+        details = docker_api_client().inspect_image(image)
+    except DockerException as e:
+        module_logger.warning("Unable to inspect image {}: {}".format(image, e))
+        return None
+
+    return {
+        "Id": details.get("Id"),
+        "Size": details.get("Size"),
+        "RepoDigests": details.get("RepoDigests") or []
+    }
 
 
 def remove_image(repository):
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import os
 import shutil
@@ -6,13 +7,161 @@ import tempfile
 import traceback
 from urllib.parse import urlparse
 
-from github import Github
-
 from builder.authentication.authenticate import session_client
 from builder.authentication.ssm import fetch_credentials
+from builder.core.diskcache import DirectoryCache
+from builder.core.gitcache import GitMirrorCache
+from builder.core.ignores import IgnoreMatcher, walk_context
+from builder.core.metrics import cache_lookup
+from builder.core.s3stream import S3ObjectReader
+from builder.settings import env_int
 
 module_logger = logging.getLogger('builder.retriever')
 
+# How dir:// sources are turned into a build context
+# copy   => move the source aside and copy it back without ignores (default)
+# link   => hardlink snapshot of the source into the workspace
+# direct => build the context straight from the source path
+DIR_MODES = ["copy", "link", "direct"]
+
+
+def workspace_root():
+    """Returns the directory holding the per build source trees"""
+    return os.path.join(tempfile.gettempdir(), "code")
+
+
+def link_tree(src, dst, matcher=None):
+    """
+    Creates a snapshot of src at dst using hardlinks
+
+    Only metadata is written so the cost is a single walk of the source.
+    Falls back to copying files when src and dst are on different
+    filesystems or hardlinks are not permitted.
+    """
+    os.makedirs(dst)
+    can_link = True
+
+    for path, relpath, is_dir in walk_context(src, matcher):
+        target = os.path.join(dst, relpath)
+
+        if is_dir:
+            os.mkdir(target)
+            shutil.copystat(path, target)
+        elif os.path.islink(path):
+            os.symlink(os.readlink(path), target)
+        else:
+            if can_link:
+                try:
+                    os.link(path, target)
+                    continue
+                except OSError as e:
+                    module_logger.info("Hardlinks unavailable, copying {} instead: {}".format(src, e))
+                    can_link = False
+            shutil.copy2(path, target)
+
+    return dst
+
+
+def _is_within(path, parent):
+    return os.path.commonpath([parent, path]) == parent
+
+
+def extract_stream(fileobj, dest, matcher=None, mode="r|*"):
+    """
+    Extracts a tar stream into dest in a single pass
+
+    Members excluded by matcher are skipped rather than extracted and
+    removed later. Members which would be written outside of dest through
+    absolute paths, '..' or links are skipped.
+    """
+    dest = os.path.abspath(dest)
+    os.makedirs(dest, exist_ok=True)
+
+    with tarfile.open(fileobj=fileobj, mode=mode) as t:
+        for member in t:
+            relpath = os.path.normpath(member.name).replace(os.sep, "/")
+            if relpath == ".":
+                continue
+
+            target = os.path.abspath(os.path.join(dest, relpath))
+            if os.path.isabs(relpath) or not _is_within(target, dest):
+                module_logger.warning("Skipping archive member outside of build dir: {}".format(member.name))
+                continue
+
+            if member.issym() or member.islnk():
+                if member.issym():
+                    link_target = os.path.join(os.path.dirname(target), member.linkname)
+                else:
+                    link_target = os.path.join(dest, member.linkname)
+
+                if os.path.isabs(member.linkname) or not _is_within(os.path.abspath(link_target), dest):
+                    module_logger.warning("Skipping link outside of build dir: {}".format(member.name))
+                    continue
+
+            if matcher and matcher.matches(relpath):
+                continue
+
+            # Hard links to skipped members cannot be resolved in a stream
+            if member.islnk() and matcher and matcher.matches(os.path.normpath(member.linkname)):
+                continue
+
+            member.name = relpath
+            t.extract(member, dest)
+
+    return dest
+
+
+class S3SourceCache:
+    """
+    Extracted s3 source bundles keyed by bucket, key and ETag
+
+    Each bundle is extracted once without ignores and later builds of the
+    same object version get a hardlink snapshot of it with their own
+    ignores applied. A HeadObject call validates the ETag on every build.
+    """
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = env_int("M1L0_BUILDER_S3_CACHE_SIZE", 10 * 1024 * 1024 * 1024)
+        self.cache = DirectoryCache("s3", max_bytes)
+
+    @property
+    def enabled(self):
+        return self.cache.max_bytes > 0
+
+    def fetch(self, s3_client, bucket, key, dest, ignores=None):
+        """
+        Populates dest with the contents of the bundle
+
+        Returns True if the bundle was served from the cache
+        """
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        cache_key = hashlib.sha1("{}/{}/{}".format(bucket, key, head["ETag"]).encode("utf-8")).hexdigest()
+        entry = self.cache.path(cache_key)
+
+        with self.cache.lock(cache_key):
+            hit = self.cache.exists(cache_key)
+
+            if hit:
+                module_logger.info("Using cached s3://{}/{} ({})".format(bucket, key, head["ETag"]))
+            else:
+                tmp_entry = entry + "_tmp"
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                shutil.rmtree(entry, ignore_errors=True)
+
+                with S3ObjectReader(s3_client, bucket, key, head=head) as reader:
+                    extract_stream(reader, tmp_entry)
+                    module_logger.info("Fetched {} bytes from s3://{}/{}".format(reader.bytes_read, bucket, key))
+
+                os.rename(tmp_entry, entry)
+
+            link_tree(entry, dest, IgnoreMatcher.for_context(entry, ignores))
+            self.cache.touch(cache_key)
+
+        cache_lookup("source", hit)
+
+        self.cache.evict(keep=[cache_key])
+        return hit
+
 
 class GetSourceFiles:
     """
@@ -29,7 +178,7 @@ class GetSourceFiles:
             for ig in self.request.ignores:
                 ignores.append(ig.value)
 
-        tmp_path = os.path.join(tempfile.gettempdir(), "code")
+        tmp_path = workspace_root()
 
         # normally this is a uuid
         code_path = self.request.id
@@ -41,13 +190,26 @@ class GetSourceFiles:
 
             # Assume that the dir refers to an existing path inside the mounted volume of this container
 
-            try:
-                # Copy from parsed_url.path to temp dir to remove ignores
-                shutil.move(parsed_url.path, code_copy_path + "_tmp")
-                # Copy from temp back to code_copy_path
-                shutil.copytree(code_copy_path + "_tmp", code_copy_path, ignore=shutil.ignore_patterns(*ignores))
+            dir_mode = os.environ.get("M1L0_BUILDER_DIR_MODE", "copy")
+            if dir_mode not in DIR_MODES:
+                raise Exception("M1L0_BUILDER_DIR_MODE must be one of {}".format("/".join(DIR_MODES)))
 
-                shutil.rmtree(code_copy_path + "_tmp")
+            try:
+                if dir_mode == "direct":
+                    # Ignores are applied when the context archive is created
+                    return parsed_url.path
+                elif dir_mode == "link":
+                    matcher = IgnoreMatcher.for_context(parsed_url.path, ignores)
+                    link_tree(parsed_url.path, code_copy_path, matcher)
+                else:
+                    # Copy from parsed_url.path to temp dir to remove ignores
+                    shutil.move(parsed_url.path, code_copy_path + "_tmp")
+                    # Copy from temp back to code_copy_path
+                    matcher = IgnoreMatcher.for_context(code_copy_path + "_tmp", ignores)
+                    shutil.copytree(code_copy_path + "_tmp", code_copy_path,
+                                    ignore=matcher.copytree_ignore(code_copy_path + "_tmp"))
+
+                    shutil.rmtree(code_copy_path + "_tmp")
             except Exception as e:
                 error_msg = "Dir copy error: \n{}\n{}".format(traceback.format_exc(), str(e))
                 module_logger.error(error_msg)
@@ -57,28 +219,31 @@ class GetSourceFiles:
             auth_config = fetch_credentials("ecr")
             s3_client = session_client("s3", auth_config)
 
-            # Downloads from s3 bucket into local tmp folder..
             bucket = parsed_url.netloc
             s3_target = parsed_url.path.lstrip("/")
-            local_target = f"{code_copy_path}.tar.gz"
-            s3_client.download_file(bucket, s3_target, local_target)
-
-            with tarfile.open(local_target) as t:
-                t.extractall(code_copy_path + "_tmp")
-            shutil.copytree(code_copy_path + "_tmp", code_copy_path, ignore=shutil.ignore_patterns(*ignores))
-
-            shutil.rmtree(code_copy_path + "_tmp")
-            os.remove(local_target)
+            source_cache = S3SourceCache()
+
+            if source_cache.enabled:
+                source_cache.fetch(s3_client, bucket, s3_target, code_copy_path, ignores)
+            else:
+                # Streams the archive from the s3 bucket straight into the code path
+                # The .dockerignore inside the archive is applied when the context is created
+                matcher = IgnoreMatcher(request_patterns=ignores)
+
+                with S3ObjectReader(s3_client, bucket, s3_target) as reader:
+                    extract_stream(reader, code_copy_path, matcher)
+                    module_logger.info("Fetched {} bytes from s3://{}/{}".format(reader.bytes_read, bucket,
+                                                                               s3_target))
         elif ".git" in parsed_url.path:
             # Get token
             auth_config = fetch_credentials("github")
-            # Login to github first using token
-            github_client = Github(auth_config["token"])
-            repo = github_client.get_repo(parsed_url.path.lstrip("/").split(".git")[0])
-            cmd = "git clone {} {}".format(repo.clone_url, code_copy_path + "_tmp")
-            os.system(cmd)
-            shutil.copytree(code_copy_path + "_tmp", code_copy_path, ignore=shutil.ignore_patterns(*ignores))
-
-            shutil.rmtree(code_copy_path + "_tmp")
+            matcher = IgnoreMatcher(request_patterns=ignores)
+
+            GitMirrorCache().export(
+                self.request.config.source,
+                code_copy_path,
+                lambda stream, dest: extract_stream(stream, dest, matcher, mode="r|"),
+                token=auth_config.get("token")
+            )
 
         return code_copy_path
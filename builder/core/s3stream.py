@@ -0,0 +1,92 @@
+# Streams S3 objects using parallel ranged downloads
+from collections import deque
+from concurrent import futures
+import io
+import logging
+
+from builder.settings import env_int
+
+module_logger = logging.getLogger('builder.s3stream')
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY = 8
+
+
+class S3ObjectReader(io.RawIOBase):
+    """
+    Read only file object over an S3 object
+
+    Parts of the object are fetched with ranged GetObject calls on a thread
+    pool and handed out in order. At most `concurrency` parts are in flight
+    or buffered at any time so memory use is bounded by
+    part_size * concurrency regardless of the object size.
+
+    Parts are requested with IfMatch on the ETag so an object replaced
+    mid-download fails instead of mixing two versions.
+    """
+    def __init__(self, s3_client, bucket, key, part_size=None, concurrency=None, head=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size or env_int("M1L0_BUILDER_S3_PART_SIZE", DEFAULT_PART_SIZE)
+        self.concurrency = concurrency or env_int("M1L0_BUILDER_S3_CONCURRENCY", DEFAULT_CONCURRENCY)
+
+        if head is None:
+            head = s3_client.head_object(Bucket=bucket, Key=key)
+        self.size = head["ContentLength"]
+        self.etag = head.get("ETag")
+        self.bytes_read = 0
+
+        self._next_offset = 0
+        self._buffer = memoryview(b"")
+        self._pending = deque()
+        self._executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+
+        for _ in range(self.concurrency):
+            self._schedule()
+
+    def _fetch(self, start, end):
+        args = {
+            "Bucket": self.bucket,
+            "Key": self.key,
+            "Range": "bytes={}-{}".format(start, end)
+        }
+        if self.etag:
+            args["IfMatch"] = self.etag
+
+        resp = self.s3_client.get_object(**args)
+        return resp["Body"].read()
+
+    def _schedule(self):
+        if self._next_offset >= self.size:
+            return
+
+        start = self._next_offset
+        end = min(start + self.part_size, self.size) - 1
+        self._pending.append(self._executor.submit(self._fetch, start, end))
+        self._next_offset = end + 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self._buffer) == 0:
+            if len(self._pending) == 0:
+                return 0
+
+            self._buffer = memoryview(self._pending.popleft().result())
+            self._schedule()
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        self.bytes_read += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._executor.shutdown(wait=True)
+        super().close()
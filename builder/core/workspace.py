@@ -0,0 +1,229 @@
+# Per build source dirs under the workspace root with a byte quota
+from contextlib import contextmanager
+import logging
+import os
+import queue
+import shutil
+import threading
+
+from builder.core.diskcache import dir_size
+from builder.core.metrics import phase
+from builder.core.retriever import workspace_root
+from builder.settings import env_int
+
+module_logger = logging.getLogger('builder.workspace')
+
+DEFAULT_QUOTA = 20 * 1024 * 1024 * 1024
+
+# Seconds a build over the quota waits for pending removals to free space
+REMOVAL_TIMEOUT = 30
+
+
+class WorkspaceQuotaExceeded(Exception):
+    pass
+
+
+class WorkspaceInUse(Exception):
+    pass
+
+
+class Janitor:
+    """
+    Runs cleanup work on a background thread
+
+    Removing source trees and images happens after the response stream has
+    closed so clients are not kept waiting. Work submitted while the
+    janitor is not running is done on the calling thread.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name="workspace-janitor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        """Finishes the queued work and stops the thread"""
+        if not self.running:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, fn, *args):
+        if self.running:
+            self._queue.put((fn, args))
+        else:
+            self._call(fn, args)
+
+    def join(self):
+        """Blocks until all submitted work is done"""
+        if self.running:
+            self._queue.join()
+
+    def _call(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            module_logger.warning("Cleanup {} failed: {}".format(getattr(fn, "__name__", fn), e))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._call(*item)
+            finally:
+                self._queue.task_done()
+
+
+class Workspace:
+    """
+    Source dirs of builds under the workspace root
+
+    Each build claims <workspace root>/<id> for its lifetime and the dir is
+    removed by the janitor once the build ends, whether it succeeded,
+    failed or the client went away. A build is refused while the dirs in
+    the workspace use more than M1L0_BUILDER_WORKSPACE_QUOTA bytes.
+
+    Dirs left by a previous process are reclaimed by sweep.
+    """
+    def __init__(self, quota=None, janitor=None):
+        if quota is None:
+            quota = env_int("M1L0_BUILDER_WORKSPACE_QUOTA", DEFAULT_QUOTA)
+        self.quota = quota
+        self.janitor = janitor or Janitor()
+
+        # Build dir name => bytes used, for dirs claimed or waiting removal
+        self._sizes = {}
+        self._active = set()
+        # Build dir names submitted to the janitor and not yet removed
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._removed = threading.Condition(self._lock)
+
+    @property
+    def root(self):
+        return workspace_root()
+
+    def path(self, build_id):
+        return os.path.join(self.root, build_id)
+
+    def usage(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def start(self):
+        self.janitor.start()
+
+    def stop(self, timeout=30):
+        self.janitor.stop(timeout)
+
+    def _check_quota(self, build_id, timeout=REMOVAL_TIMEOUT):
+        # Dirs waiting removal by the janitor may free enough space, other
+        # janitor work is not waited for
+        with self._removed:
+            self._removed.wait_for(
+                lambda: not self._pending or sum(self._sizes.values()) <= self.quota, timeout
+            )
+            usage = sum(self._sizes.values())
+
+        if usage > self.quota:
+            msg = "Workspace quota exceeded, {} of {} bytes used, unable to build {}".format(
+                usage, self.quota, build_id
+            )
+            module_logger.warning(msg)
+            raise WorkspaceQuotaExceeded(msg)
+
+    @contextmanager
+    def claim(self, build_id):
+        """Reserves the build dir, removing it on exit"""
+        self._check_quota(build_id)
+
+        with self._lock:
+            if build_id in self._active:
+                raise WorkspaceInUse("Build dir {} is already in use".format(build_id))
+            self._active.add(build_id)
+            self._sizes[build_id] = 0
+
+        try:
+            yield self.path(build_id)
+        finally:
+            with self._lock:
+                self._active.discard(build_id)
+                self._pending.add(build_id)
+            self.janitor.submit(self.remove, build_id)
+
+    def measure(self, build_id):
+        """Records the size of the fetched sources, failing if the quota is now exceeded"""
+        size = dir_size(self.path(build_id))
+        with self._lock:
+            self._sizes[build_id] = size
+            usage = sum(self._sizes.values())
+
+        if usage > self.quota:
+            raise WorkspaceQuotaExceeded("Workspace quota exceeded, sources of {} need {} bytes, {} of {} bytes used".format(
+                build_id, size, usage, self.quota
+            ))
+        return size
+
+    def remove(self, build_id):
+        try:
+            with self._lock:
+                # Claimed again before the janitor got to it
+                if build_id in self._active:
+                    return
+
+            path = self.path(build_id)
+            if os.path.exists(path):
+                with phase("build", "cleanup"):
+                    shutil.rmtree(path, ignore_errors=True)
+                module_logger.info("Removed build dir {}".format(path))
+
+            with self._lock:
+                if build_id not in self._active:
+                    self._sizes.pop(build_id, None)
+        finally:
+            with self._removed:
+                self._pending.discard(build_id)
+                self._removed.notify_all()
+
+    def sweep(self):
+        """
+        Removes dirs not claimed by a build
+
+        Dirs ending in _tmp hold dir sources moved aside while they are
+        copied and are kept so the sources are never lost. Returns the
+        number of bytes reclaimed.
+        """
+        if not os.path.isdir(self.root):
+            return 0
+
+        with self._lock:
+            active = set(self._active)
+
+        reclaimed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name in active or not os.path.isdir(path):
+                continue
+            if name.endswith("_tmp"):
+                module_logger.warning("Leaving moved dir source {} in place".format(path))
+                continue
+
+            size = dir_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+            with self._lock:
+                self._sizes.pop(name, None)
+            module_logger.info("Reclaimed orphaned build dir {} ({} bytes)".format(path, size))
+            reclaimed += size
+
+        return reclaimed
@@ -6,6 +6,7 @@ import sys
 from signal import signal, SIGTERM, SIGINT
 
 import grpc
+from grpc_interceptor.exceptions import AlreadyExists, GrpcException, ResourceExhausted
 from grpc_health.v1 import health
 from grpc_health.v1 import health_pb2
 from grpc_health.v1 import health_pb2_grpc
@@ -14,8 +15,17 @@ from m1l0_services.imagebuilder.v1 import imagebuilder_service_pb2_grpc
 from m1l0_services.imagebuilder.v1 import imagebuilder_service_pb2
 from m1l0_services.imagebuilder.v1.imagebuilder_service_pb2 import BuildResponse, FindResponse, PushResponse
 
+from builder.core.catalog import ImageCatalog
+from builder.core.coalescer import BuildCoalescer, build_request_key
 from builder.core.retriever import GetSourceFiles
+from builder.core.gc import ImageGarbageCollector
 from builder.core.imagebuilder import ImageBuilder
+from builder.core.metrics import count_bytes, phase, start_metrics_server, track_scheduler
+from builder.core.prewarm import BaseImagePrewarmer
+from builder.core.repo import build_backend
+from builder.core.workspace import Workspace, WorkspaceInUse, WorkspaceQuotaExceeded
+from builder.service.scheduler import BuildScheduler, request_metadata
+from builder.settings import env_int
 from builder.validator.service_request_validator import ServiceRequestValidator
 
 
@@ -27,45 +37,110 @@ console_handler.setFormatter(formatter)
 module_logger.addHandler(console_handler)
 
 
+# Request metadata selecting the build backend e.g. buildkit
+BUILDER_METADATA_KEY = "x-m1l0-builder"
+
+
 class ImageBuilderService(imagebuilder_service_pb2_grpc.ImageBuilderServiceServicer):
+    def __init__(self, scheduler=None, coalescer=None, catalog=None, workspace=None):
+        self.scheduler = scheduler or BuildScheduler()
+        self.coalescer = coalescer or BuildCoalescer(follow_slot=self.scheduler.follow)
+        self.catalog = catalog or ImageCatalog()
+        self.workspace = workspace or Workspace()
+
     def Build(self, request, context):
         module_logger.info("Received build request...")
 
         # Validate request
         ServiceRequestValidator.validate(request)
-
-        code_copy_path = GetSourceFiles(request).call()
-        builder = ImageBuilder(request, code_copy_path)
-
-        for log in builder.build():
-            yield BuildResponse(body=log)
-
-        builder.cleanup_code_path()
+        backend = request_metadata(context, BUILDER_METADATA_KEY)
+        ServiceRequestValidator.validate_backend(backend)
+
+        def build(build_context):
+            # build_context stands for every request sharing the build
+            with self.scheduler.slot(request.config.namespace, build_context):
+                try:
+                    # The build dir is removed by the janitor even if the build fails or the client goes away
+                    with self.workspace.claim(request.id), phase("build", "total"):
+                        with phase("build", "fetch"):
+                            code_copy_path = GetSourceFiles(request).call()
+                        builder = ImageBuilder(request, code_copy_path, backend=backend)
+                        count_bytes("fetched", self.workspace.measure(request.id))
+
+                        for log in builder.build():
+                            yield log
+                        return builder
+                except WorkspaceQuotaExceeded as e:
+                    self._reject(e, build_context)
+                except WorkspaceInUse as e:
+                    self._reject(e, build_context, AlreadyExists)
+
+        # Identical requests in flight share a single build, which is also
+        # recorded in the catalog under the ids of the requests that joined it
+        key = build_request_key(request, build_backend(backend))
+        try:
+            for log in self.coalescer.run(key, build, context,
+                                          on_join=lambda builder: builder.record_shared(request.id)):
+                yield BuildResponse(body=log)
+        except GrpcException as e:
+            if context is None:
+                raise
+            context.abort(e.status_code, e.details)
 
     def Push(self, request, context):
         module_logger.info("Received push request...")
         # Validate request
         ServiceRequestValidator.validate(request)
 
-        builder = ImageBuilder(request)
-
-        for log in builder.push():
-            yield PushResponse(body=log)
-
-        builder.cleanup_repository()
+        with self.scheduler.slot(request.config.namespace, context):
+            builder = ImageBuilder(request)
+            try:
+                with phase("push", "total"):
+                    for log in builder.push():
+                        yield PushResponse(body=log)
+            finally:
+                self.workspace.janitor.submit(builder.cleanup_repository)
+
+    def _reject(self, e, context, error=ResourceExhausted):
+        module_logger.warning(str(e))
+        if context is None:
+            raise error(str(e))
+        context.abort(error.status_code, str(e))
 
     def Find(self, request, context):
         module_logger.info("Received query request...")
-        resp = FindResponse()
-        return resp
 
+        # id may also be a digest, tag or namespace/name[:revision]
+        entry = self.catalog.find(request.id)
+        if entry is None:
+            return FindResponse()
 
-def serve(host, port, secure=False, local=False):
+        return FindResponse(id=entry["id"], image=entry["tag"] or "", repository=entry["repository"] or "")
+
+
+def serve(host, port, secure=False, local=False, metrics_port=None):
+    scheduler = BuildScheduler()
+
+    # Metrics are served on a separate http port if one is configured
+    track_scheduler(scheduler)
+    start_metrics_server(metrics_port)
+
+    # Builds and pushes, running or queued, hold at most max_builds + queue_size
+    # threads so the remaining workers are kept for Find and other light calls
+    light_workers = env_int("M1L0_BUILDER_LIGHT_WORKERS", 10)
     server = grpc.server(
-        futures.ThreadPoolExecutor(max_workers=10),
+        futures.ThreadPoolExecutor(max_workers=scheduler.max_builds + scheduler.queue_size + light_workers),
     )
 
-    imagebuilder_service_pb2_grpc.add_ImageBuilderServiceServicer_to_server(ImageBuilderService(), server)
+    # Build dirs left by an earlier process are reclaimed before serving
+    workspace = Workspace()
+    reclaimed = workspace.sweep()
+    module_logger.info("Reclaimed {} bytes of orphaned build dirs".format(reclaimed))
+    workspace.start()
+
+    imagebuilder_service_pb2_grpc.add_ImageBuilderServiceServicer_to_server(
+        ImageBuilderService(scheduler, workspace=workspace), server
+    )
 
     listen_address = "{}:{}".format(host, port)
 
@@ -104,10 +179,20 @@ def serve(host, port, secure=False, local=False):
     else:
         server.add_insecure_port(listen_address)
 
+    prewarmer = BaseImagePrewarmer()
+    prewarmer.start()
+
+    # Warm base images are never collected
+    gc = ImageGarbageCollector(protected=prewarmer.warm_images)
+    gc.start()
+
     def handle_sigterm(*_):
         module_logger.info("Received shutdown...")
+        prewarmer.stop()
+        gc.stop()
         all_rpcs_done_event = server.stop(30)
         all_rpcs_done_event.wait(30)
+        workspace.stop()
         module_logger.info("Shutdown gracefully...")
         sys.exit(0)
 
@@ -0,0 +1,194 @@
+# Admission control for heavy build and push requests
+from contextlib import contextmanager
+import itertools
+import logging
+import math
+import threading
+import time
+
+import grpc
+from grpc_interceptor.exceptions import Cancelled, ResourceExhausted
+
+from builder.core.metrics import QUEUE_SECONDS
+from builder.settings import env_int
+
+module_logger = logging.getLogger('builder.scheduler')
+
+PRIORITY_METADATA_KEY = "x-m1l0-priority"
+RETRY_AFTER_METADATA_KEY = "retry-after"
+
+
+def request_metadata(context, name):
+    """Returns the value of a request metadata key or None"""
+    if context is None:
+        return None
+
+    for key, value in context.invocation_metadata() or ():
+        if key == name:
+            return value
+    return None
+
+
+def request_priority(context):
+    """Returns the priority set in the request metadata, default 0"""
+    value = request_metadata(context, PRIORITY_METADATA_KEY)
+    if value is None:
+        return 0
+
+    try:
+        return int(value)
+    except ValueError:
+        module_logger.warning("Ignoring invalid priority {}".format(value))
+        return 0
+
+
+class _Ticket:
+    def __init__(self, namespace, priority, seq):
+        self.namespace = namespace
+        self.priority = priority
+        self.seq = seq
+        self.granted = False
+
+
+class BuildScheduler:
+    """
+    Limits how many builds and pushes run at once
+
+    At most max_builds requests run, set by M1L0_BUILDER_MAX_BUILDS, and up
+    to queue_size more wait, set by M1L0_BUILDER_BUILD_QUEUE_SIZE. Requests
+    beyond that are rejected with RESOURCE_EXHAUSTED and a retry-after
+    trailing metadata hint in seconds, estimated from recent build times.
+
+    A free slot goes to the waiting namespace with the fewest running
+    requests so one namespace cannot take all the slots. Within that,
+    higher x-m1l0-priority metadata goes first, then arrival order.
+
+    Requests following a build started by another hold no slot but count
+    as queued, so running, queued and following requests together never
+    take more than max_builds + queue_size worker threads.
+    """
+    def __init__(self, max_builds=None, queue_size=None):
+        self.max_builds = max_builds or env_int("M1L0_BUILDER_MAX_BUILDS", 4)
+        if queue_size is None:
+            queue_size = env_int("M1L0_BUILDER_BUILD_QUEUE_SIZE", 16)
+        self.queue_size = queue_size
+
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = {}
+        self._following = 0
+        self._seq = itertools.count()
+        # Moving average of how long a slot is held, seeds the retry hint
+        self._avg_duration = 60.0
+
+    @property
+    def running(self):
+        with self._cond:
+            return sum(self._running.values())
+
+    @property
+    def queued(self):
+        with self._cond:
+            return len(self._waiting)
+
+    @property
+    def following(self):
+        with self._cond:
+            return self._following
+
+    def retry_after(self):
+        """Seconds until a slot is likely free for a new request"""
+        with self._cond:
+            rounds = (len(self._waiting) + 1) / float(self.max_builds)
+            return max(1, int(math.ceil(self._avg_duration * rounds)))
+
+    def _dispatch(self):
+        """Grants free slots to waiting tickets, called with the lock held"""
+        while self._waiting and sum(self._running.values()) < self.max_builds:
+            ticket = min(self._waiting, key=lambda t: (self._running.get(t.namespace, 0), -t.priority, t.seq))
+            self._waiting.remove(ticket)
+            self._running[ticket.namespace] = self._running.get(ticket.namespace, 0) + 1
+            ticket.granted = True
+        self._cond.notify_all()
+
+    def _reject(self, context):
+        retry_after = self.retry_after()
+        msg = "Builder is at capacity, retry in {} seconds".format(retry_after)
+        module_logger.warning(msg)
+
+        if context is None:
+            raise ResourceExhausted(msg)
+
+        context.set_trailing_metadata(((RETRY_AFTER_METADATA_KEY, str(retry_after)),))
+        context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, msg)
+
+    def acquire(self, namespace, context=None):
+        """
+        Blocks until the request may run
+
+        Returns the ticket to pass to release or None if the client went
+        away while waiting
+        """
+        ticket = _Ticket(namespace, request_priority(context), next(self._seq))
+        queued_at = time.time()
+
+        with self._cond:
+            queued = len(self._waiting) + self._following
+            if queued >= self.queue_size and sum(self._running.values()) >= self.max_builds:
+                ticket = None
+            else:
+                self._waiting.append(ticket)
+                self._dispatch()
+
+        if ticket is None:
+            self._reject(context)
+
+        with self._cond:
+            while not ticket.granted:
+                self._cond.wait(timeout=1)
+                if not ticket.granted and context is not None and not context.is_active():
+                    self._waiting.remove(ticket)
+                    return None
+
+        ticket.started = time.time()
+        QUEUE_SECONDS.observe(ticket.started - queued_at)
+        return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            self._running[ticket.namespace] -= 1
+            if self._running[ticket.namespace] == 0:
+                del self._running[ticket.namespace]
+
+            duration = time.time() - ticket.started
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+            self._dispatch()
+
+    @contextmanager
+    def follow(self, context=None):
+        """Held while a request follows a build running in another request's slot"""
+        with self._cond:
+            busy = sum(self._running.values()) + len(self._waiting) + self._following
+            full = busy >= self.max_builds + self.queue_size
+            if not full:
+                self._following += 1
+
+        if full:
+            self._reject(context)
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._following -= 1
+
+    @contextmanager
+    def slot(self, namespace, context=None):
+        ticket = self.acquire(namespace, context)
+        if ticket is None:
+            raise Cancelled("Client cancelled while queued")
+
+        try:
+            yield
+        finally:
+            self.release(ticket)
@@ -0,0 +1,40 @@
+# Helpers for reading service settings from the environment
+import os
+import tempfile
+
+
+def env_int(name, default):
+    """Returns env var as int or the default if unset/blank"""
+    value = os.environ.get(name, "")
+    if len(value.strip()) == 0:
+        return default
+    return int(value)
+
+
+def env_float(name, default):
+    """Returns env var as float or the default if unset/blank"""
+    value = os.environ.get(name, "")
+    if len(value.strip()) == 0:
+        return default
+    return float(value)
+
+
+def env_bool(name, default):
+    """Returns env var as bool or the default if unset/blank"""
+    value = os.environ.get(name, "")
+    if len(value.strip()) == 0:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def cache_dir(*parts):
+    """
+    Returns a directory under the service cache root, creating it if needed
+
+    The root defaults to <tmp>/m1l0 which is the volume mounted into the
+    service container so caches survive restarts
+    """
+    root = os.environ.get("M1L0_BUILDER_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "m1l0")
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
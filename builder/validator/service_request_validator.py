@@ -6,8 +6,10 @@ class ServiceRequestValidator:
 
     @staticmethod
     def validate(request):
+        # Pushes may target several services as a comma separated list
         supported_services = ["dockerhub", "ecr"]
-        if request.config.service not in supported_services:
+        services = [x.strip() for x in request.config.service.split(",")]
+        if any(service not in supported_services for service in services):
             raise InvalidArgument("Service not one of dockerhub/ecr")
 
         if len(request.config.repository) == 0:
@@ -15,3 +17,9 @@ class ServiceRequestValidator:
 
         if len(request.config.source) == 0:
             raise InvalidArgument("Source cannot be blank")
+
+    @staticmethod
+    def validate_backend(backend):
+        supported_backends = ["classic", "buildkit"]
+        if backend is not None and backend not in supported_backends:
+            raise InvalidArgument("Builder not one of classic/buildkit")
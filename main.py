@@ -9,10 +9,11 @@ version = '1.0.0'
 @click.option("--host", default="[::]", type=str, help="Hostname of service")
 @click.option("--port", default=50051, type=int, help="Port for service")
 @click.option("--secure", is_flag=True, help="Run service with TLS")
-def start(host, port, secure):
+@click.option("--metrics-port", default=None, type=int, help="Port for Prometheus metrics")
+def start(host, port, secure, metrics_port):
     """Starts ImageBuilder service"""
     print("[INFO] Starting ImageBuilder service on host {} port {} ...".format(host, port))
-    serve(host, port, secure)
+    serve(host, port, secure, metrics_port=metrics_port)
 
 if __name__ == "__main__":
     start()
\ No newline at end of file
@@ -38,7 +38,6 @@ setup(
         "grpcio-tools~=1.30",
         "grpc-interceptor==0.12.0",
         "requests~=2.25.1",
-        "PyGithub~=1.55",
         "pytest~=5.4.1",
         "pytest-cov==2.8.1",
         "flake8~=3.9.2",
@@ -47,6 +46,7 @@ setup(
         "grpcio-reflection",
         "grpcio-health-checking",
         "click==8.0.1",
+        "prometheus_client~=0.11.0",
         "m1l0_protobufs~=0.9.0"
     ],
     entry_points={
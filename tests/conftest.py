@@ -8,6 +8,10 @@ import boto3
 from moto import mock_s3, mock_secretsmanager, mock_sts
 import pytest
 
+from builder.authentication.authenticate import invalidate_registry_auth
+from builder.authentication.ssm import clear_credentials_cache
+from builder.clients.aws import clear_aws_clients
+
 
 @pytest.fixture(scope='function')
 def aws_credentials():
@@ -16,6 +20,26 @@ def aws_credentials():
     os.environ["AWS_SHARED_CREDENTIALS_FILE"] = creds_path
 
 
+@pytest.fixture(autouse=True)
+def builder_cache_dir(tmp_path, monkeypatch):
+    """Keeps the service caches and indexes inside the test tmp dir"""
+    cache_path = os.path.join(str(tmp_path), "m1l0")
+    monkeypatch.setenv("M1L0_BUILDER_CACHE_DIR", cache_path)
+    return cache_path
+
+
+@pytest.fixture(autouse=True)
+def reset_credentials_cache():
+    """Secrets and clients created in one moto mock must not leak into other tests"""
+    clear_credentials_cache()
+    invalidate_registry_auth()
+    clear_aws_clients()
+    yield
+    clear_credentials_cache()
+    invalidate_registry_auth()
+    clear_aws_clients()
+
+
 @pytest.fixture(scope='function')
 def s3(aws_credentials):
     with mock_s3():
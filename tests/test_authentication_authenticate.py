@@ -1,3 +1,5 @@
+import base64
+from datetime import datetime, timedelta, timezone
 from unittest.mock import patch, Mock, PropertyMock
 
 from botocore.stub import Stubber
@@ -5,7 +7,9 @@ from docker import APIClient
 from docker.errors import APIError
 import pytest
 
-from builder.authentication.authenticate import session_client, get_ecr_image_prefix, authenticate_docker_client
+from builder.authentication.authenticate import session_client, get_ecr_image_prefix, authenticate_docker_client, \
+    authenticate_ecr, login_docker_client, is_auth_error, invalidate_registry_auth
+from builder.clients.docker import docker_api_client, close_docker_clients
 
 @patch("botocore.configloader.load_config")
 def test_session_client(mock_profiles):
@@ -46,4 +50,75 @@ def test_authenticate_docker_client(mock_docker_client):
         mock_docker_client.side_effect = APIError("Issue with login")    
         client = APIClient()
         resp = authenticate_docker_client(client, "mydocker/myproj:latest", {})
-    assert "Issue with login" in str(exc_info.value)
\ No newline at end of file
+    assert "Issue with login" in str(exc_info.value)
+
+@patch("builder.authentication.authenticate.session_client")
+def test_authenticate_ecr_caches_token(mock_session):
+    ecr_client = Mock()
+    ecr_client.get_authorization_token.return_value = {
+        "authorizationData": [{
+            "authorizationToken": base64.b64encode(b"AWS:secret").decode("utf-8"),
+            "proxyEndpoint": "https://123.dkr.ecr.us-east-1.amazonaws.com",
+            "expiresAt": datetime.now(timezone.utc) + timedelta(hours=12)
+        }]
+    }
+    mock_session.return_value = ecr_client
+
+    url, creds = authenticate_ecr({"region_name": "us-east-1"}, "myproject")
+    assert url == "https://123.dkr.ecr.us-east-1.amazonaws.com"
+    assert creds == {"username": "AWS", "password": "secret"}
+
+    creds["reauth"] = True
+    url, creds = authenticate_ecr({"region_name": "us-east-1"}, "myproject")
+    assert creds == {"username": "AWS", "password": "secret"}, "Cached creds are not mutated by callers"
+    assert ecr_client.get_authorization_token.call_count == 1
+
+    invalidate_registry_auth()
+    authenticate_ecr({"region_name": "us-east-1"}, "myproject")
+    assert ecr_client.get_authorization_token.call_count == 2
+
+
+def test_login_docker_client_reuses_login():
+    client = Mock(base_url="http+docker://localhost")
+    client.login.return_value = {"Status": "Login Succeeded"}
+    auth = {"username": "m1l0", "password": "token"}
+
+    assert login_docker_client(client, "https://index.docker.io/v1/", auth) == "Login Succeeded"
+    assert login_docker_client(client, "https://index.docker.io/v1/", auth) == "Login Succeeded"
+    assert client.login.call_count == 1
+    assert "reauth" not in auth
+
+    # New credentials log in again
+    login_docker_client(client, "https://index.docker.io/v1/", {"username": "m1l0", "password": "new"})
+    assert client.login.call_count == 2
+
+
+@patch("builder.clients.docker.APIClient")
+def test_login_docker_client_after_client_replaced(mock_client, monkeypatch):
+    monkeypatch.setenv("M1L0_BUILDER_DOCKER_HEALTHCHECK", "0")
+    mock_client.side_effect = lambda **kwargs: Mock(base_url=kwargs["base_url"],
+                                                    login=Mock(return_value={"Status": "Login Succeeded"}))
+    auth = {"username": "m1l0", "password": "token"}
+    close_docker_clients()
+
+    try:
+        first = docker_api_client()
+        login_docker_client(first, "https://index.docker.io/v1/", auth)
+        login_docker_client(docker_api_client(), "https://index.docker.io/v1/", auth)
+        assert first.login.call_count == 1
+
+        # The daemon restarted and the client was replaced with one for the same endpoint
+        first.ping.side_effect = APIError("daemon restarted")
+        second = docker_api_client()
+        assert second is not first and second.base_url == first.base_url
+
+        login_docker_client(second, "https://index.docker.io/v1/", auth)
+        second.login.assert_called_once()
+    finally:
+        close_docker_clients()
+
+
+def test_is_auth_error():
+    assert is_auth_error(APIError("Error: denied: Your authorization token has expired. Reauthenticate"))
+    assert is_auth_error(APIError("unauthorized: authentication required"))
+    assert not is_auth_error(APIError("Error: manifest unknown"))
@@ -0,0 +1,62 @@
+import threading
+import time
+from unittest.mock import Mock
+
+from builder.authentication.cache import ExpiringCache
+
+
+def test_serves_cached_value_until_expiry():
+    cache = ExpiringCache("test")
+    loader = Mock(side_effect=lambda: ("value", time.time() + 60))
+
+    assert cache.get("key", loader) == "value"
+    assert cache.get("key", loader) == "value"
+    assert loader.call_count == 1
+
+    cache.invalidate("key")
+    assert cache.get("key", loader) == "value"
+    assert loader.call_count == 2
+
+
+def test_expired_value_is_reloaded():
+    cache = ExpiringCache("test")
+    values = iter([("old", time.time() - 1), ("new", time.time() + 60)])
+
+    assert cache.get("key", lambda: next(values)) == "old"
+    assert cache.get("key", lambda: next(values)) == "new"
+
+
+def test_refreshes_in_background_before_expiry():
+    cache = ExpiringCache("test", refresh_ratio=0.5)
+    refreshed = threading.Event()
+
+    cache.get("key", lambda: ("old", time.time() + 0.2))
+    time.sleep(0.15)
+
+    def loader():
+        refreshed.set()
+        return "new", time.time() + 60
+
+    # Current value is still served while the refresh runs
+    assert cache.get("key", loader) == "old"
+    assert refreshed.wait(5)
+    time.sleep(0.05)
+    assert cache.get("key", loader) == "new"
+
+
+def test_concurrent_misses_load_once():
+    cache = ExpiringCache("test")
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.1)
+        return "value", time.time() + 60
+
+    threads = [threading.Thread(target=cache.get, args=("key", loader)) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
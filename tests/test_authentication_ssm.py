@@ -54,4 +54,23 @@ def test_fetch_credentials(ssm):
     with pytest.raises(ClientError) as exc_info:
         fetch_credentials("ecr")
 
-    assert str(exc_info.value) == "An error occurred (ResourceNotFoundException) when calling the GetSecretValue operation: Secrets Manager can't find the specified secret."
\ No newline at end of file
+    assert str(exc_info.value) == "An error occurred (ResourceNotFoundException) when calling the GetSecretValue operation: Secrets Manager can't find the specified secret."
+
+def test_fetch_credentials_caches_secret(ssm):
+    os.environ.update({
+        "SECRET_NAME": "secret",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_CONTAINER_CREDENTIALS_RELATIVE_URI": "http://localhost"
+    })
+
+    ssm.create_secret(
+        Name="secret",
+        SecretString=json.dumps({"DOCKERHUB_USER": "m1l0", "GITHUB_TOKEN": "gtoken"})
+    )
+
+    assert fetch_credentials("dockerhub").get("username") == "m1l0"
+
+    # Later lookups share the parsed secret without calling secrets manager
+    ssm.delete_secret(SecretId="secret", ForceDeleteWithoutRecovery=True)
+    assert fetch_credentials("github").get("token") == "gtoken"
+    del os.environ["AWS_CONTAINER_CREDENTIALS_RELATIVE_URI"]
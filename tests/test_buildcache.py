@@ -0,0 +1,79 @@
+import os
+from unittest.mock import patch, Mock
+
+from docker.errors import ImageNotFound
+
+from builder.core.buildcache import BuildCache, compute_content_hash, dockerfile_base_images, CONTENT_HASH_LABEL
+from builder.core.repo import reuse_cached_image, split_image_tag
+
+
+def test_compute_content_hash(tmp_path):
+    (tmp_path / "main.py").write_text("print('hello')")
+    config = {"dockerfile_from_image": "m1l0/tensorflow:2.4.0-py3.8-cpu", "tags": {}}
+
+    first = compute_content_hash("FROM python", str(tmp_path), config)
+    assert first == compute_content_hash("FROM python", str(tmp_path), config), "Hash should be stable"
+
+    (tmp_path / "main.py").write_text("print('changed')")
+    assert first != compute_content_hash("FROM python", str(tmp_path), config), "File change alters hash"
+
+    config["tags"] = {"project": "mnist"}
+    second = compute_content_hash("FROM python", str(tmp_path), config)
+    assert second != compute_content_hash("FROM python", str(tmp_path), {"tags": {}}), "Config alters hash"
+    assert second != compute_content_hash("FROM ubuntu", str(tmp_path), config), "Dockerfile alters hash"
+
+
+def test_base_images_in_hash(tmp_path):
+    config = {"tags": {}}
+    first = compute_content_hash("FROM python", str(tmp_path), config, base_images={"python": "sha256:aaa"})
+    assert first != compute_content_hash("FROM python", str(tmp_path), config, base_images={"python": "sha256:bbb"})
+
+    dockerfile = "\n".join([
+        "ARG BUILDER=m1l0/tensorflow:2.5.0-py3.8-cpu",
+        "FROM --platform=linux/amd64 python:3.8 AS builder",
+        "RUN pip install numpy",
+        "FROM builder AS test",
+        "FROM ${BUILDER}",
+        "COPY --from=builder /opt /opt",
+        "FROM scratch",
+        "FROM $BASE"
+    ])
+    assert dockerfile_base_images(dockerfile) == ["python:3.8", "m1l0/tensorflow:2.5.0-py3.8-cpu"]
+
+
+def test_build_cache_index(tmp_path):
+    cache = BuildCache(os.path.join(str(tmp_path), "index.json"))
+    assert cache.lookup("abc") is None
+
+    cache.record("abc", "m1l0/myproject:latest")
+    assert BuildCache(cache.index_path).lookup("abc") == "m1l0/myproject:latest"
+
+    cache.discard("abc")
+    assert cache.lookup("abc") is None
+
+    os.environ["M1L0_BUILDER_BUILD_CACHE"] = "false"
+    try:
+        cache.record("abc", "m1l0/myproject:latest")
+        assert cache.lookup("abc") is None
+    finally:
+        del os.environ["M1L0_BUILDER_BUILD_CACHE"]
+
+
+def test_split_image_tag():
+    assert split_image_tag("m1l0/myproject:v1") == ("m1l0/myproject", "v1")
+    assert split_image_tag("localhost:5000/myproject") == ("localhost:5000/myproject", "latest")
+
+
+@patch("builder.core.repo.docker_api_client")
+def test_reuse_cached_image(mock_client):
+    api_client = Mock()
+    api_client.inspect_image.return_value = {"Config": {"Labels": {CONTENT_HASH_LABEL: "abc"}}}
+    mock_client.return_value = api_client
+
+    assert reuse_cached_image("m1l0/myproject:v1", "m1l0/myproject:v2", "abc") is True
+    api_client.tag.assert_called_with("m1l0/myproject:v1", "m1l0/myproject", "v2")
+
+    assert reuse_cached_image("m1l0/myproject:v1", "m1l0/myproject:v2", "def") is False
+
+    api_client.inspect_image.side_effect = ImageNotFound("gone")
+    assert reuse_cached_image("m1l0/myproject:v1", "m1l0/myproject:v2", "abc") is False
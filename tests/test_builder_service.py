@@ -1,18 +1,21 @@
+import os
+import threading
 from unittest.mock import patch, Mock, PropertyMock
 
-from grpc_interceptor.exceptions import InvalidArgument
+import grpc
+from grpc_interceptor.exceptions import GrpcException, InvalidArgument
 import pytest
 
+from builder.core.catalog import ImageCatalog
 from builder.service.imageservice import ImageBuilderService
-from m1l0_services.imagebuilder.v1.imagebuilder_service_pb2 import BuildRequest, PushRequest, BuildConfig
+from m1l0_services.imagebuilder.v1.imagebuilder_service_pb2 import BuildRequest, PushRequest, BuildConfig, \
+    FindRequest, FindResponse
 
 
 @patch("builder.core.retriever.GetSourceFiles.call")
-@patch("builder.core.imagebuilder.ImageBuilder.cleanup_code_path")
 @patch("builder.core.imagebuilder.ImageBuilder.build")
-def test_builder_Build(mock_build, mock_cleanup, mock_retriever):
+def test_builder_Build(mock_build, mock_retriever):
     mock_build.return_value = iter(["80%", "90%", "100%"])
-    mock_cleanup = Mock()
     mock_retriever.return_value = "/tmp/code/123"
 
     config = {
@@ -74,4 +77,87 @@ def test_builder_Push(mock_push, mock_cleanup):
         resp = service.Push(request, None)
         resp = [x.body for x in resp]
 
-    assert "Service not one of dockerhub/ecr" in str(exc_info.value)
\ No newline at end of file
+    assert "Service not one of dockerhub/ecr" in str(exc_info.value)
+
+def test_builder_Find(tmp_path):
+    catalog = ImageCatalog(str(tmp_path / "catalog.db"))
+    catalog.record_build("123", "m1l0", "myproject", "latest", "m1l0/myproject:latest")
+    catalog.record_push("123", "m1l0/myproject:latest", "m1l0/myproject:latest")
+
+    service = ImageBuilderService(catalog=catalog)
+
+    resp = service.Find(FindRequest(id="123"), None)
+    assert resp.id == "123"
+    assert resp.image == "m1l0/myproject:latest"
+    assert resp.repository == "m1l0/myproject:latest"
+
+    assert service.Find(FindRequest(id="m1l0/myproject:latest"), None).id == "123"
+    assert service.Find(FindRequest(id="unknown"), None) == FindResponse()
+
+
+@patch("builder.core.imagebuilder.ImageBuilder.build")
+@patch("builder.service.imageservice.GetSourceFiles")
+def test_builder_Build_cleans_up_failed_build(mock_retriever, mock_build, tmp_path, monkeypatch):
+    root = str(tmp_path / "code")
+    monkeypatch.setattr("builder.core.workspace.workspace_root", lambda: root)
+
+    def fetch():
+        os.makedirs(os.path.join(root, "123"))
+        return os.path.join(root, "123")
+
+    mock_retriever.return_value.call.side_effect = fetch
+    mock_build.side_effect = RuntimeError("Build failed")
+
+    request = BuildRequest(id="123", config=BuildConfig(source="dir:///tmp/123", service="dockerhub",
+                                                        repository="m1l0/myproject", revision="latest"))
+
+    service = ImageBuilderService()
+    with pytest.raises(RuntimeError):
+        list(service.Build(request, None))
+
+    assert not os.path.exists(os.path.join(root, "123"))
+
+
+@patch("builder.core.imagebuilder.ImageBuilder.record_build")
+@patch("builder.service.imageservice.GetSourceFiles")
+def test_builder_Build_records_coalesced_requests(mock_retriever, mock_record, tmp_path, monkeypatch):
+    root = str(tmp_path / "code")
+    monkeypatch.setattr("builder.core.workspace.workspace_root", lambda: root)
+    mock_retriever.return_value.call.return_value = root
+    step = threading.Event()
+
+    def build(self):
+        self._recorded = ("m1l0/myproject:latest", {}, None)
+        yield "Step 1/2"
+        step.wait(5)
+        yield "Step 2/2"
+
+    config = BuildConfig(source="dir:///tmp/123", service="dockerhub", repository="m1l0/myproject", revision="latest")
+    service = ImageBuilderService()
+
+    with patch("builder.core.imagebuilder.ImageBuilder.build", build):
+        leader = service.Build(BuildRequest(id="123", config=config), None)
+        assert next(leader).body == "Step 1/2"
+        follower = service.Build(BuildRequest(id="456", config=config), None)
+        assert next(follower).body == "Step 1/2"
+
+        step.set()
+        assert [x.body for x in leader] == ["Step 2/2"]
+        assert [x.body for x in follower] == ["Step 2/2"]
+
+    # The shared build is recorded under the id of the follower
+    assert mock_record.call_args[1]["request_id"] == "456"
+
+
+@patch("builder.service.imageservice.GetSourceFiles")
+def test_builder_Build_rejects_duplicate_id(mock_retriever, tmp_path, monkeypatch):
+    monkeypatch.setattr("builder.core.workspace.workspace_root", lambda: str(tmp_path / "code"))
+    service = ImageBuilderService()
+
+    request = BuildRequest(id="123", config=BuildConfig(source="dir:///tmp/123", service="dockerhub",
+                                                        repository="m1l0/myproject", revision="latest"))
+    with service.workspace.claim("123"):
+        with pytest.raises(GrpcException) as exc_info:
+            list(service.Build(request, None))
+    assert exc_info.value.status_code == grpc.StatusCode.ALREADY_EXISTS
+    mock_retriever.assert_not_called()
@@ -0,0 +1,55 @@
+from builder.core.catalog import ImageCatalog
+
+
+def test_catalog_record_and_find(tmp_path):
+    catalog = ImageCatalog(str(tmp_path / "catalog.db"))
+    catalog.record_build("123", "m1l0", "myproject", "v1", "m1l0/myproject:v1", image_id="sha256:aaa",
+                         size=1024, labels={"m1l0.name": "myproject", "team": "ml"}, content_hash="abc")
+    catalog.record_build("456", "m1l0", "myproject", "v2", "m1l0/myproject:v2", image_id="sha256:bbb")
+
+    entry = catalog.find("123")
+    assert entry["tag"] == "m1l0/myproject:v1"
+    assert entry["size"] == 1024
+    assert entry["labels"] == {"m1l0.name": "myproject", "team": "ml"}
+
+    assert catalog.find("sha256:bbb")["id"] == "456"
+    assert catalog.find("m1l0/myproject:v1")["id"] == "123"
+    assert catalog.find("m1l0/myproject")["id"] == "456", "Latest revision without a revision"
+    assert catalog.find("m1l0/unknown") is None
+
+    assert [e["id"] for e in catalog.find_by_label("team", "ml")] == ["123"]
+    assert [e["id"] for e in catalog.latest("m1l0", "myproject")] == ["456", "123"]
+
+
+def test_catalog_record_push(tmp_path):
+    catalog = ImageCatalog(str(tmp_path / "catalog.db"))
+    catalog.record_build("123", "m1l0", "myproject", "v1", "m1l0/myproject:v1")
+
+    # Push with its own request id updates the build of the same tag
+    catalog.record_push("789", "m1l0/myproject:v1", "m1l0/myproject:v1", digest="sha256:ccc")
+    entry = catalog.find("sha256:ccc")
+    assert entry["id"] == "123"
+    assert entry["repository"] == "m1l0/myproject:v1"
+    assert entry["pushed"] is not None
+
+    catalog.record_push("999", "m1l0/other:v1", "m1l0/other:v1")
+    assert catalog.find("999")["repository"] == "m1l0/other:v1"
+
+
+def test_catalog_records_every_pushed_repository(tmp_path):
+    catalog = ImageCatalog(str(tmp_path / "catalog.db"))
+    catalog.record_build("123", "m1l0", "myproject", "v1", "m1l0/myproject:v1")
+    ecr = "123.dkr.ecr.us-east-1.amazonaws.com/myproject:v1"
+
+    catalog.record_push("123", "m1l0/myproject:v1", ecr, digest="sha256:ecr")
+    catalog.record_push("123", "m1l0/myproject:v1", "m1l0/myproject:v1", digest="sha256:hub")
+
+    entry = catalog.find("123")
+    assert sorted(entry["repositories"]) == sorted([ecr, "m1l0/myproject:v1"])
+    assert catalog.find(ecr)["id"] == "123"
+    assert catalog.find("sha256:ecr")["id"] == "123"
+    assert catalog.image_last_used(ecr) is not None
+
+    # Pushing the same repository again keeps a single row
+    catalog.record_push("123", "m1l0/myproject:v1", ecr)
+    assert len(catalog.find("123")["repositories"]) == 2
@@ -0,0 +1,43 @@
+from builder.clients import aws
+from builder.clients.aws import aws_client
+
+
+def test_client_is_shared(aws_credentials):
+    first = aws_client("s3", region_name="us-east-1")
+    assert aws_client("s3", region_name="us-east-1") is first
+    assert aws_client("s3", region_name="eu-west-1") is not first
+    assert aws_client("logs", region_name="us-east-1") is not first
+
+
+def test_client_recreated_when_credentials_rotate(aws_credentials, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "first")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+    first = aws_client("sts", region_name="us-east-1")
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "rotated")
+    second = aws_client("sts", region_name="us-east-1")
+    assert second is not first
+    assert aws_client("sts", region_name="us-east-1") is second
+
+
+def test_stale_clients_evicted(aws_credentials, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "first")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+    aws_client("sts", region_name="us-east-1")
+    aws_client("s3", region_name="us-east-1")
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "rotated")
+    aws_client("sts", region_name="us-east-1")
+    assert len(aws._clients) == 1
+
+
+def test_client_cache_is_bounded(aws_credentials, monkeypatch):
+    monkeypatch.setattr(aws, "MAX_CLIENTS", 2)
+    first = aws_client("s3", region_name="us-east-1")
+    aws_client("s3", region_name="eu-west-1")
+    assert aws_client("s3", region_name="us-east-1") is first
+
+    # eu-west-1 is the least recently used
+    aws_client("s3", region_name="ap-south-1")
+    assert len(aws._clients) == 2
+    assert aws_client("s3", region_name="us-east-1") is first
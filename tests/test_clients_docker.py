@@ -0,0 +1,69 @@
+import threading
+from unittest.mock import patch, Mock
+
+from docker.errors import APIError
+import pytest
+
+from builder.clients.docker import docker_api_client, docker_endpoints, close_docker_clients
+
+
+@pytest.fixture(autouse=True)
+def shared_clients():
+    close_docker_clients()
+    yield
+    close_docker_clients()
+
+
+@patch("builder.clients.docker.APIClient")
+def test_client_is_shared_per_endpoint(mock_client):
+    mock_client.side_effect = lambda **kwargs: Mock(base_url=kwargs["base_url"])
+
+    first = docker_api_client()
+    assert docker_api_client() is first
+    assert docker_api_client("tcp://docker2:2375") is not first
+    assert mock_client.call_count == 2
+    assert mock_client.call_args[1]["max_pool_size"] == 10
+
+
+@patch("builder.clients.docker.APIClient")
+def test_unhealthy_client_is_replaced(mock_client, monkeypatch):
+    monkeypatch.setenv("M1L0_BUILDER_DOCKER_HEALTHCHECK", "0")
+    mock_client.side_effect = lambda **kwargs: Mock()
+
+    first = docker_api_client()
+    assert docker_api_client() is first, "Healthy client is kept"
+
+    first.ping.side_effect = APIError("daemon restarted")
+    second = docker_api_client()
+    assert second is not first
+    first.close.assert_called_once()
+
+
+@patch("builder.clients.docker.APIClient")
+def test_slow_endpoint_does_not_block_others(mock_client):
+    creating = threading.Event()
+    unblock = threading.Event()
+
+    def create(**kwargs):
+        if kwargs["base_url"] == "tcp://slow:2375":
+            creating.set()
+            unblock.wait(5)
+        return Mock(base_url=kwargs["base_url"])
+
+    mock_client.side_effect = create
+
+    slow = threading.Thread(target=docker_api_client, args=("tcp://slow:2375",))
+    slow.start()
+    try:
+        assert creating.wait(5)
+        assert docker_api_client("tcp://docker2:2375").base_url == "tcp://docker2:2375"
+    finally:
+        unblock.set()
+        slow.join(5)
+
+
+def test_docker_endpoints(monkeypatch):
+    assert docker_endpoints() == ["unix://var/run/docker.sock"]
+
+    monkeypatch.setenv("M1L0_BUILDER_DOCKER_HOSTS", "unix://var/run/docker.sock, tcp://docker2:2375")
+    assert docker_endpoints() == ["unix://var/run/docker.sock", "tcp://docker2:2375"]
@@ -0,0 +1,95 @@
+import json
+import threading
+import time
+from unittest.mock import patch
+
+import boto3
+import pytest
+from moto import mock_logs
+
+from builder.core.cloudwatchlogs import (
+    CloudWatchLogShipper,
+    clear_log_stream_cache,
+    MAX_BATCH_BYTES
+)
+
+
+@pytest.fixture(autouse=True)
+def log_group(monkeypatch, aws_credentials):
+    monkeypatch.setenv("JOB_LOG_GROUP", "m1l0-builds")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_PROFILE", "tester")
+    clear_log_stream_cache()
+    yield "m1l0-builds"
+    clear_log_stream_cache()
+
+
+def read_stream(stream):
+    client = boto3.client("logs", region_name="us-east-1")
+    resp = client.get_log_events(logGroupName="m1l0-builds", logStreamName=stream, startFromHead=True)
+    return resp["events"]
+
+
+@mock_logs
+def test_shipper_flushes_on_close():
+    with CloudWatchLogShipper("123", flush_interval=60) as shipper:
+        for i in range(25):
+            shipper.put("line {}".format(i))
+
+    events = read_stream("123")
+    assert [json.loads(e["message"]) for e in events] == ["line {}".format(i) for i in range(25)]
+
+
+@mock_logs
+def test_shipper_uses_capture_timestamps():
+    now = int(time.time() * 1000)
+    with patch("builder.core.cloudwatchlogs._timestamp", side_effect=[now - 5000, now - 1000]):
+        with CloudWatchLogShipper("123") as shipper:
+            shipper.put("first")
+            shipper.put("second")
+
+    assert [e["timestamp"] for e in read_stream("123")] == [now - 5000, now - 1000]
+
+
+@patch("builder.core.cloudwatchlogs.setup_log_stream")
+@patch("builder.core.cloudwatchlogs.get_client")
+def test_shipper_batches_within_size_limit(mock_client, mock_setup):
+    client = mock_client.return_value
+    client.put_log_events.return_value = {"nextSequenceToken": "token"}
+
+    line = "x" * 100000
+    with CloudWatchLogShipper("123", flush_interval=60) as shipper:
+        for _ in range(25):
+            shipper.put(line)
+
+    batches = [c[1]["logEvents"] for c in client.put_log_events.call_args_list]
+    assert sum(len(b) for b in batches) == 25
+    assert len(batches) == 3
+    for batch in batches:
+        assert sum(len(e["message"]) + 26 for e in batch) <= MAX_BATCH_BYTES
+
+    assert "sequenceToken" not in client.put_log_events.call_args_list[0][1]
+    assert client.put_log_events.call_args_list[1][1]["sequenceToken"] == "token"
+    assert mock_setup.call_count == 1
+
+
+@patch("builder.core.cloudwatchlogs.setup_log_stream")
+@patch("builder.core.cloudwatchlogs.get_client")
+def test_shipper_drops_when_queue_full(mock_client, mock_setup):
+    sending = threading.Event()
+    release = threading.Event()
+    client = mock_client.return_value
+    client.put_log_events.side_effect = lambda **kwargs: sending.set() or release.wait() or {}
+
+    shipper = CloudWatchLogShipper("123", queue_size=1, flush_interval=0.01, block_timeout=0.01)
+    shipper.put("first")
+    sending.wait(5)
+    results = [shipper.put(i) for i in range(20)]
+    release.set()
+    shipper.close()
+
+    assert not all(results)
+    assert shipper.dropped == results.count(False)
+
+    messages = [json.loads(e["message"]) for c in client.put_log_events.call_args_list for e in c[1]["logEvents"]]
+    assert "{} log lines dropped".format(shipper.dropped) in messages
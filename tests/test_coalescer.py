@@ -0,0 +1,188 @@
+from contextlib import contextmanager
+import threading
+import time
+
+import grpc
+from grpc_interceptor.exceptions import GrpcException
+import pytest
+
+from builder.core.coalescer import BuildCoalescer, build_request_key
+from m1l0_services.imagebuilder.v1.imagebuilder_service_pb2 import BuildRequest, BuildConfig
+
+
+def build_request(id, revision="v1"):
+    return BuildRequest(id=id, config=BuildConfig(source="s3://bucket/code.tar.gz", revision=revision))
+
+
+def test_build_request_key():
+    assert build_request_key(build_request("1")) == build_request_key(build_request("2"))
+    assert build_request_key(build_request("1")) != build_request_key(build_request("1", revision="v2"))
+
+
+def test_build_request_key_includes_backend():
+    assert build_request_key(build_request("1"), "buildkit") != build_request_key(build_request("2"), "classic")
+    assert build_request_key(build_request("1"), "buildkit") == build_request_key(build_request("2"), "buildkit")
+
+
+def follow_in_thread(coalescer, key, work, **kwargs):
+    """Runs a follower on a thread, returns the thread and what it collected"""
+    res = {"lines": [], "error": None}
+
+    def run():
+        try:
+            res["lines"].extend(coalescer.run(key, work, **kwargs))
+        except Exception as e:
+            res["error"] = e
+
+    follower = threading.Thread(target=run)
+    follower.start()
+    return follower, res
+
+
+def test_followers_replay_then_follow():
+    coalescer = BuildCoalescer()
+    step = threading.Event()
+    calls = []
+    joined = []
+
+    def work(context):
+        calls.append(1)
+        yield "Step 1/2"
+        step.wait(5)
+        yield "Step 2/2"
+        return "image"
+
+    leader = coalescer.run("key", work, on_join=joined.append)
+    assert next(leader) == "Step 1/2"
+
+    follower, res = follow_in_thread(coalescer, "key", work, on_join=joined.append)
+    while len(coalescer._flights["key"].contexts) < 2:
+        time.sleep(0.01)
+
+    step.set()
+    assert list(leader) == ["Step 2/2"]
+    follower.join(5)
+
+    assert res["lines"] == ["Step 1/2", "Step 2/2"]
+    assert len(calls) == 1
+    assert joined == ["image"], "Only the follower records the shared result"
+
+    # Finished builds are not joined
+    assert list(coalescer.run("key", lambda context: iter(["rebuilt"]))) == ["rebuilt"]
+
+
+def test_followers_get_status_errors():
+    coalescer = BuildCoalescer()
+    failed = threading.Event()
+
+    def work(context):
+        yield "Step 1/2"
+        failed.wait(5)
+        raise RuntimeError("Build failed")
+
+    leader = coalescer.run("key", work)
+    next(leader)
+    follower = coalescer.run("key", work)
+    assert next(follower) == "Step 1/2"
+
+    failed.set()
+    with pytest.raises(RuntimeError):
+        list(leader)
+    with pytest.raises(GrpcException) as exc_info:
+        list(follower)
+    assert exc_info.value.status_code == grpc.StatusCode.UNKNOWN
+    assert "Build failed" in exc_info.value.details
+
+
+def test_followers_share_abort_status():
+    coalescer = BuildCoalescer()
+    joined = threading.Event()
+
+    def work(context):
+        yield "Queued"
+        joined.wait(5)
+        context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Builder is at capacity")
+
+    leader = coalescer.run("key", work)
+    next(leader)
+    follower = coalescer.run("key", work)
+    next(follower)
+    joined.set()
+
+    for participant in [leader, follower]:
+        with pytest.raises(GrpcException) as exc_info:
+            list(participant)
+        assert exc_info.value.status_code == grpc.StatusCode.RESOURCE_EXHAUSTED
+
+
+def test_build_continues_when_leader_cancels():
+    coalescer = BuildCoalescer()
+    step = threading.Event()
+    joined = []
+
+    def work(context):
+        yield "Step 1/2"
+        step.wait(5)
+        yield "Step 2/2"
+        return "image"
+
+    leader = coalescer.run("key", work)
+    next(leader)
+    follower, res = follow_in_thread(coalescer, "key", work, on_join=joined.append)
+    while len(coalescer._flights["key"].contexts) < 2:
+        time.sleep(0.01)
+
+    leader.close()
+    step.set()
+    follower.join(5)
+
+    assert res["error"] is None
+    assert res["lines"] == ["Step 1/2", "Step 2/2"]
+    assert joined == ["image"]
+
+
+def test_build_stops_when_all_cancel():
+    coalescer = BuildCoalescer()
+    step = threading.Event()
+    stopped = threading.Event()
+
+    def work(context):
+        try:
+            yield "Step 1/2"
+            step.wait(5)
+            yield "Step 2/2"
+        finally:
+            stopped.set()
+
+    leader = coalescer.run("key", work)
+    next(leader)
+    leader.close()
+    step.set()
+
+    assert stopped.wait(5)
+
+
+def test_followers_hold_follow_slot():
+    held = []
+
+    @contextmanager
+    def follow_slot(context):
+        held.append(context)
+        yield
+
+    coalescer = BuildCoalescer(follow_slot=follow_slot)
+    step = threading.Event()
+
+    def work(context):
+        yield "Step 1/2"
+        step.wait(5)
+
+    leader = coalescer.run("key", work, "leader")
+    next(leader)
+    follower = coalescer.run("key", work, "follower")
+    next(follower)
+    step.set()
+    list(leader)
+    list(follower)
+
+    assert held == ["follower"]
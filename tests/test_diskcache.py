@@ -0,0 +1,108 @@
+import io
+import os
+import subprocess
+import tarfile
+import time
+
+import pytest
+
+from builder.core.diskcache import DirectoryCache
+from builder.core.gitcache import GitError, GitMirrorCache, mirror_key, split_source
+
+
+def _entry(cache, key, size):
+    os.makedirs(cache.path(key))
+    with open(os.path.join(cache.path(key), "data"), "wb") as f:
+        f.write(b"x" * size)
+    cache.touch(key)
+    time.sleep(0.01)
+
+
+def test_evicts_least_recently_used():
+    cache = DirectoryCache("test", max_bytes=250)
+    _entry(cache, "a", 100)
+    _entry(cache, "b", 100)
+    _entry(cache, "c", 100)
+
+    # Reading "a" makes "b" the oldest entry
+    cache.touch("a")
+
+    assert cache.evict() == 100
+    assert sorted(x[0] for x in cache.entries()) == ["a", "c"]
+    assert not os.path.exists(cache.path("b"))
+
+
+def test_evict_skips_kept_and_locked_entries():
+    cache = DirectoryCache("test", max_bytes=0)
+    _entry(cache, "a", 100)
+    _entry(cache, "b", 100)
+
+    with cache.lock("b"):
+        assert cache.evict(keep=["a"]) == 0
+
+    assert cache.exists("a") and cache.exists("b")
+
+
+def test_git_source_parsing():
+    assert split_source("https://github.com/m1l0/myproject.git#v1.0") == \
+        ("https://github.com/m1l0/myproject.git", "v1.0")
+    assert split_source("https://github.com/m1l0/myproject.git")[1] == "HEAD"
+    assert mirror_key("https://token@GitHub.com/m1l0/myproject.git") == \
+        mirror_key("https://github.com/m1l0/myproject")
+
+
+def test_split_source_rejects_option_refs():
+    assert split_source("https://github.com/m1l0/myproject.git#refs/heads/main")[1] == "refs/heads/main"
+    assert split_source("https://github.com/m1l0/myproject.git#1a2b3c4")[1] == "1a2b3c4"
+
+    for ref in ["--upload-pack=touch /tmp/pwned", "-c", "main..other", "bad ref"]:
+        with pytest.raises(GitError):
+            split_source("https://github.com/m1l0/myproject.git#{}".format(ref))
+
+
+def _git(cwd, *args):
+    env = dict(os.environ, GIT_AUTHOR_NAME="m1l0", GIT_AUTHOR_EMAIL="m1l0@example.com",
+               GIT_COMMITTER_NAME="m1l0", GIT_COMMITTER_EMAIL="m1l0@example.com")
+    return subprocess.check_output(["git"] + list(args), cwd=cwd, env=env).decode("utf-8").strip()
+
+
+def test_git_export_with_installed_git(tmp_path):
+    # Runs the real git binary, the service image ships git 2.20 so only
+    # options available in that version may be used
+    repo = str(tmp_path / "repo")
+    os.makedirs(repo)
+    _git(repo, "init", "--quiet")
+    with open(os.path.join(repo, "main.py"), "w") as f:
+        f.write("print('v1')")
+    _git(repo, "add", "main.py")
+    _git(repo, "commit", "--quiet", "-m", "v1")
+    _git(repo, "tag", "v1.0")
+
+    cache = GitMirrorCache()
+    commands = []
+    git = cache._git
+
+    def record(args, **kwargs):
+        commands.append(args)
+        return git(args, **kwargs)
+
+    cache._git = record
+
+    def extract(stream, dest):
+        with tarfile.open(fileobj=io.BytesIO(stream.read())) as tar:
+            files[dest] = tar.extractfile("main.py").read()
+
+    files = {}
+    url = "file://{}".format(repo)
+    assert cache.export(url + "#v1.0", "v1", extract) == _git(repo, "rev-parse", "v1.0")
+    assert files["v1"] == b"print('v1')"
+
+    # A commit made after the mirror was cloned is fetched
+    with open(os.path.join(repo, "main.py"), "w") as f:
+        f.write("print('v2')")
+    _git(repo, "commit", "--quiet", "-am", "v2")
+    commit = _git(repo, "rev-parse", "HEAD")
+    mirror = cache.cache.path(mirror_key(url))
+    assert cache.resolve(mirror, commit) == commit
+
+    assert not any("--end-of-options" in args for args in commands)
@@ -0,0 +1,102 @@
+from unittest.mock import patch
+
+from builder.core.catalog import ImageCatalog
+from builder.core.gc import ImageGarbageCollector, docker_disk_usage, in_flight, in_flight_images
+
+
+class FakeDaemon:
+    """Daemon with a set of images whose unique size counts towards disk usage"""
+    def __init__(self, images):
+        self.images = images
+        self.removed = []
+        self.pruned_builds = 0
+        self.prune_filters = []
+
+    def df(self):
+        return {
+            "LayersSize": sum(x["Size"] - x["SharedSize"] for x in self.images),
+            "Images": list(self.images),
+            "Containers": [],
+            "BuildCache": []
+        }
+
+    def prune_containers(self, filters=None):
+        self.prune_filters.append(filters)
+        return {"ContainersDeleted": ["abc"]}
+
+    def prune_images(self, filters=None):
+        self.prune_filters.append(filters)
+        return {"ImagesDeleted": []}
+
+    def prune_builds(self):
+        self.pruned_builds += 1
+        return {"SpaceReclaimed": 0}
+
+    def remove_image(self, image, force=False):
+        self.removed.append(image)
+        self.images = [x for x in self.images if x["Id"] != image]
+
+
+def image(id, tag, size, created, containers=0):
+    return {"Id": id, "RepoTags": [tag], "Size": size, "SharedSize": 0, "Created": created, "Containers": containers}
+
+
+def test_docker_disk_usage():
+    df = {
+        "LayersSize": 100,
+        "Containers": [{"SizeRw": 10}, {}],
+        "BuildCache": [{"Size": 5, "Shared": False}, {"Size": 7, "Shared": True}]
+    }
+    assert docker_disk_usage(df) == 115
+
+
+def test_in_flight():
+    with in_flight("m1l0/myproject:v1"):
+        with in_flight("m1l0/myproject:v1"):
+            images, oldest = in_flight_images()
+            assert images == {"m1l0/myproject:v1"}
+            assert oldest is not None
+        assert in_flight_images()[0] == {"m1l0/myproject:v1"}
+    assert in_flight_images() == (set(), None)
+
+
+@patch("builder.core.gc.docker_api_client")
+def test_collect_below_high_watermark(mock_client, tmp_path):
+    daemon = FakeDaemon([image("sha256:a", "m1l0/a:v1", 100, 1)])
+    mock_client.return_value = daemon
+
+    gc = ImageGarbageCollector(catalog=ImageCatalog(str(tmp_path / "catalog.db")), high_watermark=200,
+                               low_watermark=100)
+    report = gc.collect()
+
+    assert report.reclaimed == 0
+    assert daemon.prune_filters == [] and daemon.removed == []
+
+
+@patch("builder.core.gc.docker_api_client")
+def test_collect_lru_to_low_watermark(mock_client, tmp_path):
+    daemon = FakeDaemon([
+        image("sha256:base", "m1l0/tensorflow:2.4.0-py3.8-cpu", 400, 1),
+        image("sha256:old", "m1l0/old:v1", 300, 2),
+        image("sha256:used", "m1l0/used:v1", 300, 3),
+        image("sha256:running", "m1l0/running:v1", 300, 4, containers=1),
+        image("sha256:building", "m1l0/building:v1", 300, 5),
+        image("sha256:new", "m1l0/new:v1", 300, 6)
+    ])
+    mock_client.return_value = daemon
+
+    catalog = ImageCatalog(str(tmp_path / "catalog.db"))
+    # Built long after it was created so it is the most recently used
+    catalog.record_build("123", "m1l0", "used", "v1", "m1l0/used:v1")
+
+    gc = ImageGarbageCollector(catalog=catalog, high_watermark=1500, low_watermark=1300,
+                               protected=lambda: {"m1l0/tensorflow:2.4.0-py3.8-cpu"})
+
+    with in_flight("m1l0/building:v1"):
+        report = gc.collect()
+
+    assert daemon.removed == ["sha256:old", "sha256:new"]
+    assert report.reclaimed == 600
+    assert report.containers == 1
+    assert gc.total_reclaimed == 600
+    assert daemon.pruned_builds == 0, "Build cache is kept while builds are in flight"
@@ -0,0 +1,69 @@
+import os
+from unittest.mock import patch
+
+from builder.core.ignores import IgnoreMatcher, walk_context
+
+
+def test_request_patterns_match_at_any_depth():
+    matcher = IgnoreMatcher(request_patterns=["*.pyc", "__pycache__", "data/raw"])
+
+    assert matcher.matches("main.pyc")
+    assert matcher.matches("pkg/module.pyc")
+    assert matcher.matches("pkg/__pycache__")
+    assert matcher.matches("pkg/__pycache__/module.cpython-38.pyc")
+    assert matcher.matches("data/raw/train.csv")
+    assert not matcher.matches("pkg/data/raw")
+    assert not matcher.matches("main.py")
+
+
+def test_dockerignore_semantics():
+    matcher = IgnoreMatcher(dockerignore_patterns=[
+        "# comment",
+        "/.git",
+        "**/node_modules",
+        "*.md",
+        "!README.md",
+        "models/*",
+        "!models/keep"
+    ])
+
+    assert matcher.matches(".git/objects/ab")
+    assert matcher.matches("web/app/node_modules/react/index.js")
+    assert matcher.matches("CHANGELOG.md")
+    assert not matcher.matches("README.md"), "Later exception re-includes file"
+    assert not matcher.matches("docs/guide.md"), "Dockerignore patterns are anchored at the root"
+    assert matcher.matches("models/weights.h5")
+    assert not matcher.matches("models/keep")
+
+    assert matcher.prunes(".git")
+    assert not matcher.prunes("models"), "Cannot prune dir with a re-included child"
+
+
+def test_walk_context_prunes_ignored_dirs(tmp_path):
+    for p in ["main.py", "README.md", ".git/HEAD", "venv/bin/python", "pkg/mod.py", "pkg/mod.pyc"]:
+        path = tmp_path / p
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    (tmp_path / ".dockerignore").write_text(".git\nvenv\n")
+
+    matcher = IgnoreMatcher.for_context(str(tmp_path), ["*.pyc"])
+
+    walked = []
+    orig_walk = os.walk
+
+    def recording_walk(root):
+        for entry in orig_walk(root):
+            walked.append(os.path.relpath(entry[0], str(tmp_path)))
+            yield entry
+
+    with patch("os.walk", recording_walk):
+        entries = [(relpath, is_dir) for _, relpath, is_dir in walk_context(str(tmp_path), matcher)]
+
+    assert entries == [
+        ("pkg", True),
+        (".dockerignore", False),
+        ("README.md", False),
+        ("main.py", False),
+        ("pkg/mod.py", False)
+    ]
+    assert ".git" not in walked and "venv" not in walked, "Ignored dirs should not be walked"
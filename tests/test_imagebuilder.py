@@ -6,26 +6,6 @@ from m1l0_services.imagebuilder.v1.imagebuilder_service_pb2 import BuildRequest,
 
 from builder.core.imagebuilder import ImageBuilder
 
-@patch("shutil.rmtree")
-def test_cleanup_code_path(mock_shutil):
-    mock_shutil.return_value = Mock()
-
-    config = {
-        "source": "dir:///tmp/123",
-        "service": "dockerhub",
-        "repository": "m1l0/myproject",
-        "revision": "latest"
-    }
-
-    request = BuildRequest(
-        id="123", 
-        config=BuildConfig(**config)
-    )
-
-    imagebuilder = ImageBuilder(request, code_copy_path="/tmp/code/123")
-    imagebuilder.cleanup_code_path()
-    mock_shutil.assert_called_with("/tmp/code/123")
-
 @patch("docker.APIClient.remove_image")
 def test_cleanup_repository(mock_remove_image):
     mock_remove_image.return_value = Mock()
@@ -116,4 +96,204 @@ def test_push(mock_push):
     res = imagebuilder.push()
     res = list(res)
     assert res == ["80%", "90%", "100%"]
-    assert imagebuilder.repository == "repository: m1l0/myproject"
\ No newline at end of file
+    assert imagebuilder.repository == "repository: m1l0/myproject"
+
+@patch("builder.core.imagebuilder.reuse_cached_image")
+@patch("builder.core.imagebuilder.build_docker_image")
+@patch("builder.core.imagebuilder.prepare_archive")
+@patch("builder.core.imagebuilder.create_dockerfile")
+def test_build_cache_hit(mock_docker, mock_archive, mock_builder, mock_reuse, tmp_path):
+    code_path = tmp_path / "123"
+    code_path.mkdir()
+    (code_path / "main.py").write_text("print('hello')")
+    mock_docker.return_value = "DOCKERFILE CONTENTS"
+    mock_builder.side_effect = lambda *args, **kwargs: iter(["100%", "imagename: m1l0/myproject:latest"])
+    mock_reuse.return_value = True
+
+    config = {
+        "source": "dir:///tmp/123",
+        "service": "dockerhub",
+        "repository": "m1l0/myproject",
+        "revision": "latest"
+    }
+
+    request = BuildRequest(
+        id="123",
+        config=BuildConfig(**config)
+    )
+
+    res = list(ImageBuilder(request, code_copy_path=str(code_path)).build())
+    assert res == ["100%"]
+    assert mock_builder.call_count == 1
+
+    # Rebuild of unchanged source is served from the cache
+    request.config.revision = "v2"
+    imagebuilder = ImageBuilder(request, code_copy_path=str(code_path))
+    res = list(imagebuilder.build())
+    assert "Build cache hit" in res[0]
+    assert mock_builder.call_count == 1
+    assert imagebuilder.imagename == "imagename: m1l0/myproject:v2"
+    mock_reuse.assert_called_with("m1l0/myproject:latest", "m1l0/myproject:v2", mock_reuse.call_args[0][2])
+
+
+@patch("builder.core.imagebuilder.image_details")
+@patch("builder.core.imagebuilder.push_docker_image")
+@patch("builder.core.imagebuilder.build_docker_image")
+@patch("builder.core.imagebuilder.prepare_archive")
+@patch("builder.core.imagebuilder.create_dockerfile")
+def test_build_and_push_recorded_in_catalog(mock_docker, mock_archive, mock_builder, mock_push, mock_details,
+                                            tmp_path):
+    code_path = tmp_path / "123"
+    code_path.mkdir()
+    (code_path / "main.py").write_text("print('hello')")
+    mock_docker.return_value = "DOCKERFILE CONTENTS"
+    mock_builder.return_value = iter(["100%", "imagename: m1l0/myproject:latest"])
+    mock_push.return_value = iter(["100%", "digest: sha256:ccc", "repository: m1l0/myproject:latest"])
+    mock_details.return_value = {"Id": "sha256:aaa", "Size": 1024, "RepoDigests": []}
+
+    config = {
+        "source": "dir:///tmp/123",
+        "namespace": "m1l0",
+        "name": "myproject",
+        "service": "dockerhub",
+        "repository": "m1l0/myproject",
+        "revision": "latest"
+    }
+    request = BuildRequest(id="123", config=BuildConfig(**config))
+
+    imagebuilder = ImageBuilder(request, code_copy_path=str(code_path))
+    list(imagebuilder.build())
+    assert list(imagebuilder.push()) == ["100%"]
+
+    entry = imagebuilder.catalog.find("m1l0/myproject")
+    assert entry["id"] == "123"
+    assert entry["image_id"] == "sha256:aaa"
+    assert entry["digest"] == "sha256:ccc"
+    assert entry["labels"]["m1l0.name"] == "myproject"
+
+
+@patch("builder.core.imagebuilder.tag_image")
+@patch("builder.core.imagebuilder.push_docker_image")
+def test_push_fan_out(mock_push, mock_tag):
+    def push(service, repository, revision, job_id):
+        yield "{} 100%".format(job_id)
+        if service == "dockerhub" and revision == "1.0":
+            raise RuntimeError("denied")
+        yield "repository: {}/{}:{}".format(service, repository, revision)
+
+    mock_push.side_effect = push
+
+    config = {
+        "source": "dir:///tmp/123",
+        "service": "ecr,dockerhub",
+        "repository": "m1l0/myproject",
+        "revision": "latest,1.0"
+    }
+    request = BuildRequest(id="123", config=BuildConfig(**config))
+
+    imagebuilder = ImageBuilder(request, catalog=Mock())
+    res = []
+    with pytest.raises(RuntimeError) as exc_info:
+        for log in imagebuilder.push():
+            res.append(log)
+
+    assert "dockerhub 1.0" in str(exc_info.value)
+    mock_tag.assert_called_once_with("m1l0/myproject:latest", "m1l0/myproject:1.0")
+    assert mock_push.call_count == 4
+    assert "[ecr 1.0] 123-ecr-1.0 100%" in res
+    assert "[dockerhub 1.0] Push failed: denied" in res
+    assert "[ecr latest] Pushed ecr/m1l0/myproject:latest " in res
+    assert len([x for x in res if " Pushed " in x]) == 3
+
+    # The targets pushed before the failure are recorded
+    assert sorted(imagebuilder._repositories) == [
+        "repository: dockerhub/m1l0/myproject:latest",
+        "repository: ecr/m1l0/myproject:1.0",
+        "repository: ecr/m1l0/myproject:latest"
+    ]
+    assert imagebuilder.catalog.record_push.call_count == 3
+
+
+@patch("builder.core.imagebuilder.remove_image")
+def test_cleanup_repository_removes_every_pushed_image(mock_remove):
+    imagebuilder = ImageBuilder(BuildRequest(id="123"))
+    imagebuilder._repositories = [
+        "repository: registry.example.com/myproject:latest",
+        "repository: m1l0/myproject:latest"
+    ]
+
+    imagebuilder.cleanup_repository()
+    assert [x[0][0] for x in mock_remove.call_args_list] == [
+        "registry.example.com/myproject:latest",
+        "m1l0/myproject:latest"
+    ]
+
+
+def test_cache_sources(monkeypatch):
+    request = BuildRequest(id="789", config=BuildConfig(namespace="m1l0", name="myproject", revision="v3"))
+    imagebuilder = ImageBuilder(request)
+    imagebuilder.config = {"namespace": "m1l0", "name": "myproject"}
+
+    imagebuilder.catalog.record_build("123", "m1l0", "myproject", "v1", "m1l0/myproject:v1")
+    imagebuilder.catalog.record_build("456", "m1l0", "myproject", "v2", "m1l0/myproject:v2")
+    imagebuilder.catalog.record_push("456", "m1l0/myproject:v2", "123.dkr.ecr/m1l0/myproject:v2")
+    imagebuilder.catalog.record_push("456", "m1l0/myproject:v2", "m1l0/myproject:v2")
+
+    # Every repository a build was pushed to is a source, latest push first
+    assert imagebuilder.cache_sources("m1l0/myproject:v3") == [
+        "m1l0/myproject:v3",
+        "m1l0/myproject:v2",
+        "123.dkr.ecr/m1l0/myproject:v2",
+        "m1l0/myproject:v1"
+    ]
+
+    monkeypatch.setenv("M1L0_BUILDER_CACHE_FROM_COUNT", "0")
+    assert imagebuilder.cache_sources("m1l0/myproject:v3") == []
+
+
+@patch("builder.core.imagebuilder.image_details")
+@patch("builder.core.imagebuilder.reuse_cached_image")
+@patch("builder.core.imagebuilder.build_docker_image")
+@patch("builder.core.imagebuilder.prepare_archive")
+def test_build_cache_hit_across_request_ids(mock_archive, mock_builder, mock_reuse, mock_details, tmp_path):
+    code_path = tmp_path / "src"
+    code_path.mkdir()
+    (code_path / "main.py").write_text("print('hello')")
+    (code_path / "requirements.txt").write_text("numpy")
+    mock_builder.side_effect = lambda *args, **kwargs: iter(["100%", "imagename: m1l0/myproject:latest"])
+    mock_reuse.return_value = True
+    mock_details.return_value = {"Id": "sha256:base1"}
+
+    config = {
+        "source": "dir:///tmp/src",
+        "service": "dockerhub",
+        "repository": "m1l0/myproject",
+        "revision": "latest",
+        "framework": "tensorflow",
+        "version": "2.5.0",
+        "pyversion": "3.8",
+        "resource": "cpu",
+        "entry": "main.py"
+    }
+
+    request = BuildRequest(id="aaaa-1", config=BuildConfig(**config))
+    list(ImageBuilder(request, code_copy_path=str(code_path)).build())
+    assert "aaaa-1" not in mock_archive.call_args[0][0]
+
+    # Requests differ in id only, the rendered dockerfile and hash are the same
+    request = BuildRequest(id="bbbb-2", config=BuildConfig(**config))
+    res = list(ImageBuilder(request, code_copy_path=str(code_path)).build())
+    assert "Build cache hit" in res[0]
+    assert mock_builder.call_count == 1
+
+    # The base image was updated and pulled again so the image is rebuilt on it
+    mock_details.return_value = {"Id": "sha256:base2"}
+    request = BuildRequest(id="cccc-3", config=BuildConfig(**config))
+    res = list(ImageBuilder(request, code_copy_path=str(code_path)).build())
+    assert not any("Build cache hit" in x for x in res)
+    assert mock_builder.call_count == 2
+
+    # A base image missing locally is pulled by the build, the cache is not used
+    mock_details.return_value = None
+    res = list(ImageBuilder(request, code_copy_path=str(code_path)).build())
+    assert mock_builder.call_count == 3
@@ -0,0 +1,77 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from builder.core.cloudwatchlogs import CloudWatchLogShipper
+from builder.core.logsinks import (
+    FileLogSink,
+    LogSink,
+    NullLogSink,
+    StdoutLogSink,
+    open_log_sink
+)
+
+
+def test_open_log_sink(monkeypatch):
+    monkeypatch.delenv("MODE", raising=False)
+    monkeypatch.setenv("M1L0_BUILDER_LOG_SINK", "null")
+    assert isinstance(open_log_sink("123"), NullLogSink)
+
+    monkeypatch.setenv("M1L0_BUILDER_LOG_SINK", "stdout")
+    assert isinstance(open_log_sink("123"), StdoutLogSink)
+
+    monkeypatch.setenv("M1L0_BUILDER_LOG_SINK", "")
+    monkeypatch.setenv("MODE", "Local")
+    assert isinstance(open_log_sink("123"), FileLogSink)
+
+    monkeypatch.setenv("M1L0_BUILDER_LOG_SINK", "kafka")
+    with pytest.raises(ValueError):
+        open_log_sink("123")
+
+
+def test_open_log_sink_defaults_to_cloudwatch(monkeypatch):
+    monkeypatch.delenv("MODE", raising=False)
+    monkeypatch.delenv("M1L0_BUILDER_LOG_SINK", raising=False)
+
+    sink = open_log_sink("123")
+    assert isinstance(sink, CloudWatchLogShipper)
+    assert isinstance(sink, LogSink)
+    sink.close()
+
+
+def test_log_sink_requires_put():
+    with pytest.raises(TypeError):
+        LogSink("123")
+
+    class PartialSink(LogSink):
+        pass
+
+    with pytest.raises(TypeError):
+        PartialSink("123")
+
+
+def test_file_log_sink_rotates_compressed(tmp_path, monkeypatch):
+    monkeypatch.setenv("M1L0_BUILDER_LOG_FILE_SIZE", "1000")
+
+    with FileLogSink("123", log_dir=str(tmp_path)) as sink:
+        for i in range(50):
+            sink.put("Step {}/50 : RUN true".format(i))
+
+    files = sorted(os.listdir(str(tmp_path)))
+    assert "123.log" not in files, "Finished stream is only kept compressed"
+    assert len(files) > 1 and all(f.endswith(".gz") for f in files)
+
+    lines = []
+    for name in reversed(sorted(files, key=lambda f: int(f.split(".")[2]))):
+        with gzip.open(os.path.join(str(tmp_path), name), "rt") as f:
+            lines += [json.loads(line.split(" ", 2)[2]) for line in f]
+    assert lines == ["Step {}/50 : RUN true".format(i) for i in range(50)]
+
+
+def test_stdout_log_sink(capsys):
+    with StdoutLogSink("123") as sink:
+        sink.put("Step 1/1 : FROM python")
+
+    assert capsys.readouterr().out == "[123] Step 1/1 : FROM python\n"
@@ -0,0 +1,78 @@
+import socket
+import urllib.request
+
+import pytest
+from prometheus_client import REGISTRY
+
+from builder.core.metrics import cache_lookup, count_bytes, phase, start_metrics_server, track_scheduler
+from builder.core.repo import prepare_archive
+from builder.service.scheduler import BuildScheduler
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_phase_recorded_on_failure():
+    before = sample("m1l0_builder_phase_seconds_count", operation="build", phase="test")
+
+    with phase("build", "test"):
+        pass
+
+    with pytest.raises(RuntimeError):
+        with phase("build", "test"):
+            raise RuntimeError("Build failed")
+
+    assert sample("m1l0_builder_phase_seconds_count", operation="build", phase="test") == before + 2
+
+
+def test_bytes_and_cache_lookups():
+    before = sample("m1l0_builder_bytes_total", kind="test")
+    count_bytes("test", 100)
+    count_bytes("test", None)
+    assert sample("m1l0_builder_bytes_total", kind="test") == before + 100
+
+    hits = sample("m1l0_builder_cache_lookups_total", cache="test", result="hit")
+    misses = sample("m1l0_builder_cache_lookups_total", cache="test", result="miss")
+    cache_lookup("test", True, 3)
+    cache_lookup("test", False)
+    cache_lookup("test", False, 0)
+    assert sample("m1l0_builder_cache_lookups_total", cache="test", result="hit") == hits + 3
+    assert sample("m1l0_builder_cache_lookups_total", cache="test", result="miss") == misses + 1
+
+
+def test_context_bytes_counted(tmp_path):
+    (tmp_path / "main.py").write_text("print('hello')")
+    before = sample("m1l0_builder_bytes_total", kind="context")
+
+    with prepare_archive("FROM python:3.8", str(tmp_path)) as archive:
+        size = len(archive.read())
+
+    assert sample("m1l0_builder_bytes_total", kind="context") == before + size
+
+
+def test_scheduler_gauges():
+    scheduler = BuildScheduler(max_builds=1, queue_size=1)
+    track_scheduler(scheduler)
+
+    ticket = scheduler.acquire("team")
+    assert sample("m1l0_builder_active_builds") == 1
+    assert sample("m1l0_builder_queued_builds") == 0
+
+    scheduler.release(ticket)
+    assert sample("m1l0_builder_active_builds") == 0
+
+
+def test_metrics_server(monkeypatch):
+    monkeypatch.delenv("M1L0_BUILDER_METRICS_PORT", raising=False)
+    assert not start_metrics_server()
+    monkeypatch.setenv("M1L0_BUILDER_METRICS_PORT", " ")
+    assert not start_metrics_server()
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    assert start_metrics_server(port, addr="127.0.0.1")
+    body = urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(port), timeout=5).read().decode("utf-8")
+    assert "m1l0_builder_phase_seconds" in body
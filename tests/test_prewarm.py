@@ -0,0 +1,69 @@
+from unittest.mock import patch
+
+from docker.errors import APIError, ImageNotFound
+
+from builder.core.catalog import ImageCatalog
+from builder.core.prewarm import BaseImagePrewarmer
+
+
+def use(catalog, image, times):
+    for _ in range(times):
+        catalog.record_base_image_use(image)
+
+
+@patch("builder.core.prewarm.docker_api_client")
+def test_prewarm_most_used(mock_client, tmp_path):
+    api_client = mock_client.return_value
+    api_client.inspect_image.return_value = {"Size": 100}
+
+    catalog = ImageCatalog(str(tmp_path / "catalog.db"))
+    use(catalog, "m1l0/tensorflow:2.4.0-py3.8-cpu", 3)
+    use(catalog, "m1l0/pytorch:1.8.0-py3.8-gpu", 2)
+    use(catalog, "m1l0/sklearn:0.24-py3.8-cpu", 1)
+
+    prewarmer = BaseImagePrewarmer(catalog=catalog, count=2, max_bytes=1000)
+    assert prewarmer.run_once() == 0
+
+    pulled = [(c[0][0], c[1]["tag"]) for c in api_client.pull.call_args_list]
+    assert pulled == [("m1l0/tensorflow", "2.4.0-py3.8-cpu"), ("m1l0/pytorch", "1.8.0-py3.8-gpu")]
+    assert prewarmer.warm_images() == {"m1l0/tensorflow:2.4.0-py3.8-cpu", "m1l0/pytorch:1.8.0-py3.8-gpu"}
+
+    entries = {x["image"]: x for x in catalog.base_images()}
+    assert entries["m1l0/tensorflow:2.4.0-py3.8-cpu"]["size"] == 100
+    assert entries["m1l0/tensorflow:2.4.0-py3.8-cpu"]["uses"] == 3
+
+
+@patch("builder.core.prewarm.docker_api_client")
+def test_prewarm_evicts_least_used(mock_client, tmp_path):
+    sizes = {
+        "m1l0/tensorflow:2.4.0-py3.8-cpu": 400,
+        "m1l0/pytorch:1.8.0-py3.8-gpu": 400,
+        "m1l0/sklearn:0.24-py3.8-cpu": 300,
+        "m1l0/xgboost:1.3-py3.8-cpu": 300
+    }
+
+    def inspect_image(image):
+        if image not in sizes:
+            raise ImageNotFound("missing")
+        return {"Size": sizes[image]}
+
+    def remove_image(image):
+        if image == "m1l0/xgboost:1.3-py3.8-cpu":
+            raise APIError("image is being used by running container")
+        del sizes[image]
+
+    api_client = mock_client.return_value
+    api_client.inspect_image.side_effect = inspect_image
+    api_client.remove_image.side_effect = remove_image
+
+    catalog = ImageCatalog(str(tmp_path / "catalog.db"))
+    use(catalog, "m1l0/tensorflow:2.4.0-py3.8-cpu", 4)
+    use(catalog, "m1l0/pytorch:1.8.0-py3.8-gpu", 3)
+    use(catalog, "m1l0/sklearn:0.24-py3.8-cpu", 2)
+    use(catalog, "m1l0/xgboost:1.3-py3.8-cpu", 1)
+
+    prewarmer = BaseImagePrewarmer(catalog=catalog, count=1, max_bytes=1000)
+    assert prewarmer.run_once() == 700
+
+    # xgboost is still in use and tensorflow is warm
+    assert set(sizes) == {"m1l0/tensorflow:2.4.0-py3.8-cpu", "m1l0/xgboost:1.3-py3.8-cpu"}
@@ -0,0 +1,329 @@
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import tarfile
+from unittest.mock import patch, Mock
+
+from docker.errors import APIError, ImageNotFound, NotFound
+import pytest
+
+from builder.core.ignores import IgnoreMatcher
+from builder.core.repo import prepare_archive, build_docker_image, create_dockerfile, LayerCacheReport, \
+    push_docker_image, remote_image_digest, buildkit_build, pull_cache_sources, recent_ecr_images, CONTEXT_DIR
+
+TEMPLATES = os.path.join(str(Path(__file__).parent.parent), "builder", "templates")
+
+
+def test_prepare_archive(tmp_path):
+    code_path = tmp_path / "123"
+    code_path.mkdir()
+    (code_path / "main.py").write_text("print('hello')")
+
+    context = prepare_archive("FROM python", str(code_path))
+    assert context.tell() == 0, "Context should be rewound for streaming"
+
+    with tarfile.open(fileobj=context, mode="r") as t:
+        names = t.getnames()
+        assert t.extractfile("Dockerfile").read() == b"FROM python"
+
+    assert "123/main.py" in names
+    context.close()
+
+
+def test_prepare_archive_skips_ignored(tmp_path):
+    for p in ["main.py", "data/train.csv", "pkg/mod.pyc"]:
+        path = tmp_path / p
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    (tmp_path / ".dockerignore").write_text("data\n")
+
+    matcher = IgnoreMatcher.for_context(str(tmp_path), ["*.pyc"])
+    context = prepare_archive("FROM python", str(tmp_path), custom_dockerfile=True, matcher=matcher)
+
+    with tarfile.open(fileobj=context, mode="r") as t:
+        names = t.getnames()
+    context.close()
+
+    assert "./main.py" in names
+    assert "./pkg" in names
+    assert "./data" not in names and "./data/train.csv" not in names
+    assert "./pkg/mod.pyc" not in names
+
+
+def test_prepare_archive_custom_dockerfile(tmp_path):
+    Path(os.path.join(tmp_path, "main.py")).touch()
+
+    context = prepare_archive("FROM python", str(tmp_path), custom_dockerfile=True)
+
+    with tarfile.open(fileobj=context, mode="r") as t:
+        assert "./main.py" in t.getnames()
+    context.close()
+
+
+@patch("builder.core.repo.open_log_sink")
+@patch("builder.core.repo.service_login")
+@patch("builder.core.repo.docker_api_client")
+def test_build_docker_image_streams_context(mock_client, mock_login, mock_shipper, tmp_path):
+    api_client = Mock()
+    api_client.build.return_value = iter([{"stream": "Step 1/1 : FROM python"}])
+    mock_client.return_value = api_client
+    mock_login.return_value = ("Login Succeeded", {})
+
+    context = prepare_archive("FROM python", str(tmp_path))
+    res = list(build_docker_image(context, "m1l0/myproject:latest", {}, {"id": "123"}))
+
+    assert res[-1] == "imagename: m1l0/myproject:latest"
+    assert api_client.build.call_args[1]["fileobj"] is context, "Context file is passed without copying"
+    assert context.closed
+    assert mock_shipper.return_value.close.called, "Logs are flushed when the build ends"
+
+
+def test_create_dockerfile_installs_requirements_before_code():
+    config = {
+        "framework": "tensorflow",
+        "version": "2.4.0",
+        "pyversion": "3.8",
+        "resource": "cpu",
+        "entry": "main.py",
+        "tags": {},
+        "framework_labels": {"m1l0.name": "myproject"}
+    }
+
+    dockerfile = create_dockerfile(config, TEMPLATES, CONTEXT_DIR, has_requirements=True, has_constraints=True)
+
+    reqs_copy = dockerfile.index("COPY code/requirements.txt code/constraints.txt /opt/model/")
+    pip_install = dockerfile.index("--requirement /opt/model/requirements.txt --constraint /opt/model/constraints.txt")
+    code_copy = dockerfile.index("COPY code /opt/model")
+    assert reqs_copy < pip_install < code_copy
+
+    dockerfile = create_dockerfile(config, TEMPLATES, "123")
+    assert "requirements.txt" not in dockerfile
+
+
+def test_layer_cache_report():
+    report = LayerCacheReport()
+    for line in [
+        "Step 1/4 : FROM python",
+        " ---> 1234",
+        "Step 2/4 : COPY 123/requirements.txt /opt/model/",
+        " ---> Using cache\n ---> 5678\n",
+        "Step 3/4 : RUN python3 -m pip install",
+        " ---> Using cache",
+        "Step 4/4 : COPY 123 /opt/model",
+        " ---> Running in abcd"
+    ]:
+        report.observe(line)
+
+    assert report.hits == 2
+    assert report.misses == 1
+    assert report.summary() == [
+        "Layer cache: 2 cached, 1 built",
+        "  [cached] COPY 123/requirements.txt /opt/model/",
+        "  [cached] RUN python3 -m pip install",
+        "  [built] COPY 123 /opt/model"
+    ]
+
+
+@patch("builder.core.repo.image_details")
+@patch("builder.core.repo.docker_api_client")
+def test_remote_image_digest_dockerhub(mock_client, mock_details):
+    mock_details.return_value = {"Id": "sha256:aaa", "Size": 1, "RepoDigests": ["m1l0/myproject@sha256:bbb"]}
+    api_client = mock_client.return_value
+
+    api_client.inspect_distribution.return_value = {"Descriptor": {"digest": "sha256:bbb"}}
+    assert remote_image_digest("dockerhub", "m1l0/myproject", "m1l0/myproject", "v1", {}) == "sha256:bbb"
+
+    api_client.inspect_distribution.return_value = {"Descriptor": {"digest": "sha256:ccc"}}
+    assert remote_image_digest("dockerhub", "m1l0/myproject", "m1l0/myproject", "v1", {}) is None
+
+
+@patch("builder.core.repo.fetch_credentials")
+@patch("builder.core.repo.session_client")
+@patch("builder.core.repo.image_details")
+def test_remote_image_digest_ecr(mock_details, mock_session, mock_creds):
+    mock_details.return_value = {"Id": "sha256:aaa", "Size": 1, "RepoDigests": []}
+    ecr_client = mock_session.return_value
+    ecr_client.batch_get_image.return_value = {"images": [{
+        "imageId": {"imageDigest": "sha256:bbb", "imageTag": "v1"},
+        "imageManifest": json.dumps({"config": {"digest": "sha256:aaa"}})
+    }]}
+
+    assert remote_image_digest("ecr", "123.dkr.ecr/myproject", "myproject", "v1", {}) == "sha256:bbb"
+    assert ecr_client.batch_get_image.call_args[1]["imageIds"] == [{"imageTag": "v1"}]
+
+    ecr_client.batch_get_image.return_value = {"images": [], "failures": [{"failureCode": "ImageNotFound"}]}
+    assert remote_image_digest("ecr", "123.dkr.ecr/myproject", "myproject", "v1", {}) is None
+
+
+@patch("builder.core.repo.open_log_sink")
+@patch("builder.core.repo.remote_image_digest")
+@patch("builder.core.repo.service_login")
+@patch("builder.core.repo.docker_api_client")
+def test_push_docker_image_skips_unchanged(mock_client, mock_login, mock_remote, mock_sink):
+    mock_login.return_value = ("Login Succeeded", {})
+    mock_remote.return_value = "sha256:bbb"
+
+    res = list(push_docker_image("dockerhub", "m1l0/myproject", "v1", "123"))
+
+    assert not mock_client.return_value.push.called
+    assert "skipping push" in res[0]
+    assert res[1:] == ["digest: sha256:bbb", "repository: m1l0/myproject:v1"]
+
+
+def test_layer_cache_report_buildkit():
+    report = LayerCacheReport()
+    for line in [
+        "#1 [internal] load build definition from Dockerfile",
+        "#1 DONE 0.0s",
+        "#5 [builder 1/3] FROM docker.io/library/python:3.8",
+        "#7 [builder 2/3] RUN python3 -m pip install --requirement /opt/model/requirements.txt",
+        "#8 [stage-1 2/3] COPY 123 /opt/model",
+        "#7 CACHED",
+        "#8 0.102 copying",
+        "#8 [stage-1 2/3] COPY 123 /opt/model",
+        "#8 DONE 0.2s"
+    ]:
+        report.observe(line)
+
+    assert report.hits == 1
+    assert report.misses == 1
+    assert report.summary()[1:] == [
+        "  [cached] builder RUN python3 -m pip install --requirement /opt/model/requirements.txt",
+        "  [built] stage-1 COPY 123 /opt/model"
+    ]
+
+
+def test_create_dockerfile_buildkit():
+    config = {
+        "framework": "tensorflow",
+        "version": "2.4.0",
+        "pyversion": "3.8",
+        "resource": "cpu",
+        "entry": "main.py",
+        "tags": {},
+        "framework_labels": {"m1l0.name": "myproject"}
+    }
+
+    dockerfile = create_dockerfile(config, TEMPLATES, "123", has_requirements=True, buildkit=True)
+    assert dockerfile.startswith("# syntax=docker/dockerfile:1\n")
+    assert "RUN --mount=type=cache,target=/root/.cache/pip" in dockerfile
+    assert "--no-cache-dir" not in dockerfile
+
+    dockerfile = create_dockerfile(config, TEMPLATES, "123", has_requirements=True)
+    assert "syntax" not in dockerfile and "--mount" not in dockerfile
+
+
+@pytest.fixture
+def fake_docker_cli(tmp_path, monkeypatch):
+    """docker cli which reports its args, env and the size of the context on stdin"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    cli = bin_dir / "docker"
+    cli.write_text(
+        "#!/bin/sh\n"
+        "echo \"#1 args $*\"\n"
+        "echo \"#2 env $DOCKER_BUILDKIT $DOCKER_HOST\"\n"
+        "echo \"#3 auths $(cat $DOCKER_CONFIG/config.json)\"\n"
+        "echo \"#4 context $(wc -c | tr -d ' ')\"\n"
+        "echo \"#5 config $DOCKER_CONFIG $(stat -c %a $DOCKER_CONFIG/config.json)\"\n"
+        "exit ${FAKE_DOCKER_EXIT:-0}\n"
+    )
+    cli.chmod(0o755)
+    monkeypatch.setenv("PATH", "{}:{}".format(bin_dir, os.environ["PATH"]))
+
+
+def test_buildkit_build(fake_docker_cli, tmp_path, monkeypatch):
+    context = prepare_archive("FROM python", str(tmp_path))
+    size = os.fstat(context.fileno()).st_size
+
+    lines = list(buildkit_build(context, "m1l0/myproject:latest", labels={"m1l0.content-hash": "abc"},
+                                registries={"https://index.docker.io/v1/": {"username": "u", "password": "p"}},
+                                cache_from=["m1l0/myproject:v1"]))
+
+    assert lines[0] == "#1 args build --progress=plain --tag m1l0/myproject:latest " \
+                       "--build-arg BUILDKIT_INLINE_CACHE=1 --label m1l0.content-hash=abc " \
+                       "--cache-from m1l0/myproject:v1 -"
+    assert lines[1] == "#2 env 1 unix:///var/run/docker.sock"
+    assert '"https://index.docker.io/v1/": {"auth": "dTpw"}' in lines[2]
+    assert lines[3] == "#4 context {}".format(size)
+
+    # The docker config holding the registry auths is private and removed after the build
+    _, _, docker_config, mode = lines[4].split()
+    assert mode == "600"
+    assert not os.path.exists(docker_config)
+
+    monkeypatch.setenv("FAKE_DOCKER_EXIT", "1")
+    context.seek(0)
+    with pytest.raises(APIError):
+        list(buildkit_build(context, "m1l0/myproject:latest"))
+    context.close()
+
+
+def test_buildkit_build_removes_docker_config_when_closed(fake_docker_cli, tmp_path):
+    context = prepare_archive("FROM python", str(tmp_path))
+
+    logs = buildkit_build(context, "m1l0/myproject:latest",
+                          registries={"https://index.docker.io/v1/": {"username": "u", "password": "p"}})
+    line = next(logs)
+    while not line.startswith("#5"):
+        line = next(logs)
+    docker_config = line.split()[2]
+    assert os.path.exists(docker_config)
+
+    # The client went away before the build finished
+    logs.close()
+    context.close()
+    assert not os.path.exists(docker_config)
+
+
+def test_pull_cache_sources():
+    api_client = Mock()
+    ecr = "123.dkr.ecr.us-east-1.amazonaws.com"
+
+    def inspect_image(image):
+        if image != "m1l0/myproject:local":
+            raise ImageNotFound("missing")
+        return {}
+
+    api_client.inspect_image.side_effect = inspect_image
+
+    def pull(repository, tag=None, auth_config=None):
+        if tag == "gone":
+            raise NotFound("manifest unknown")
+
+    api_client.pull.side_effect = pull
+
+    images = ["m1l0/myproject:local", "m1l0/myproject:v1", ecr + "/myproject:v2", ecr + "/myproject:gone",
+              "localhost:5000/myproject:v3"]
+    available = pull_cache_sources(api_client, images, {"username": "u"}, "https://" + ecr)
+
+    # Only images of the target registry are pulled, missing local tags are skipped
+    assert available == ["m1l0/myproject:local", ecr + "/myproject:v2"]
+    assert api_client.pull.call_count == 2
+    api_client.pull.assert_any_call(ecr + "/myproject", tag="v2", auth_config={"username": "u"})
+
+    api_client.pull.reset_mock()
+    assert pull_cache_sources(api_client, images, {"username": "u"}) == ["m1l0/myproject:local"]
+    api_client.pull.assert_not_called()
+
+
+@patch("builder.core.repo.fetch_credentials")
+@patch("builder.core.repo.session_client")
+def test_recent_ecr_images(mock_session, mock_creds):
+    # The most recent images are spread across pages
+    mock_session.return_value.get_paginator.return_value.paginate.return_value = [
+        {"imageDetails": [
+            {"imageTags": ["v1"], "imagePushedAt": datetime(2021, 1, 1)},
+            {"imageTags": ["v3"], "imagePushedAt": datetime(2021, 3, 1)}
+        ]},
+        {"imageDetails": [
+            {"imageTags": ["v2", "latest"], "imagePushedAt": datetime(2021, 2, 1)},
+            {"imagePushedAt": datetime(2021, 4, 1)}
+        ]}
+    ]
+
+    assert recent_ecr_images("myproject", "https://123.dkr.ecr.us-east-1.amazonaws.com", 2) == [
+        "123.dkr.ecr.us-east-1.amazonaws.com/myproject:v3",
+        "123.dkr.ecr.us-east-1.amazonaws.com/myproject:v2"
+    ]
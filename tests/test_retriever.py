@@ -2,6 +2,7 @@ import json
 import os
 from pathlib import Path
 import shutil
+import subprocess
 import tarfile
 import tempfile
 
@@ -112,9 +113,11 @@ def test_s3_urls(ssm, s3, create_tmp_directory):
         code_path = retriever.call()
         assert "hello" in os.listdir(code_path)
 
-@patch("github.Github.get_repo")
-@patch("os.system")
-def test_github(fake_os, fake_git, ssm, create_tmp_directory):
+def _git(*args):
+    subprocess.run(["git", "-c", "user.name=m1l0", "-c", "user.email=m1l0@example.com"] + list(args),
+                   check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+def test_github(ssm, create_tmp_directory, tmp_path):
     os.environ.update({
         "SECRET_NAME": "secret", 
         "AWS_DEFAULT_REGION": "us-east-1",
@@ -132,21 +135,66 @@ def test_github(fake_os, fake_git, ssm, create_tmp_directory):
         SecretString=creds
     )
 
-    fake_git.return_value = Mock(clone_url="myrepo")
-    fake_os.return_value = True
-
-    request = BuildRequest(id="123", config=BuildConfig(source="https://github.com/myrepo.git"))
+    # Local repository standing in for the remote
+    repo = os.path.join(str(tmp_path), "myrepo.git")
+    _git("init", "--quiet", repo)
+    Path(os.path.join(repo, "hello")).touch()
+    Path(os.path.join(repo, "notes.md")).touch()
+    _git("-C", repo, "add", ".")
+    _git("-C", repo, "commit", "--quiet", "-m", "first")
+    _git("-C", repo, "tag", "v1")
+    Path(os.path.join(repo, "second")).touch()
+    _git("-C", repo, "add", ".")
+    _git("-C", repo, "commit", "--quiet", "-m", "second")
+
+    request = BuildRequest(id="123", config=BuildConfig(source="file://{}".format(repo)))
+    request.ignores.append(BuildIgnores(value="*.md"))
     retriever = GetSourceFiles(request)
 
     with create_tmp_directory("test", "123") as res:
         _, new_dir = res
-        
-        tmp_fpath = f"{new_dir}_tmp"
-        os.makedirs(tmp_fpath, exist_ok=True)
-        new_fpath = os.path.join(tmp_fpath, 'hello')
-        Path(new_fpath).touch()
 
         code_path = retriever.call()
         assert code_path == "/tmp/code/123"
-        assert os.path.exists(os.path.join(code_path, "hello")) == True, "Contents should have been moved to new directory"
-        assert os.path.exists(code_path) == True, "Target directory should exist"
+        assert sorted(os.listdir(code_path)) == ["hello", "second"], "Should export HEAD without ignored files"
+
+        shutil.rmtree(code_path)
+
+        # Revision pinned build reuses the mirror
+        request.config.source = "file://{}#v1".format(repo)
+        with patch("builder.core.gitcache.GitMirrorCache.update_mirror") as mock_update:
+            mock_update.side_effect = lambda url, key, token=None: os.path.join(
+                os.environ["M1L0_BUILDER_CACHE_DIR"], "git", key)
+            code_path = GetSourceFiles(request).call()
+        assert sorted(os.listdir(code_path)) == ["hello"]
+
+def test_dir_link_mode(create_tmp_directory, monkeypatch):
+    monkeypatch.setenv("M1L0_BUILDER_DIR_MODE", "link")
+    request = BuildRequest(id="123", config=BuildConfig(source="dir:///tmp/test"))
+    request.ignores.append(BuildIgnores(value="*.txt"))
+    retriever = GetSourceFiles(request)
+
+    with create_tmp_directory("test", "123") as res:
+        orig_dir, new_dir = res
+        os.makedirs(os.path.join(orig_dir, "pkg"))
+        Path(os.path.join(orig_dir, "pkg", "hello.py")).touch()
+        Path(os.path.join(orig_dir, "hello.txt")).touch()
+
+        code_path = retriever.call()
+        assert code_path == "/tmp/code/123"
+        assert os.path.exists(os.path.join(orig_dir, "pkg", "hello.py")), "Source should be left in place"
+        assert os.path.samefile(os.path.join(orig_dir, "pkg", "hello.py"), os.path.join(new_dir, "pkg", "hello.py"))
+        assert os.path.exists(os.path.join(new_dir, "hello.txt")) == False, "File should have been ignored"
+
+def test_dir_direct_mode(create_tmp_directory, monkeypatch):
+    monkeypatch.setenv("M1L0_BUILDER_DIR_MODE", "direct")
+    request = BuildRequest(id="123", config=BuildConfig(source="dir:///tmp/test"))
+    retriever = GetSourceFiles(request)
+
+    with create_tmp_directory("test", "123") as res:
+        orig_dir, new_dir = res
+        Path(os.path.join(orig_dir, "hello")).touch()
+
+        code_path = retriever.call()
+        assert code_path == "/tmp/test"
+        assert os.path.exists(new_dir) == False, "Nothing should be copied"
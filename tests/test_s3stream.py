@@ -0,0 +1,75 @@
+import io
+import os
+import tarfile
+from unittest.mock import patch
+
+from builder.core.ignores import IgnoreMatcher
+from builder.core.retriever import extract_stream, S3SourceCache
+from builder.core.s3stream import S3ObjectReader
+
+
+def test_reader_reassembles_parts_in_order(s3):
+    s3.create_bucket(Bucket="mybucket")
+    body = os.urandom(10 * 1024 + 17)
+    s3.put_object(Bucket="mybucket", Key="context.tar.gz", Body=body)
+
+    with S3ObjectReader(s3, "mybucket", "context.tar.gz", part_size=1024, concurrency=3) as reader:
+        assert reader.size == len(body)
+        assert reader.read() == body
+        assert reader.bytes_read == len(body)
+
+
+def test_reader_empty_object(s3):
+    s3.create_bucket(Bucket="mybucket")
+    s3.put_object(Bucket="mybucket", Key="empty", Body=b"")
+
+    with S3ObjectReader(s3, "mybucket", "empty") as reader:
+        assert reader.read() == b""
+
+
+def _add(t, name, data=b"", **kwargs):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    for k, v in kwargs.items():
+        setattr(info, k, v)
+    t.addfile(info, io.BytesIO(data))
+
+
+def test_extract_stream_filters_members(tmp_path):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as t:
+        _add(t, "./main.py", b"print('hello')")
+        _add(t, "./data/train.csv", b"1,2")
+        _add(t, "../escape.py", b"bad")
+        _add(t, "./link", type=tarfile.SYMTYPE, linkname="../../etc/passwd")
+    archive.seek(0)
+
+    dest = os.path.join(str(tmp_path), "123")
+    extract_stream(archive, dest, IgnoreMatcher(request_patterns=["data"]))
+
+    assert os.listdir(dest) == ["main.py"]
+    assert not os.path.exists(os.path.join(str(tmp_path), "escape.py"))
+
+
+def test_source_cache_reuses_extracted_bundle(s3, tmp_path):
+    s3.create_bucket(Bucket="mybucket")
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as t:
+        _add(t, "./main.py", b"print('hello')")
+        _add(t, "./notes.md", b"notes")
+    s3.put_object(Bucket="mybucket", Key="context.tar.gz", Body=archive.getvalue())
+
+    cache = S3SourceCache(max_bytes=1024 * 1024)
+    first = os.path.join(str(tmp_path), "first")
+    assert cache.fetch(s3, "mybucket", "context.tar.gz", first) is False
+    assert sorted(os.listdir(first)) == ["main.py", "notes.md"]
+
+    second = os.path.join(str(tmp_path), "second")
+    with patch.object(s3, "get_object") as mock_get:
+        assert cache.fetch(s3, "mybucket", "context.tar.gz", second, ["*.md"]) is True
+        mock_get.assert_not_called()
+    assert os.listdir(second) == ["main.py"]
+
+    # New object version has a new ETag and is downloaded again
+    s3.put_object(Bucket="mybucket", Key="context.tar.gz", Body=archive.getvalue() + b"\0" * 1024)
+    assert cache.fetch(s3, "mybucket", "context.tar.gz", os.path.join(str(tmp_path), "third")) is False
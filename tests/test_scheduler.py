@@ -0,0 +1,108 @@
+import threading
+import time
+from unittest.mock import Mock
+
+import grpc
+from grpc_interceptor.exceptions import ResourceExhausted
+import pytest
+
+from builder.service.scheduler import BuildScheduler, request_priority
+
+
+def grpc_context(priority=None):
+    context = Mock()
+    context.invocation_metadata.return_value = [] if priority is None else [("x-m1l0-priority", str(priority))]
+    context.is_active.return_value = True
+    return context
+
+
+def start_waiter(scheduler, namespace, order, context=None):
+    def run():
+        with scheduler.slot(namespace, context):
+            order.append(namespace)
+
+    t = threading.Thread(target=run)
+    t.start()
+    while scheduler.queued == 0 or not any(w.namespace == namespace for w in scheduler._waiting):
+        time.sleep(0.001)
+    return t
+
+
+def test_request_priority():
+    assert request_priority(None) == 0
+    assert request_priority(grpc_context()) == 0
+    assert request_priority(grpc_context(5)) == 5
+    assert request_priority(grpc_context("high")) == 0
+
+
+def test_scheduler_rejects_when_saturated():
+    scheduler = BuildScheduler(max_builds=1, queue_size=0)
+    ticket = scheduler.acquire("m1l0")
+
+    with pytest.raises(ResourceExhausted):
+        scheduler.acquire("m1l0")
+
+    context = grpc_context()
+    context.abort.side_effect = grpc.RpcError()
+    with pytest.raises(grpc.RpcError):
+        scheduler.acquire("m1l0", context)
+
+    code, _ = context.abort.call_args[0]
+    assert code == grpc.StatusCode.RESOURCE_EXHAUSTED
+    trailing = dict(context.set_trailing_metadata.call_args[0][0])
+    assert int(trailing["retry-after"]) >= 1
+
+    scheduler.release(ticket)
+    scheduler.release(scheduler.acquire("m1l0"))
+
+
+def test_scheduler_fair_share_then_priority():
+    scheduler = BuildScheduler(max_builds=2, queue_size=10)
+    first = scheduler.acquire("busy")
+    second = scheduler.acquire("busy")
+
+    order = []
+    threads = [
+        start_waiter(scheduler, "busy", order, grpc_context(10)),
+        start_waiter(scheduler, "low", order),
+        start_waiter(scheduler, "high", order, grpc_context(5))
+    ]
+
+    # Free slots go to namespaces without running builds before "busy"
+    scheduler.release(first)
+    for t in threads:
+        t.join(5)
+    scheduler.release(second)
+
+    assert order == ["high", "low", "busy"]
+    assert scheduler.running == 0 and scheduler.queued == 0
+
+
+def test_scheduler_drops_cancelled_waiters():
+    scheduler = BuildScheduler(max_builds=1, queue_size=10)
+    ticket = scheduler.acquire("m1l0")
+
+    context = grpc_context()
+    context.is_active.return_value = False
+    assert scheduler.acquire("m1l0", context) is None
+    assert scheduler.queued == 0
+
+    scheduler.release(ticket)
+
+
+def test_scheduler_counts_followers():
+    scheduler = BuildScheduler(max_builds=1, queue_size=1)
+    ticket = scheduler.acquire("m1l0")
+
+    with scheduler.follow():
+        assert scheduler.following == 1
+
+        # The follower takes the only queue place
+        with pytest.raises(ResourceExhausted):
+            scheduler.acquire("m1l0")
+        with pytest.raises(ResourceExhausted):
+            with scheduler.follow():
+                pass
+
+    assert scheduler.following == 0
+    scheduler.release(ticket)
@@ -38,6 +38,24 @@ def test_invalid_service():
         ServiceRequestValidator.validate(request)
     assert "Service not one of dockerhub/ecr" in str(exc_info.value)
 
+def test_service_list():
+    config = {
+        "source": "/tmp/123",
+        "service": "ecr, dockerhub",
+        "repository": "m1l0/myproject",
+        "revision": "latest,1.0"
+    }
+
+    request = BuildRequest(
+        id="123",
+        config=BuildConfig(**config)
+    )
+    assert ServiceRequestValidator.validate(request) is None
+
+    request.config.service = "ecr,unknown"
+    with pytest.raises(InvalidArgument):
+        ServiceRequestValidator.validate(request)
+
 def test_invalid_missing_repository():
     config = {
         "service": "ecr",
@@ -67,4 +85,12 @@ def test_invalid_missing_source():
 
     with pytest.raises(InvalidArgument) as exc_info:
         ServiceRequestValidator.validate(request)
-    assert "Source cannot be blank" in str(exc_info.value)
\ No newline at end of file
+    assert "Source cannot be blank" in str(exc_info.value)
+
+def test_validate_backend():
+    assert ServiceRequestValidator.validate_backend(None) is None
+    assert ServiceRequestValidator.validate_backend("buildkit") is None
+
+    with pytest.raises(InvalidArgument) as exc_info:
+        ServiceRequestValidator.validate_backend("kaniko")
+    assert "Builder not one of classic/buildkit" in str(exc_info.value)
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+
+import pytest
+
+from builder.core.workspace import Janitor, Workspace, WorkspaceInUse, WorkspaceQuotaExceeded
+
+
+@pytest.fixture()
+def workspace_dir(tmp_path, monkeypatch):
+    root = os.path.join(str(tmp_path), "code")
+    os.makedirs(root)
+    monkeypatch.setattr("builder.core.workspace.workspace_root", lambda: root)
+    return root
+
+
+def write_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+
+def test_claim_removes_build_dir_on_failure(workspace_dir):
+    workspace = Workspace(quota=1000)
+
+    with pytest.raises(RuntimeError):
+        with workspace.claim("123") as path:
+            assert path == os.path.join(workspace_dir, "123")
+            write_file(os.path.join(path, "main.py"), 100)
+            assert workspace.measure("123") == 100
+            raise RuntimeError("Build failed")
+
+    assert not os.path.exists(os.path.join(workspace_dir, "123"))
+    assert workspace.usage() == 0
+
+
+def test_quota_exceeded(workspace_dir):
+    workspace = Workspace(quota=150)
+
+    with workspace.claim("123") as path:
+        write_file(os.path.join(path, "main.py"), 100)
+        workspace.measure("123")
+
+        with pytest.raises(WorkspaceQuotaExceeded):
+            with workspace.claim("456") as other:
+                write_file(os.path.join(other, "main.py"), 100)
+                workspace.measure("456")
+
+        assert not os.path.exists(os.path.join(workspace_dir, "456"))
+
+        # Only 100 bytes in use so the next build may start
+        with workspace.claim("789"):
+            pass
+
+    workspace.quota = 0
+    assert workspace.usage() == 0
+    with workspace.claim("123"):
+        pass
+
+
+def test_janitor_runs_cleanup_in_background(workspace_dir):
+    workspace = Workspace(quota=1000)
+    workspace.start()
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_cleanup():
+        started.set()
+        release.wait(5)
+
+    try:
+        workspace.janitor.submit(slow_cleanup)
+        assert started.wait(5)
+
+        with workspace.claim("123") as path:
+            write_file(os.path.join(path, "main.py"), 100)
+            workspace.measure("123")
+
+        # Removal is queued behind the slow cleanup
+        assert os.path.exists(os.path.join(workspace_dir, "123"))
+        assert workspace.usage() == 100
+
+        release.set()
+        workspace.janitor.join()
+        assert not os.path.exists(os.path.join(workspace_dir, "123"))
+        assert workspace.usage() == 0
+    finally:
+        release.set()
+        workspace.stop()
+
+    assert not workspace.janitor.running
+
+
+def test_claim_rejects_build_dir_in_use(workspace_dir):
+    workspace = Workspace(quota=1000)
+
+    with workspace.claim("123"):
+        with pytest.raises(WorkspaceInUse):
+            with workspace.claim("123"):
+                pass
+
+
+def test_quota_waits_only_for_pending_removals(workspace_dir):
+    workspace = Workspace(quota=1000)
+    workspace.start()
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_cleanup():
+        started.set()
+        release.wait(5)
+
+    try:
+        with workspace.claim("123") as path:
+            write_file(os.path.join(path, "main.py"), 200)
+            workspace.measure("123")
+            workspace.quota = 150
+
+        # Removal of 123 is pending, the build waits for it and then starts
+        with workspace.claim("456"):
+            assert not os.path.exists(os.path.join(workspace_dir, "123"))
+
+        workspace.janitor.join()
+
+        # Unrelated janitor work does not hold up a build over the quota
+        workspace.janitor.submit(slow_cleanup)
+        assert started.wait(5)
+        with workspace.claim("789") as path:
+            write_file(os.path.join(path, "main.py"), 100)
+            workspace.measure("789")
+
+            workspace.quota = 50
+            start = time.time()
+            with pytest.raises(WorkspaceQuotaExceeded):
+                with workspace.claim("999"):
+                    pass
+            assert time.time() - start < 5
+    finally:
+        release.set()
+        workspace.stop()
+
+
+def test_janitor_logs_failed_cleanup():
+    janitor = Janitor()
+    calls = []
+
+    def failing(x):
+        calls.append(x)
+        raise OSError("busy")
+
+    # Runs on the calling thread when not started
+    janitor.submit(failing, 1)
+    assert calls == [1]
+
+
+def test_sweep_reclaims_orphaned_dirs(workspace_dir):
+    write_file(os.path.join(workspace_dir, "old", "main.py"), 100)
+    write_file(os.path.join(workspace_dir, "moved_tmp", "main.py"), 50)
+
+    workspace = Workspace(quota=1000)
+    with workspace.claim("active") as path:
+        write_file(os.path.join(path, "main.py"), 10)
+
+        assert workspace.sweep() == 100
+        assert os.path.exists(path)
+
+    assert not os.path.exists(os.path.join(workspace_dir, "old"))
+    # Dir sources moved aside are never removed
+    assert os.path.exists(os.path.join(workspace_dir, "moved_tmp"))